@@ -27,19 +27,19 @@ do
         sleep 5
     done
 
+    jobs=()
     for geo in "${geographies_array[@]}"; do
         chunks_array=($(uv run ./src/split_chunks.py \
             --year "$year" --geography "$geo" --state "$state" | jq -r '.[]'))
-
         for chunk in "${chunks_array[@]}"; do
-            echo "Starting job with parameters: mode=foot, year="$year", geography=${geo}, state="$state", centroid_type=weighted, chunk=${chunk}"
-            uv run ./src/calculate_times.py \
-                --mode foot --year "$year" \
-                --geography "$geo" --state "$state" \
-                --centroid-type weighted --chunk "$chunk" \
-                --write-to-s3
-            done
+            jobs+=("${geo}:weighted:${chunk}")
         done
+    done
+
+    echo "Starting ${#jobs[@]} jobs with parameters: mode=foot, year="$year", state="$state""
+    uv run ./src/calculate_times_batch.py \
+        --mode foot --year "$year" --state "$state" \
+        --jobs "${jobs[@]}" --write-to-s3
 
     docker stop osrm
 
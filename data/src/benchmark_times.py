@@ -0,0 +1,665 @@
+import argparse
+import copy
+import json
+import multiprocessing
+import resource
+import time
+import tracemalloc
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import yaml
+from utils.constants import DOCKER_ENDPOINT
+from utils.logging import create_logger
+from utils.mock_osrm import encode_flatbuffers_table, serve
+from utils.osrm import TableRequestBuilder, decode_flatbuffers_table
+from utils.times import (
+    AsyncTravelTimeCalculator,
+    ProcessTravelTimeCalculator,
+    TravelTimeCalculator,
+    TravelTimeConfig,
+    TravelTimeInputs,
+    parse_table_response,
+)
+from utils.utils import format_size, format_time
+
+logger = create_logger(__name__)
+
+
+def create_synthetic_points(
+    n: int, seed: int = 0, state: str = "17"
+) -> pd.DataFrame:
+    """
+    Create a DataFrame of random points shaped like the snapped origins and
+    destinations used by the travel time calculator. Points fall inside a
+    box roughly the size of a 300 km buffered state.
+
+    Args:
+        n: Number of points to create.
+        seed: Seed for the random number generator.
+        state: Two-digit state FIPS code used to prefix the fake GEOIDs.
+    """
+    rng = np.random.default_rng(seed)
+    lon = rng.uniform(-91.5, -87.5, n).round(6)
+    lat = rng.uniform(37.0, 42.5, n).round(6)
+    df = pd.DataFrame(
+        {
+            "id": [f"{state}{i:010d}" for i in range(n)],
+            "lon": lon,
+            "lat": lat,
+            "lon_snapped": lon,
+            "lat_snapped": lat,
+            "is_snapped": False,
+        }
+    )
+    return df
+
+
+def legacy_build(
+    mode: str, origins: pd.DataFrame, destinations: pd.DataFrame
+) -> str:
+    """
+    Row-wise request builder used by the calculator before the vectorized
+    TableRequestBuilder. Kept here as a baseline for benchmarking only.
+    """
+
+    def _col_dict(x) -> dict:
+        return {
+            "id": x["id"],
+            "lon": x["lon_snapped"],
+            "lat": x["lat_snapped"],
+        }
+
+    origins_list = origins.apply(_col_dict, axis=1).tolist()
+    destinations_list = destinations.apply(_col_dict, axis=1).tolist()
+    coords_set = {
+        (item["id"], item["lon"], item["lat"])
+        for item in origins_list + destinations_list
+    }
+    coords_list = list(coords_set)
+    origins_index = [
+        coords_list.index((item["id"], item["lon"], item["lat"]))
+        for item in origins_list
+    ]
+    destinations_index = [
+        coords_list.index((item["id"], item["lon"], item["lat"]))
+        for item in destinations_list
+    ]
+    return (
+        f"/table/v1/{mode}/"
+        + ";".join([f"{lon},{lat}" for _, lon, lat in coords_list])
+        + f"?sources={';'.join([str(i) for i in origins_index])}"
+        + f"&destinations={';'.join([str(i) for i in destinations_index])}"
+    )
+
+
+def legacy_parse_response(
+    response_data: dict,
+    origin_ids: pd.Series,
+    destination_ids: pd.Series,
+) -> pd.DataFrame:
+    """
+    List-based response parser used by the calculator before durations were
+    decoded into NumPy arrays. Kept here as a baseline for benchmarking only.
+    """
+    durations = [i for sl in response_data["durations"] for i in sl]
+    return pd.DataFrame(
+        {
+            "origin_id": origin_ids.repeat(len(destination_ids)).tolist(),
+            "destination_id": destination_ids.tolist() * len(origin_ids),
+            "duration_sec": durations,
+        }
+    )
+
+
+def benchmark_response_parser(
+    block_size: int, n_blocks: int, null_share: float = 0.01
+) -> None:
+    """
+    Measure the time and peak memory needed to turn an OSRM Table API
+    response into a DataFrame, comparing the NumPy parser to the legacy
+    list-based parser. Memory is traced with tracemalloc, so it includes the
+    Python objects built by each parser but not the parsed JSON response.
+
+    Args:
+        block_size: Number of origins AND destinations per block. Should
+            match times.max_split_size in params.yaml.
+        n_blocks: Number of blocks to parse.
+        null_share: Share of pairs returned as null (unroutable).
+    """
+    origins = create_synthetic_points(block_size, seed=0)
+    destinations = create_synthetic_points(block_size, seed=1)
+    rng = np.random.default_rng(0)
+
+    timings: dict[str, list[float]] = {"numpy": [], "legacy": []}
+    peaks: dict[str, list[int]] = {"numpy": [], "legacy": []}
+    for _ in range(n_blocks):
+        durations = rng.uniform(0, 20000, (block_size, block_size)).round(1)
+        durations = durations.astype(object)
+        durations[rng.random(durations.shape) < null_share] = None
+        response_data = {"durations": durations.tolist()}
+        del durations
+
+        parsers = {
+            "numpy": lambda: parse_table_response(
+                response_data, 0, 0, block_size, block_size
+            ),
+            "legacy": lambda: legacy_parse_response(
+                response_data, origins["id"], destinations["id"]
+            ),
+        }
+        for name, parser in parsers.items():
+            tracemalloc.start()
+            start_time = time.perf_counter()
+            df = parser()
+            timings[name].append(time.perf_counter() - start_time)
+            peaks[name].append(tracemalloc.get_traced_memory()[1])
+            tracemalloc.stop()
+            del df
+
+    for name in timings:
+        logger.info(
+            "%s parser: %s blocks of %sx%s, mean %.4fs/block, "
+            "mean peak memory %s/block, max peak memory %s/block",
+            name,
+            n_blocks,
+            block_size,
+            block_size,
+            np.mean(timings[name]),
+            format_size(np.mean(peaks[name])),
+            format_size(np.max(peaks[name])),
+        )
+
+
+def benchmark_response_decoder(
+    block_size: int, n_blocks: int, null_share: float = 0.01
+) -> None:
+    """
+    Time the decoding of raw OSRM Table API response bodies into a float32
+    array of durations, comparing JSON to FlatBuffers. Measures decoding
+    only, from the bytes received to the array passed to the response
+    parser.
+
+    Args:
+        block_size: Number of origins AND destinations per block. The
+            default of 5000 gives 25M cells per block.
+        n_blocks: Number of blocks to decode.
+        null_share: Share of pairs without a route (null in JSON, 0 in
+            FlatBuffers).
+    """
+    rng = np.random.default_rng(0)
+
+    timings: dict[str, list[float]] = {"json": [], "flatbuffers": []}
+    body_sizes: dict[str, list[int]] = {"json": [], "flatbuffers": []}
+    for _ in range(n_blocks):
+        durations = rng.uniform(0, 20000, (block_size, block_size))
+        durations = durations.round(1).astype(np.float32)
+        durations[rng.random(durations.shape) < null_share] = np.nan
+        durations_list = durations.astype(object)
+        durations_list[np.isnan(durations)] = None
+        bodies = {
+            "json": json.dumps(
+                {"code": "Ok", "durations": durations_list.tolist()}
+            ).encode(),
+            "flatbuffers": encode_flatbuffers_table(durations),
+        }
+        del durations, durations_list
+
+        decoders = {
+            "json": lambda body: np.array(
+                json.loads(body)["durations"], dtype=np.float32
+            ),
+            "flatbuffers": lambda body: np.asarray(
+                decode_flatbuffers_table(body)["durations"], dtype=np.float32
+            ),
+        }
+        for name, decoder in decoders.items():
+            start_time = time.perf_counter()
+            decoded = decoder(bodies[name])
+            timings[name].append(time.perf_counter() - start_time)
+            body_sizes[name].append(len(bodies[name]))
+            del decoded
+        del bodies
+
+    for name in timings:
+        logger.info(
+            "%s decoder: %s blocks of %sx%s, mean %.4fs/block, "
+            "max %.4fs/block, mean body size %s/block",
+            name,
+            n_blocks,
+            block_size,
+            block_size,
+            np.mean(timings[name]),
+            np.max(timings[name]),
+            format_size(np.mean(body_sizes[name])),
+        )
+
+
+def benchmark_request_builder(
+    n_origins: int,
+    n_destinations: int,
+    block_size: int,
+    n_blocks: int,
+    skip_legacy: bool = False,
+    encoding: str = "text",
+) -> None:
+    """
+    Time the preparation of OSRM Table API requests per block, comparing the
+    vectorized request builder to the legacy row-wise builder.
+
+    Args:
+        n_origins: Number of synthetic origins.
+        n_destinations: Number of synthetic destinations.
+        block_size: Number of origins AND destinations per block. Should
+            match times.max_split_size in params.yaml.
+        n_blocks: Number of blocks to time.
+        skip_legacy: Skip the (slow) legacy builder.
+        encoding: Coordinate encoding used by the vectorized builder.
+    """
+    origins = create_synthetic_points(n_origins, seed=0)
+    destinations = create_synthetic_points(n_destinations, seed=1)
+    blocks = [
+        (
+            o,
+            d,
+            min(o + block_size, n_origins),
+            min(d + block_size, n_destinations),
+        )
+        for o in range(0, n_origins, block_size)
+        for d in range(0, n_destinations, block_size)
+    ][:n_blocks]
+
+    start_time = time.perf_counter()
+    builder = TableRequestBuilder(
+        mode="car",
+        origins=origins,
+        destinations=destinations,
+        lon_col="lon_snapped",
+        lat_col="lat_snapped",
+        encoding=encoding,
+    )
+    setup_time = time.perf_counter() - start_time
+    logger.info(
+        "Formatted %s coordinate strings in %.3fs",
+        n_origins + n_destinations,
+        setup_time,
+    )
+
+    timings: dict[str, list[float]] = {"vectorized": [], "legacy": []}
+    url_bytes: dict[str, int] = {"vectorized": 0, "legacy": 0}
+    for osi, dsi, oei, dei in blocks:
+        start_time = time.perf_counter()
+        url = builder.build(osi, dsi, oei, dei)
+        timings["vectorized"].append(time.perf_counter() - start_time)
+        url_bytes["vectorized"] += len(url)
+
+        if not skip_legacy:
+            start_time = time.perf_counter()
+            url = legacy_build(
+                "car", origins.iloc[osi:oei], destinations.iloc[dsi:dei]
+            )
+            timings["legacy"].append(time.perf_counter() - start_time)
+            url_bytes["legacy"] += len(url)
+
+    for name, values in timings.items():
+        if not values:
+            continue
+        logger.info(
+            "%s builder: %s blocks of %sx%s, mean %.4fs/block, "
+            "max %.4fs/block, total %s, mean URL size %s/block",
+            name,
+            len(values),
+            block_size,
+            block_size,
+            np.mean(values),
+            np.max(values),
+            format_time(sum(values)),
+            format_size(url_bytes[name] / len(values)),
+        )
+
+
+def benchmark_block_order(
+    mode: str,
+    year: str,
+    state: str,
+    geography: str,
+    centroid_type: str,
+    n_blocks: int,
+) -> None:
+    """
+    Time OSRM Table API requests for the top-level blocks of a real state
+    under each spatial order (GEOID and Hilbert). The same number of blocks
+    is sampled evenly from the block grid of each order. Requires the input
+    files for the state and an OSRM service for its extract running at
+    localhost:5333, as for calculate_times.py.
+
+    Args:
+        mode: Travel mode to route with.
+        year: Year of the input data.
+        state: Two-digit state FIPS code.
+        geography: Census geography of the origins and destinations.
+        centroid_type: Either 'weighted' or 'unweighted'.
+        n_blocks: Number of blocks to time for each order.
+    """
+    with open(Path.cwd() / "params.yaml") as file:
+        params = yaml.safe_load(file)
+    args = argparse.Namespace(
+        mode=mode,
+        year=year,
+        geography=geography,
+        state=state,
+        centroid_type=centroid_type,
+        chunk=None,
+        write_to_s3=False,
+    )
+    config = TravelTimeConfig(args, params=params, logger=logger)
+    inputs = config.load_default_inputs()
+
+    for spatial_order in TravelTimeCalculator.VALID_SPATIAL_ORDERS:
+        # Only the order changes between runs. Blocks keep their static shape
+        # and every block is sent as is
+        config.params = copy.deepcopy(params)
+        config.params["times"]["spatial_order"] = spatial_order
+        config.params["times"]["preflight"]["enabled"] = False
+        config.params["times"]["adaptive_block_size"]["enabled"] = False
+        config.params["times"]["checkpoint"]["enabled"] = False
+        tt_calc = TravelTimeCalculator(config, inputs)
+
+        m_spl_o = inputs.max_split_size_origins
+        m_spl_d = inputs.max_split_size_destinations
+        blocks = [
+            (
+                o,
+                d,
+                min(o + m_spl_o, inputs.n_origins),
+                min(d + m_spl_d, inputs.n_destinations),
+            )
+            for o in range(0, inputs.n_origins, m_spl_o)
+            for d in range(0, inputs.n_destinations, m_spl_d)
+        ]
+        sample_idx = np.linspace(
+            0, len(blocks) - 1, min(n_blocks, len(blocks))
+        )
+        timings, n_pairs, n_null, n_failed = [], 0, 0, 0
+        for i in np.unique(sample_idx.astype(int)):
+            osi, dsi, oei, dei = blocks[i]
+            request_path = tt_calc.request_builder.build(osi, dsi, oei, dei)
+            start_time = time.perf_counter()
+            try:
+                response_data = config.client.get(request_path)
+            except Exception as e:
+                logger.warning("Block %s failed: %s", blocks[i], e)
+                n_failed += 1
+                continue
+            timings.append(time.perf_counter() - start_time)
+            durations = np.array(response_data["durations"], dtype=np.float32)
+            n_pairs += durations.size
+            n_null += int(np.isnan(durations).sum())
+
+        logger.info(
+            "%s order: %s blocks of up to %sx%s, mean %.3fs/block, "
+            "median %.3fs/block, %.0f pairs/sec, %s failed blocks, "
+            "%s null pairs",
+            spatial_order,
+            len(timings),
+            m_spl_o,
+            m_spl_d,
+            np.mean(timings) if timings else float("nan"),
+            np.median(timings) if timings else float("nan"),
+            n_pairs / max(sum(timings), 1e-9),
+            n_failed,
+            n_null,
+        )
+
+
+def benchmark_end_to_end(
+    n_origins: int,
+    n_destinations: int,
+    max_split_size: int,
+    engine: str,
+    concurrency: int | None,
+    latency_ms: float,
+    search_ms: float,
+    n_failing: int,
+    max_table_size: int | None,
+    stream: bool = True,
+) -> None:
+    """
+    Route synthetic origins to synthetic destinations with the travel time
+    calculator against a mock OSRM service (see utils/mock_osrm.py), and
+    report throughput, requests issued, binary search overhead, and peak
+    memory. The mock is started on the OSRM port, so no OSRM service may be
+    running. Pre-flight is disabled, so its cached labels don't carry over
+    between runs. Results are streamed one stripe at a time and discarded,
+    as with calculate_times.py --stream, unless stream is False. Run one
+    configuration per process, since peak memory is measured for the whole
+    process.
+
+    Args:
+        n_origins: Number of origins to route from.
+        n_destinations: Number of destinations to route to.
+        max_split_size: Starting number of origins and destinations per
+            block.
+        engine: One of 'thread', 'async', or 'process'.
+        concurrency: Number of requests in flight with the async engine, or
+            number of worker processes with the process engine.
+        latency_ms: Mock latency per table request.
+        search_ms: Mock latency per source and destination of a request.
+        n_failing: Number of origins that make every request including
+            them fail, each isolated by the binary search.
+        max_table_size: Mock table size limit, in pairs.
+        stream: If False, collect the times and missing pairs of all origins
+            at once with many_to_many, as calculate_times.py does by default.
+    """
+    with open(Path.cwd() / "params.yaml") as file:
+        params = yaml.safe_load(file)
+    params["times"]["max_split_size"] = max_split_size
+    params["times"]["preflight"]["enabled"] = False
+    params["times"]["checkpoint"]["enabled"] = False
+    args = argparse.Namespace(
+        mode="car",
+        year="2024",
+        geography="tract",
+        state="17",
+        centroid_type="weighted",
+        chunk=None,
+        write_to_s3=False,
+        engine=engine,
+        concurrency=concurrency,
+    )
+    config = TravelTimeConfig(args, params=params, logger=logger)
+    origins = create_synthetic_points(n_origins, seed=0)
+    destinations = create_synthetic_points(n_destinations, seed=1)
+    inputs = TravelTimeInputs(
+        origins=origins,
+        destinations=destinations,
+        chunk=None,
+        max_split_size_origins=max_split_size,
+        max_split_size_destinations=max_split_size,
+    )
+
+    failing = origins.sample(n=n_failing, random_state=0)
+    failing_points = {
+        f"{lon},{lat}"
+        for lon, lat in zip(failing["lon_snapped"], failing["lat_snapped"])
+    }
+    host, port = DOCKER_ENDPOINT.removeprefix("http://").split(":")
+    server = multiprocessing.Process(
+        target=serve,
+        kwargs={
+            "host": host,
+            "port": int(port),
+            "latency_ms": latency_ms,
+            "search_ms": search_ms,
+            "failing_points": failing_points,
+            "max_table_size": max_table_size,
+        },
+        daemon=True,
+    )
+    server.start()
+    time.sleep(1)
+
+    try:
+        start_time = time.time()
+        if engine == "async":
+            tt_calc: TravelTimeCalculator = AsyncTravelTimeCalculator(
+                config, inputs, concurrency=concurrency
+            )
+        elif engine == "process":
+            tt_calc = ProcessTravelTimeCalculator(
+                config, inputs, n_workers=concurrency
+            )
+        else:
+            tt_calc = TravelTimeCalculator(config, inputs)
+        n_times, n_missing_pairs = 0, 0
+        if stream:
+            for stripe_df, missing_pairs in tt_calc.iter_many_to_many():
+                n_times += len(stripe_df)
+                n_missing_pairs += missing_pairs.n_pairs
+        else:
+            times_df, missing_pairs = tt_calc.many_to_many()
+            n_times = len(times_df)
+            n_missing_pairs = missing_pairs.n_pairs
+        elapsed = time.time() - start_time
+    finally:
+        server.terminate()
+        server.join()
+
+    n_pairs = n_origins * n_destinations
+    counts = tt_calc.stats.counts
+    logger.info(
+        "Routed %sx%s pairs with the %s engine in %s: %.0f pairs/sec, "
+        "%s times, %s missing",
+        n_origins,
+        n_destinations,
+        engine,
+        format_time(elapsed),
+        n_pairs / max(elapsed, 1e-9),
+        n_times,
+        n_missing_pairs,
+    )
+    logger.info(
+        "Issued %s table requests (%s to isolate failed blocks), sending %s "
+        "pairs for %s input pairs (%.1f%% binary search overhead)",
+        counts["n_requests"],
+        counts["n_fault_isolation_requests"],
+        counts["n_pairs_sent"],
+        n_pairs,
+        100 * (counts["n_pairs_sent"] / max(n_pairs, 1) - 1),
+    )
+    logger.info(
+        "Block search tasks per depth: %s",
+        ", ".join(
+            f"{depth}: {n}"
+            for depth, n in sorted(tt_calc.stats.tasks_per_depth.items())
+        ),
+    )
+    logger.info(
+        "Peak memory usage: %s",
+        format_size(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024),
+    )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    builder_parser = subparsers.add_parser("request-builder")
+    builder_parser.add_argument("--n-origins", type=int, default=10000)
+    builder_parser.add_argument("--n-destinations", type=int, default=20000)
+    builder_parser.add_argument("--block-size", type=int, default=5000)
+    builder_parser.add_argument("--n-blocks", type=int, default=4)
+    builder_parser.add_argument(
+        "--skip-legacy", action="store_true", default=False
+    )
+    builder_parser.add_argument(
+        "--encoding",
+        type=str,
+        default="text",
+        choices=TableRequestBuilder.VALID_ENCODINGS,
+    )
+
+    parser_parser = subparsers.add_parser("response-parser")
+    parser_parser.add_argument("--block-size", type=int, default=2000)
+    parser_parser.add_argument("--n-blocks", type=int, default=3)
+    parser_parser.add_argument("--null-share", type=float, default=0.01)
+
+    decoder_parser = subparsers.add_parser("response-decoder")
+    decoder_parser.add_argument("--block-size", type=int, default=5000)
+    decoder_parser.add_argument("--n-blocks", type=int, default=1)
+    decoder_parser.add_argument("--null-share", type=float, default=0.01)
+
+    order_parser = subparsers.add_parser("block-order")
+    order_parser.add_argument("--mode", required=True, type=str)
+    order_parser.add_argument("--year", required=True, type=str)
+    order_parser.add_argument("--geography", required=True, type=str)
+    order_parser.add_argument("--state", required=True, type=str)
+    order_parser.add_argument("--centroid-type", required=True, type=str)
+    order_parser.add_argument("--n-blocks", type=int, default=8)
+
+    e2e_parser = subparsers.add_parser("end-to-end")
+    e2e_parser.add_argument("--n-origins", type=int, default=5000)
+    e2e_parser.add_argument("--n-destinations", type=int, default=20000)
+    e2e_parser.add_argument("--max-split-size", type=int, default=5000)
+    e2e_parser.add_argument(
+        "--engine",
+        type=str,
+        default="thread",
+        choices=["thread", "async", "process"],
+    )
+    e2e_parser.add_argument("--concurrency", type=int)
+    e2e_parser.add_argument("--latency-ms", type=float, default=0)
+    e2e_parser.add_argument("--search-ms", type=float, default=0)
+    e2e_parser.add_argument("--n-failing", type=int, default=0)
+    e2e_parser.add_argument("--max-table-size", type=int)
+    e2e_parser.add_argument("--no-stream", action="store_true", default=False)
+
+    args = parser.parse_args()
+    if args.benchmark == "request-builder":
+        benchmark_request_builder(
+            n_origins=args.n_origins,
+            n_destinations=args.n_destinations,
+            block_size=args.block_size,
+            n_blocks=args.n_blocks,
+            skip_legacy=args.skip_legacy,
+            encoding=args.encoding,
+        )
+    elif args.benchmark == "response-parser":
+        benchmark_response_parser(
+            block_size=args.block_size,
+            n_blocks=args.n_blocks,
+            null_share=args.null_share,
+        )
+    elif args.benchmark == "response-decoder":
+        benchmark_response_decoder(
+            block_size=args.block_size,
+            n_blocks=args.n_blocks,
+            null_share=args.null_share,
+        )
+    elif args.benchmark == "block-order":
+        benchmark_block_order(
+            mode=args.mode,
+            year=args.year,
+            state=args.state,
+            geography=args.geography,
+            centroid_type=args.centroid_type,
+            n_blocks=args.n_blocks,
+        )
+    elif args.benchmark == "end-to-end":
+        benchmark_end_to_end(
+            n_origins=args.n_origins,
+            n_destinations=args.n_destinations,
+            max_split_size=args.max_split_size,
+            engine=args.engine,
+            concurrency=args.concurrency,
+            latency_ms=args.latency_ms,
+            search_ms=args.search_ms,
+            n_failing=args.n_failing,
+            max_table_size=args.max_table_size,
+            stream=not args.no_stream,
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -1,17 +1,24 @@
 import argparse
 import os
+import resource
 import time
 import uuid
 from pathlib import Path
 
+import numpy as np
 import pandas as pd
+import pyarrow as pa
 import yaml
 from utils.logging import create_logger
+from utils.profiling import profile, stage
 from utils.times import (
+    AsyncTravelTimeCalculator,
+    ProcessTravelTimeCalculator,
     TravelTimeCalculator,
     TravelTimeConfig,
+    TravelTimeInputs,
 )
-from utils.utils import format_time, get_md5_hash
+from utils.utils import format_size, format_time, get_md5_hash
 
 logger = create_logger(__name__)
 
@@ -19,22 +26,98 @@ with open(Path.cwd() / "params.yaml") as file:
     params = yaml.safe_load(file)
 os.environ["AWS_PROFILE"] = params["s3"]["profile"]
 
+# IDs are written from categoricals as dictionary arrays, so Parquet
+# dictionary pages are built from the codes rather than from one string per
+# pair. Durations use the in-memory dtype set in params.yaml
+TIMES_SCHEMA = pa.schema(
+    [
+        ("origin_id", pa.dictionary(pa.int32(), pa.string())),
+        ("destination_id", pa.dictionary(pa.int32(), pa.string())),
+        (
+            "duration_sec",
+            pa.from_numpy_dtype(np.dtype(params["times"]["duration_dtype"])),
+        ),
+    ]
+)
+MISSING_PAIRS_SCHEMA = pa.schema(
+    [
+        ("origin_id", pa.string()),
+        ("destination_id", pa.string()),
+    ]
+)
+MISSING_PAIRS_COMPACT_SCHEMA = pa.schema(
+    [
+        ("origin_id", pa.string()),
+        ("destination_ids", pa.list_(pa.string())),
+    ]
+)
 
-def main() -> None:
-    parser = argparse.ArgumentParser()
-    parser.add_argument("--mode", required=True, type=str)
-    parser.add_argument("--year", required=True, type=str)
-    parser.add_argument("--geography", required=True, type=str)
-    parser.add_argument("--state", required=True, type=str)
-    parser.add_argument("--centroid-type", required=True, type=str)
-    parser.add_argument("--chunk", required=False, type=str)
-    parser.add_argument("--write-to-s3", action="store_true", default=False)
-    args = parser.parse_args()
-    script_start_time = time.time()
 
-    # Create a travel times configuration and set of origin/destination inputs
-    config = TravelTimeConfig(args, params=params, logger=logger)
-    inputs = config.load_default_inputs()
+def stream_results(
+    config: TravelTimeConfig, tt_calc: TravelTimeCalculator, location: str
+) -> tuple[int, int, float]:
+    """
+    Route all pairs and write times and missing pairs to Parquet one stripe
+    of origins at a time, so the full results never sit in memory.
+
+    Returns:
+        A tuple of the number of routed pairs, the number of missing pairs,
+        and the time spent writing, in seconds.
+    """
+    n_pairs, n_missing_pairs = 0, 0
+    write_time_sec = 0.0
+    compact = config.params["output"]["missing_pairs_format"] == "compact"
+    missing_pairs_schema = (
+        MISSING_PAIRS_COMPACT_SCHEMA if compact else MISSING_PAIRS_SCHEMA
+    )
+    with config.paths.open_parquet_writer(
+        "missing_pairs", missing_pairs_schema, location
+    ) as missing_pairs_writer:
+
+        def times_batches():
+            nonlocal n_pairs, n_missing_pairs, write_time_sec
+            for stripe_df, missing_pairs in tt_calc.iter_many_to_many():
+                write_start_time = time.time()
+                if missing_pairs.n_pairs:
+                    with stage("write"):
+                        missing_pairs_writer.write_batch(
+                            pa.RecordBatch.from_pandas(
+                                missing_pairs.to_df(compact=compact),
+                                schema=missing_pairs_schema,
+                                preserve_index=False,
+                            )
+                        )
+                n_missing_pairs += missing_pairs.n_pairs
+                n_pairs += len(stripe_df)
+                # The writer consumes each batch before asking for the next
+                yield pa.RecordBatch.from_pandas(
+                    stripe_df, schema=TIMES_SCHEMA, preserve_index=False
+                )
+                write_time_sec += time.time() - write_start_time
+
+        config.paths.write_to_parquet(
+            times_batches(), "times", location, schema=TIMES_SCHEMA
+        )
+
+    return n_pairs, n_missing_pairs, write_time_sec
+
+
+def run_job(
+    config: TravelTimeConfig,
+    inputs: TravelTimeInputs,
+    start_time: float | None = None,
+) -> None:
+    """
+    Route all pairs of a single job (one chunk of a geography and centroid
+    type) and write its times, missing pairs, points, and metadata.
+
+    Args:
+        config: Configuration of the job.
+        inputs: Origins and destinations of the job, already snapped.
+        start_time: When the job started, including loading its inputs.
+            Defaults to now.
+    """
+    script_start_time = start_time if start_time is not None else time.time()
 
     chunk_msg = f", chunk: {config.args.chunk}" if config.args.chunk else ""
     logger.info(
@@ -56,42 +139,132 @@ def main() -> None:
     )
 
     # Calculate times from all origins to all destinations and return a single
-    # DataFrame. Assumes an OSRM service is running locally at localhost:5333
+    # DataFrame. Assumes an OSRM service is running locally at localhost:5333,
+    # unless the in-process graph backend is used
     logger.info("Network loaded and coodinates ready, starting routing")
-    tt_calc = TravelTimeCalculator(config, inputs)
-    results_df = tt_calc.many_to_many()
+    routing_start_time = time.time()
+    if config.args.engine == "async":
+        tt_calc: TravelTimeCalculator = AsyncTravelTimeCalculator(
+            config, inputs, concurrency=config.args.concurrency
+        )
+    elif config.args.engine == "process":
+        tt_calc = ProcessTravelTimeCalculator(
+            config, inputs, n_workers=config.args.concurrency
+        )
+    else:
+        tt_calc = TravelTimeCalculator(config, inputs)
+    out_locations = ["s3"] if config.args.write_to_s3 else ["local"]
+    if config.args.stream:
+        # Times and missing pairs are written while routing, so there is only
+        # ever a single output location
+        with stage("route"):
+            n_pairs, n_missing_pairs, write_time_sec = stream_results(
+                config, tt_calc, out_locations[0]
+            )
+        routing_elapsed_time = (
+            time.time() - routing_start_time - write_time_sec
+        )
+        logger.info(
+            "Calculated and streamed times between %s pairs (%s missing) "
+            "to: %s in %s",
+            n_pairs,
+            n_missing_pairs,
+            out_locations[0],
+            format_time(time.time() - script_start_time),
+        )
+    else:
+        with stage("route"):
+            results_df, missing_pairs = tt_calc.many_to_many()
+        routing_elapsed_time = time.time() - routing_start_time
+        n_pairs = len(results_df)
+        n_missing_pairs = missing_pairs.n_pairs
+        logger.info(
+            "Finished calculating times for %s pairs in %s",
+            n_pairs + n_missing_pairs,
+            format_time(time.time() - script_start_time),
+        )
+
+        # Missing pairs are only expanded into rows of IDs now. They're
+        # already sorted by ID like the times, for efficient compression
+        with stage("expand"):
+            missing_pairs_df = missing_pairs.to_df(
+                compact=config.params["output"]["missing_pairs_format"]
+                == "compact"
+            )
+        del missing_pairs
+
+        # Loop through files and write to both local and remote paths
+        logger.info(
+            "Calculated times between %s pairs (%s missing). "
+            "Saving outputs to: %s",
+            n_pairs,
+            n_missing_pairs,
+            ", ".join(out_locations),
+        )
+        write_start_time = time.time()
+        with stage("write"):
+            for loc in out_locations:
+                config.paths.write_to_parquet(results_df, "times", loc)
+                config.paths.write_to_parquet(
+                    missing_pairs_df, "missing_pairs", loc
+                )
+        write_time_sec = time.time() - write_start_time
+        del results_df, missing_pairs_df
+
     logger.info(
-        "Finished calculating times for %s pairs in %s",
-        len(results_df),
-        format_time(time.time() - script_start_time),
+        "Routed %.0f pairs/sec using the %s engine",
+        (n_pairs + n_missing_pairs) / max(routing_elapsed_time, 1e-9),
+        config.args.engine,
     )
-
-    # Extract any missing pairs to a separate DataFrame and sort all outputs
-    # for efficient compression
-    missing_pairs_df = results_df[results_df["duration_sec"].isnull()]
-    missing_pairs_df = (
-        missing_pairs_df.drop(columns=["duration_sec"])
-        .sort_index()
-        .reset_index()
+    request_counts = tt_calc.stats.counts
+    n_skipped_pairs = request_counts["n_skipped_pairs"]
+    if tt_calc.max_distance_m is not None:
+        logger.info(
+            "Skipped %s pairs (%.1f%%) further apart than %s m",
+            n_skipped_pairs,
+            100
+            * n_skipped_pairs
+            / max(inputs.n_origins * inputs.n_destinations, 1),
+            tt_calc.max_distance_m,
+        )
+    n_over_max_duration_pairs = request_counts["n_over_max_duration_pairs"]
+    if tt_calc.max_duration_sec is not None:
+        logger.info(
+            "Dropped %s routed pairs longer than %s seconds",
+            n_over_max_duration_pairs,
+            tt_calc.max_duration_sec,
+        )
+    if tt_calc.block_size is not None:
+        logger.info(
+            "Final block shape: %s origins x %s destinations",
+            *tt_calc.block_size.shape,
+        )
+    logger.info(
+        "Sent %s to OSRM in %s table requests (%.2f bytes/pair)",
+        format_size(request_counts["bytes_sent"]),
+        request_counts["n_requests"],
+        request_counts["bytes_sent"] / max(request_counts["n_pairs_sent"], 1),
     )
-    results_df = (
-        results_df.dropna(subset=["duration_sec"]).sort_index().reset_index()
+    logger.info(
+        "Sent %s requests to isolate failed blocks using %s",
+        request_counts["n_fault_isolation_requests"],
+        params["times"]["fault_isolation"],
     )
-
-    # Loop through files and write to both local and remote paths
-    out_locations = ["s3"] if args.write_to_s3 else ["local"]
     logger.info(
-        "Calculated times between %s pairs (%s missing). "
-        "Saving outputs to: %s",
-        len(results_df),
-        len(missing_pairs_df),
-        ", ".join(out_locations),
+        "Block search tasks per depth: %s",
+        ", ".join(
+            f"{depth}: {n}"
+            for depth, n in sorted(tt_calc.stats.tasks_per_depth.items())
+        ),
     )
-    for loc in out_locations:
-        config.paths.write_to_parquet(results_df, "times", loc)
-        config.paths.write_to_parquet(inputs.origins, "origins", loc)
-        config.paths.write_to_parquet(inputs.destinations, "destinations", loc)
-        config.paths.write_to_parquet(missing_pairs_df, "missing_pairs", loc)
+    write_start_time = time.time()
+    with stage("write"):
+        for loc in out_locations:
+            config.paths.write_to_parquet(inputs.origins, "origins", loc)
+            config.paths.write_to_parquet(
+                inputs.destinations, "destinations", loc
+            )
+    write_time_sec += time.time() - write_start_time
 
     # Collect metadata and git information for the metadata table
     run_id = str(uuid.uuid4().hex[:8])
@@ -102,6 +275,12 @@ def main() -> None:
         for f in config.paths.input["files"].keys()
     }
 
+    # Request latency percentiles and the number of block search tasks at
+    # each depth, to find where the routing time went
+    latency_p50, latency_p90, latency_p99, latency_max = (
+        tt_calc.stats.latency_percentiles_ms([50, 90, 99, 100])
+    )
+
     # Create a metadata DataFrame of all settings and data used for creating
     # inputs and generating times
     metadata_df = pd.DataFrame(
@@ -109,13 +288,31 @@ def main() -> None:
             "run_id": run_id,
             "calc_datetime_finished": pd.Timestamp.now(tz="UTC"),
             "calc_time_elapsed_sec": time.time() - script_start_time,
-            "calc_chunk_id": args.chunk,
+            "calc_chunk_id": config.args.chunk,
             "calc_chunk_n_origins": inputs.n_origins,
             "calc_chunk_n_destinations": inputs.n_destinations,
             "calc_n_origins": inputs.n_origins_full,
             "calc_n_destinations": inputs.n_destinations_full,
-            "calc_n_pairs": len(results_df),
-            "calc_n_missing_pairs": len(missing_pairs_df),
+            "calc_n_pairs": n_pairs,
+            "calc_n_missing_pairs": n_missing_pairs,
+            "calc_n_fault_isolation_requests": request_counts[
+                "n_fault_isolation_requests"
+            ],
+            "calc_n_skipped_pairs": n_skipped_pairs,
+            "calc_skipped_pairs_share": n_skipped_pairs
+            / max(inputs.n_origins * inputs.n_destinations, 1),
+            "calc_n_over_max_duration_pairs": n_over_max_duration_pairs,
+            "calc_snap_time_sec": inputs.snap_time_sec,
+            "calc_routing_time_sec": routing_elapsed_time,
+            "calc_write_time_sec": write_time_sec,
+            "calc_n_requests": request_counts["n_requests"],
+            "calc_request_latency_p50_ms": latency_p50,
+            "calc_request_latency_p90_ms": latency_p90,
+            "calc_request_latency_p99_ms": latency_p99,
+            "calc_request_latency_max_ms": latency_max,
+            "calc_bytes_sent": request_counts["bytes_sent"],
+            "calc_bytes_received": request_counts["bytes_received"],
+            "calc_tasks_per_depth": [tt_calc.stats.depth_histogram()],
             "git_commit_sha_short": git_commit_sha_short,
             "git_commit_sha_long": git_commit_sha,
             "param_network_buffer_m": params["input"]["network_buffer_m"],
@@ -124,6 +321,9 @@ def main() -> None:
             ],
             "param_max_split_size": params["times"]["max_split_size"],
             "param_use_snapped": params["times"]["use_snapped"],
+            "param_fault_isolation": params["times"]["fault_isolation"],
+            "param_max_distance_m": tt_calc.max_distance_m,
+            "param_max_duration_sec": tt_calc.max_duration_sec,
             "file_input_origins_md5": input_file_hashes["origins_file"],
             "file_input_destinations_md5": input_file_hashes[
                 "destinations_file"
@@ -131,8 +331,13 @@ def main() -> None:
         },
         index=[0],
     )
-    for loc in out_locations:
-        config.paths.write_to_parquet(metadata_df, "metadata", loc)
+    with stage("write"):
+        for loc in out_locations:
+            config.paths.write_to_parquet(metadata_df, "metadata", loc)
+
+    # Every output is written, so the chunk never needs to resume
+    if tt_calc.checkpoint is not None:
+        tt_calc.checkpoint.remove()
 
     logger.info(
         "Finished routing for version: %s, mode: %s, year: %s, "
@@ -146,6 +351,63 @@ def main() -> None:
         chunk_msg,
         format_time(time.time() - script_start_time),
     )
+    logger.info(
+        "Peak memory usage: %s",
+        format_size(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024),
+    )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--mode", required=True, type=str)
+    parser.add_argument("--year", required=True, type=str)
+    parser.add_argument("--geography", required=True, type=str)
+    parser.add_argument("--state", required=True, type=str)
+    parser.add_argument("--centroid-type", required=True, type=str)
+    parser.add_argument("--chunk", required=False, type=str)
+    parser.add_argument("--write-to-s3", action="store_true", default=False)
+    parser.add_argument(
+        "--engine",
+        required=False,
+        type=str,
+        default="thread",
+        choices=["thread", "async", "process"],
+    )
+    parser.add_argument(
+        "--backend",
+        required=False,
+        type=str,
+        default="osrm",
+        choices=["osrm", "graph"],
+    )
+    parser.add_argument("--concurrency", required=False, type=int)
+    parser.add_argument("--stream", action="store_true", default=False)
+    parser.add_argument(
+        "--checkpoint",
+        action="store_true",
+        default=False,
+        help="Checkpoint finished blocks, overriding params.yaml",
+    )
+    parser.add_argument("--profile", action="store_true", default=False)
+    args = parser.parse_args()
+    if args.checkpoint:
+        params["times"]["checkpoint"]["enabled"] = True
+    script_start_time = time.time()
+
+    profile_name = "-".join(
+        ["calculate_times", args.mode, args.year, args.geography]
+        + [args.state, args.centroid_type]
+        + ([args.chunk] if args.chunk else [])
+    )
+    with profile(profile_name, args.profile):
+        # Create a travel times configuration and set of origin/destination
+        # inputs
+        with stage("load"):
+            config = TravelTimeConfig(args, params=params, logger=logger)
+            inputs = config.load_default_inputs(snap=False)
+        with stage("snap"):
+            config.snap_inputs(inputs)
+        run_job(config, inputs, start_time=script_start_time)
 
 
 if __name__ == "__main__":
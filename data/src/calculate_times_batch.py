@@ -0,0 +1,180 @@
+import argparse
+import os
+import time
+from pathlib import Path
+
+from calculate_times import logger, params, run_job
+from utils.profiling import profile, stage
+from utils.times import TravelTimeConfig
+from utils.utils import format_time
+
+
+def parse_job(job: str) -> tuple[str, str, str | None]:
+    """
+    Parse a job given as "geography:centroid_type" or
+    "geography:centroid_type:chunk".
+
+    Returns:
+        A tuple of the geography, centroid type, and chunk (None if the job
+        covers the whole geography).
+    """
+    parts = job.split(":")
+    if len(parts) not in [2, 3] or not all(parts[:2]):
+        raise ValueError(
+            f"Invalid job '{job}'. Must be geography:centroid_type[:chunk]"
+        )
+    chunk = parts[2] if len(parts) == 3 and parts[2] else None
+    return parts[0], parts[1], chunk
+
+
+def write_failed_jobs(path: str | None, jobs: list[str]) -> None:
+    """
+    Write jobs that failed or haven't finished yet, one per line, so that a
+    killed batch can be resumed from the file. Written to a temporary file
+    first so the list is never cut off.
+    """
+    if not path:
+        return
+    tmp_path = f"{path}.tmp"
+    Path(tmp_path).write_text("".join(f"{job}\n" for job in jobs))
+    os.replace(tmp_path, path)
+
+
+def main() -> None:
+    """
+    Run many calculate_times.py jobs for a single mode, year, and state in
+    one process. Imports, parameters, and the routing client are set up
+    once. The input points of each geography and centroid type are loaded
+    once and shared by all of their chunks, and every point is snapped to
+    the OSM network only once.
+
+    Failed jobs are logged and skipped. They can be written to a file, one
+    job per line, to be retried.
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--mode", required=True, type=str)
+    parser.add_argument("--year", required=True, type=str)
+    parser.add_argument("--state", required=True, type=str)
+    parser.add_argument(
+        "--jobs",
+        required=True,
+        type=str,
+        nargs="+",
+        help="Jobs to run, each as geography:centroid_type[:chunk]",
+    )
+    parser.add_argument("--write-to-s3", action="store_true", default=False)
+    parser.add_argument(
+        "--engine",
+        required=False,
+        type=str,
+        default="thread",
+        choices=["thread", "async", "process"],
+    )
+    parser.add_argument(
+        "--backend",
+        required=False,
+        type=str,
+        default="osrm",
+        choices=["osrm", "graph"],
+    )
+    parser.add_argument("--concurrency", required=False, type=int)
+    parser.add_argument("--stream", action="store_true", default=False)
+    parser.add_argument(
+        "--checkpoint",
+        action="store_true",
+        default=False,
+        help="Checkpoint finished blocks, overriding params.yaml",
+    )
+    parser.add_argument("--failed-jobs-file", required=False, type=str)
+    parser.add_argument("--profile", action="store_true", default=False)
+    args = parser.parse_args()
+    if args.checkpoint:
+        params["times"]["checkpoint"]["enabled"] = True
+    batch_start_time = time.time()
+    jobs = [parse_job(job) for job in args.jobs]
+
+    # A synthetic grid network is built around the points of a geography,
+    # so it can't be shared between geographies
+    share_client = not (
+        args.backend == "graph"
+        and params["times"]["graph_backend"]["network"] == "grid"
+    )
+    client = None
+    od_points: dict[tuple[str, str], tuple] = {}
+    snap_cache: dict[str, list[float]] = {}
+    timings: list[tuple[str, float, float]] = []
+    failed_jobs: list[str] = []
+    profile_name = "-".join(
+        ["calculate_times_batch", args.mode, args.year, args.state]
+    )
+    # Every job counts as failed until it finishes, in case the batch is
+    # killed before it can write the list at the end
+    write_failed_jobs(args.failed_jobs_file, args.jobs)
+    with profile(profile_name, args.profile):
+        for i, (job, (geography, centroid_type, chunk)) in enumerate(
+            zip(args.jobs, jobs), start=1
+        ):
+            logger.info("Starting job %s of %s: %s", i, len(jobs), job)
+            job_start_time = time.time()
+            try:
+                job_args = argparse.Namespace(
+                    **{
+                        **vars(args),
+                        "geography": geography,
+                        "centroid_type": centroid_type,
+                        "chunk": chunk,
+                    }
+                )
+                with stage("load"):
+                    config = TravelTimeConfig(
+                        job_args, params=params, logger=logger, client=client
+                    )
+                    if share_client:
+                        client = config.client
+
+                    # Points are loaded once for each geography and centroid
+                    # type. Drop the others, since jobs are usually grouped by
+                    # geography
+                    key = (geography, centroid_type)
+                    if key not in od_points:
+                        od_points.clear()
+                        od_points[key] = config.load_od_files()
+                    inputs = config.load_default_inputs(
+                        od_points=od_points[key], snap=False
+                    )
+                with stage("snap"):
+                    config.snap_inputs(inputs, snap_cache)
+                load_time = time.time() - job_start_time
+
+                run_job(config, inputs, start_time=job_start_time)
+                del config, inputs
+            except Exception:
+                logger.exception("Job %s failed", job)
+                failed_jobs.append(job)
+            else:
+                timings.append((job, load_time, time.time() - job_start_time))
+            write_failed_jobs(
+                args.failed_jobs_file, failed_jobs + args.jobs[i:]
+            )
+
+    for job, load_time, total_time in timings:
+        logger.info(
+            "Job %s: loaded inputs in %.2fs, finished in %s",
+            job,
+            load_time,
+            format_time(total_time),
+        )
+    logger.info(
+        "Finished %s of %s jobs in %s",
+        len(timings),
+        len(jobs),
+        format_time(time.time() - batch_start_time),
+    )
+
+    if failed_jobs:
+        logger.error("Failed jobs: %s", " ".join(failed_jobs))
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -11,6 +11,8 @@ from utils.census import (
     transform_5071_to_4326,
 )
 from utils.logging import create_logger
+from utils.profiling import profile, stage
+from utils.utils import write_sorted_parquet
 
 logger = create_logger(__name__)
 
@@ -66,7 +68,8 @@ def create_cenloc(year: str, geography: str, state: str | None = None) -> None:
     output_dir.mkdir(parents=True, exist_ok=True)
 
     # Load the target TIGER shapefile and drop unneeded columns
-    tiger_gdf = load_shapefile(tiger_file)
+    with stage("load"):
+        tiger_gdf = load_shapefile(tiger_file)
     original_row_count = len(tiger_gdf)
     tiger_cols_to_keep = ["geoid", "intptlon", "intptlat", "geometry"]
     tiger_gdf = tiger_gdf.drop(
@@ -79,7 +82,8 @@ def create_cenloc(year: str, geography: str, state: str | None = None) -> None:
 
     # Load the block locations and pop. data associated with the target year.
     # Convert the block location point columns to geometry
-    blockloc = pd.read_parquet(blockloc_dir)
+    with stage("load"):
+        blockloc = pd.read_parquet(blockloc_dir)
     blockloc = points_to_gdf(blockloc, "x_5071", "y_5071", "EPSG:5071")
     blockloc = blockloc[["x_5071", "y_5071", "geometry", "population"]]
     logger.info(f"Loaded {len(blockloc)} block locations")
@@ -88,15 +92,17 @@ def create_cenloc(year: str, geography: str, state: str | None = None) -> None:
     # a spatial join here since GEOIDs (for an attribute join) can change over
     # time e.g. all Connecticut counties changed GEOID in 2022, so their 2020
     # county GEOID substrings don't match their 2022 county GEOIDs
-    gdf = tiger_gdf.sjoin(blockloc, how="inner", predicate="contains")
+    with stage("join"):
+        gdf = tiger_gdf.sjoin(blockloc, how="inner", predicate="contains")
     gdf.drop(columns=["index_right", "geometry"], inplace=True)
 
-    block_centroids = calculate_weighted_mean(
-        df=gdf,
-        group_cols="geoid",
-        weight_col="population",
-        value_cols=["x_5071", "y_5071"],
-    )
+    with stage("weighted_mean"):
+        block_centroids = calculate_weighted_mean(
+            df=gdf,
+            group_cols="geoid",
+            weight_col="population",
+            value_cols=["x_5071", "y_5071"],
+        )
     logger.info(f"Calculated {len(block_centroids)} {geography} centroids")
 
     block_centroids = transform_5071_to_4326(block_centroids)
@@ -150,16 +156,12 @@ def create_cenloc(year: str, geography: str, state: str | None = None) -> None:
             state_output_dir = output_dir / f"state={state}"
             state_output_dir.mkdir(parents=True, exist_ok=True)
             state_output_file = state_output_dir / f"{state}.parquet"
-            state_gdf = state_gdf.sort_values(by=["geoid"])
-            state_gdf.to_parquet(
-                state_output_file,
-                engine="pyarrow",
-                index=False,
-            )
+            with stage("write"):
+                write_sorted_parquet(state_gdf, state_output_file, "geoid")
             logger.info(f"Wrote file to: {state_output_file}")
     else:
-        gdf = gdf.sort_values(by=["geoid"])
-        gdf.to_parquet(output_file, engine="pyarrow", index=False)
+        with stage("write"):
+            write_sorted_parquet(gdf, output_file, "geoid")
         logger.info(f"Wrote file to: {output_file}")
 
 
@@ -176,8 +178,14 @@ def main() -> None:
     parser.add_argument("--year", required=True, type=str)
     parser.add_argument("--geography", required=True, type=str)
     parser.add_argument("--state", required=False, type=str)
+    parser.add_argument("--profile", action="store_true", default=False)
     args = parser.parse_args()
-    create_cenloc(args.year, args.geography, args.state)
+    profile_name = "-".join(
+        ["create_cenloc", args.year, args.geography]
+        + ([args.state] if args.state else [])
+    )
+    with profile(profile_name, args.profile):
+        create_cenloc(args.year, args.geography, args.state)
 
 
 if __name__ == "__main__":
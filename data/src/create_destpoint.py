@@ -4,6 +4,8 @@ from pathlib import Path
 import pandas as pd
 from utils.census import load_shapefile, points_to_gdf
 from utils.logging import create_logger
+from utils.profiling import profile, stage
+from utils.utils import write_sorted_parquet
 
 logger = create_logger(__name__)
 
@@ -49,7 +51,8 @@ def create_destpoint(
     output_dir.mkdir(parents=True, exist_ok=True)
 
     # Load the buffered state boundary
-    boundary = load_shapefile(tiger_file)
+    with stage("load"):
+        boundary = load_shapefile(tiger_file)
     boundary = boundary[boundary["geoid"] == state]
     boundary = boundary[["geometry"]]
     boundary.to_crs(crs="EPSG:5071", inplace=True)
@@ -60,15 +63,20 @@ def create_destpoint(
 
     # Load the Census geography centroids (weighted and unweighted), and keep
     # only centroids of either kind that are within the buffered state
-    cenloc = pd.read_parquet(cenloc_dir)
+    with stage("load"):
+        cenloc = pd.read_parquet(cenloc_dir)
     cenloc_gdf = points_to_gdf(cenloc, "x_5071", "y_5071", "EPSG:5071")
-    cenloc_gdf = cenloc_gdf.sjoin(boundary, how="inner", predicate="within")
+    with stage("join"):
+        cenloc_gdf = cenloc_gdf.sjoin(
+            boundary, how="inner", predicate="within"
+        )
     cenloc_gdf_wt = points_to_gdf(
         cenloc, "x_5071_wt", "y_5071_wt", "EPSG:5071"
     )
-    cenloc_gdf_wt = cenloc_gdf_wt.sjoin(
-        boundary, how="inner", predicate="within"
-    )
+    with stage("join"):
+        cenloc_gdf_wt = cenloc_gdf_wt.sjoin(
+            boundary, how="inner", predicate="within"
+        )
     cenloc_final = cenloc[
         cenloc["geoid"].isin(cenloc_gdf["geoid"])
         | cenloc["geoid"].isin(cenloc_gdf_wt["geoid"])
@@ -78,8 +86,8 @@ def create_destpoint(
     cenloc_final = cenloc_final[
         [c for c in cenloc.columns if c not in ["geometry", "state"]]
     ]
-    cenloc_final = cenloc_final.sort_values(by=["geoid"])
-    cenloc_final.to_parquet(output_file, engine="pyarrow", index=False)
+    with stage("write"):
+        write_sorted_parquet(cenloc_final, output_file, "geoid")
     logger.info(f"Wrote to: {output_file}")
 
 
@@ -89,8 +97,13 @@ def main():
     parser.add_argument("--geography", required=True, type=str)
     parser.add_argument("--state", required=True, type=str)
     parser.add_argument("--buffer", required=False, type=int)
+    parser.add_argument("--profile", action="store_true", default=False)
     args = parser.parse_args()
-    create_destpoint(args.year, args.geography, args.state, args.buffer)
+    profile_name = "-".join(
+        ["create_destpoint", args.year, args.geography, args.state]
+    )
+    with profile(profile_name, args.profile):
+        create_destpoint(args.year, args.geography, args.state, args.buffer)
 
 
 if __name__ == "__main__":
@@ -5,6 +5,7 @@ import yaml
 from utils.constants import DATASET_DICT
 from utils.duckdb import create_duckdb_connection
 from utils.logging import create_logger
+from utils.profiling import profile, stage
 
 logger = create_logger(__name__)
 
@@ -77,7 +78,8 @@ def create_public_files(
                 'r2://{params["s3"]["data_bucket"]}/{dataset}{partitions}/*.parquet',
                 hive_partitioning = true,
                 hive_types_autocast = false,
-                filename = true
+                filename = true,
+                union_by_name = true
             )
             WHERE version = '{version}'
                 AND mode = '{mode}'
@@ -109,16 +111,25 @@ def main() -> None:
     parser.add_argument("--year", required=True, type=str)
     parser.add_argument("--geography", required=True, type=str)
     parser.add_argument("--state", required=True, type=str)
+    parser.add_argument("--profile", action="store_true", default=False)
     args = parser.parse_args()
-    create_public_files(
-        args.dataset,
-        args.version,
-        args.mode,
-        args.year,
-        args.geography,
-        args.state,
+    profile_name = "-".join(
+        ["create_public_files", args.dataset, args.version, args.mode]
+        + [args.year, args.geography, args.state]
     )
 
+    # The whole job is a single DuckDB copy from the data bucket to the
+    # public bucket, so it's profiled as one stage
+    with profile(profile_name, args.profile), stage("copy"):
+        create_public_files(
+            args.dataset,
+            args.version,
+            args.mode,
+            args.year,
+            args.geography,
+            args.state,
+        )
+
 
 if __name__ == "__main__":
     main()
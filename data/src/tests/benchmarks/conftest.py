@@ -0,0 +1,85 @@
+# Benchmarks of the pipeline's pure-Python hot spots on synthetic data shaped
+# like Census inputs. Run from the repository root. Results are stored as JSON
+# in tests/benchmarks/baselines (set in tests/conftest.py), one folder per
+# machine:
+#
+#   Save a baseline:  uv run pytest --benchmark-save=baseline
+#   Compare to it:    uv run pytest --benchmark-compare \
+#                       --benchmark-compare-fail=mean:20%
+#   Larger inputs:    uv run pytest --n-rows=10000,1000000,10000000
+#
+# Saved runs can also be compared without rerunning with
+# `uv run pytest-benchmark --storage data/src/tests/benchmarks/baselines
+# compare`
+import numpy as np
+import pandas as pd
+import pytest
+
+
+def pytest_addoption(parser: pytest.Parser) -> None:
+    parser.addoption(
+        "--n-rows",
+        type=str,
+        default="10000",
+        help="Comma-separated numbers of rows to benchmark each function on",
+    )
+
+
+def pytest_generate_tests(metafunc: pytest.Metafunc) -> None:
+    if "n_rows" in metafunc.fixturenames:
+        n_rows = [
+            int(n) for n in metafunc.config.getoption("n_rows").split(",")
+        ]
+        metafunc.parametrize("n_rows", n_rows, scope="session")
+
+
+def make_block_geoids(n: int, seed: int = 0) -> pd.Series:
+    """
+    Create sorted 15-digit Census block GEOIDs in Illinois, with roughly 40
+    blocks per block group and 3 block groups per tract, like real blocks.
+    """
+    rng = np.random.default_rng(seed)
+    block_idx = np.sort(rng.choice(max(n * 2, 100), size=n, replace=False))
+    bg_idx = block_idx // 40
+    tract_idx = bg_idx // 3
+    county = 2 * (tract_idx // 30 % 102) + 1
+    tract = tract_idx % 999999
+    parts = [
+        pd.Series(np.full(n, "17")),
+        pd.Series(county).astype(str).str.zfill(3),
+        pd.Series(tract).astype(str).str.zfill(6),
+        pd.Series(bg_idx % 3 + 1).astype(str),
+        pd.Series(block_idx % 40).astype(str).str.zfill(3),
+    ]
+    return parts[0].str.cat(parts[1:])
+
+
+def make_blocks(n: int, seed: int = 0) -> pd.DataFrame:
+    """
+    Create a DataFrame shaped like Census blocks: GEOIDs, the TIGER internal
+    point as signed strings, the same point in EPSG:5071, and population
+    (zero for about a third of blocks).
+    """
+    rng = np.random.default_rng(seed)
+    lon = rng.uniform(-91.5, -87.5, n)
+    lat = rng.uniform(37.0, 42.5, n)
+    x_5071 = rng.uniform(380000, 720000, n)
+    y_5071 = rng.uniform(1550000, 2200000, n)
+    population = rng.poisson(40, n) * (rng.random(n) > 0.33)
+    geoid = make_block_geoids(n, seed)
+    return pd.DataFrame(
+        {
+            "geoid": geoid,
+            "tract": geoid.str.slice(0, 11),
+            "intptlon": pd.Series(lon).map("{:+012.7f}".format),
+            "intptlat": pd.Series(lat).map("{:+011.7f}".format),
+            "x_5071": x_5071,
+            "y_5071": y_5071,
+            "population": population,
+        }
+    )
+
+
+@pytest.fixture(scope="session")
+def blocks(n_rows: int) -> pd.DataFrame:
+    return make_blocks(n_rows)
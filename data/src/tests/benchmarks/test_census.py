@@ -0,0 +1,53 @@
+import pandas as pd
+from utils.census import (
+    calculate_weighted_mean,
+    extract_centroids,
+    split_geoid,
+    transform_5071_to_4326,
+)
+
+# Number of rounds timed for each benchmark. Inputs are copied outside the
+# timer before each round, since these functions modify them
+N_ROUNDS = 3
+
+
+def test_calculate_weighted_mean(benchmark, blocks: pd.DataFrame) -> None:
+    df = benchmark.pedantic(
+        calculate_weighted_mean,
+        setup=lambda: (
+            (blocks.copy(), "tract", "population"),
+            {"value_cols": ["x_5071", "y_5071"]},
+        ),
+        rounds=N_ROUNDS,
+    )
+    assert len(df) == blocks["tract"].nunique()
+
+
+def test_split_geoid(benchmark, blocks: pd.DataFrame) -> None:
+    df = benchmark.pedantic(
+        split_geoid,
+        setup=lambda: ((blocks[["geoid"]].copy(), "geoid"), {}),
+        rounds=N_ROUNDS,
+    )
+    assert (df["state"] == "17").all()
+
+
+def test_extract_centroids(benchmark, blocks: pd.DataFrame) -> None:
+    df = benchmark.pedantic(
+        extract_centroids,
+        setup=lambda: (
+            (blocks[["geoid", "intptlon", "intptlat"]].copy(),),
+            {},
+        ),
+        rounds=N_ROUNDS,
+    )
+    assert df[["x_5071", "y_5071"]].notnull().all().all()
+
+
+def test_transform_5071_to_4326(benchmark, blocks: pd.DataFrame) -> None:
+    df = benchmark.pedantic(
+        transform_5071_to_4326,
+        setup=lambda: ((blocks[["geoid", "x_5071", "y_5071"]].copy(),), {}),
+        rounds=N_ROUNDS,
+    )
+    assert df["x_4326"].between(-180, 180).all()
@@ -0,0 +1,44 @@
+import math
+from pathlib import Path
+
+import pandas as pd
+from utils.utils import (
+    create_empty_df,
+    read_parquet_rows,
+    split_range,
+    write_sorted_parquet,
+)
+
+
+def test_split_range(benchmark, n_rows: int) -> None:
+    chunks = benchmark(split_range, n_rows, n_chunks=256, min_chunk_size=5)
+    assert chunks[0][0] == 0
+    assert chunks[-1][1] == n_rows
+
+
+def test_create_empty_df(benchmark, blocks: pd.DataFrame, n_rows: int) -> None:
+    # A square block of origins and destinations with n_rows pairs
+    n = math.isqrt(n_rows)
+    df = benchmark(
+        create_empty_df, 0, 0, n, n, blocks["geoid"], blocks["geoid"]
+    )
+    assert len(df) == n * n
+
+
+def test_read_parquet_rows(
+    benchmark, blocks: pd.DataFrame, n_rows: int, tmp_path: Path
+) -> None:
+    # One chunk of a file split into 64 chunks, like a chunked routing job
+    file = tmp_path / "blocks.parquet"
+    write_sorted_parquet(blocks.sample(frac=1, random_state=0), file, "geoid")
+    start_idx, end_idx = split_range(n_rows, n_chunks=64, min_chunk_size=5)[1]
+    df, n = benchmark(
+        read_parquet_rows,
+        file,
+        columns=["geoid", "x_5071", "y_5071"],
+        sort_by="geoid",
+        start_idx=start_idx,
+        end_idx=end_idx,
+    )
+    assert n == n_rows
+    assert df["geoid"].tolist() == blocks["geoid"][start_idx:end_idx].tolist()
@@ -0,0 +1,38 @@
+from pathlib import Path
+
+import pytest
+import yaml
+
+BENCHMARKS_DIR = Path(__file__).parent / "benchmarks"
+PARAMS_FILE = Path(__file__).parents[2] / "params.yaml"
+
+
+@pytest.hookimpl(tryfirst=True)
+def pytest_configure(config: pytest.Config) -> None:
+    # Store benchmark runs next to the benchmarks unless a storage is given.
+    # Set here rather than in addopts so that pytest still runs without the
+    # pytest-benchmark plugin
+    if config.pluginmanager.hasplugin("benchmark"):
+        if config.option.benchmark_storage == "file://./.benchmarks":
+            config.option.benchmark_storage = str(BENCHMARKS_DIR / "baselines")
+
+
+def pytest_ignore_collect(
+    collection_path: Path, config: pytest.Config
+) -> bool | None:
+    if collection_path == BENCHMARKS_DIR:
+        return not config.pluginmanager.hasplugin("benchmark")
+    return None
+
+
+@pytest.fixture
+def params() -> dict:
+    """
+    Parameters from params.yaml, with the checkpoint and adaptive block
+    sizes turned off so that calculations are repeatable.
+    """
+    with open(PARAMS_FILE) as file:
+        params = yaml.safe_load(file)
+    params["times"]["checkpoint"]["enabled"] = False
+    params["times"]["adaptive_block_size"]["enabled"] = False
+    return params
@@ -0,0 +1,56 @@
+import logging
+
+import aiohttp
+import pytest
+import requests as r
+from utils.block_size import BlockSizeController, is_resource_error
+from utils.osrm import OSRMError
+
+logger = logging.getLogger(__name__)
+
+
+@pytest.mark.parametrize(
+    "error,expected",
+    [
+        (OSRMError("TooBig", "Too many table coordinates"), True),
+        (r.exceptions.ReadTimeout(), True),
+        (aiohttp.SocketTimeoutError(), True),
+        (OSRMError("NoSegment", "Could not find a matching segment"), False),
+        (r.exceptions.ConnectTimeout(), False),
+        (r.exceptions.ConnectionError(), False),
+        (aiohttp.ConnectionTimeoutError(), False),
+        (aiohttp.ServerDisconnectedError(), False),
+        (ConnectionRefusedError(), False),
+        (ConnectionResetError(), False),
+    ],
+)
+def test_is_resource_error(error: Exception, expected: bool) -> None:
+    assert is_resource_error(error) == expected
+
+
+def test_block_size_grows_then_settles_and_shrinks() -> None:
+    controller = BlockSizeController(
+        n_origins=100,
+        n_destinations=100,
+        max_n_origins=1000,
+        max_n_destinations=1000,
+        min_split_size=25,
+        max_block_pairs=40_000,
+        target_block_sec=10,
+        n_samples=1,
+        logger=logger,
+    )
+    # Doubling the block size doubles the throughput, until blocks reach
+    # the pair budget
+    controller.record(100, 100, 1.0)
+    assert controller.shape == (200, 100)
+    controller.record(200, 100, 1.0)
+    assert controller.shape == (200, 200)
+    controller.record(200, 200, 1.0)
+    assert controller.settled
+    assert controller.shape == (200, 200)
+
+    controller.record(200, 200, 1.0, failed=True)
+    assert controller.max_block_pairs == 20_000
+    assert controller.shape == (100, 200)
+    assert not controller.settled
@@ -0,0 +1,94 @@
+import logging
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+from utils.checkpoint import BlockCheckpoint
+
+logger = logging.getLogger(__name__)
+
+BLOCKS = [
+    {"o_start_idx": 0, "d_start_idx": 0, "o_end_idx": 2, "d_end_idx": 2},
+    {"o_start_idx": 0, "d_start_idx": 2, "o_end_idx": 2, "d_end_idx": 4},
+]
+
+
+def make_times(o_start_idx: int, d_start_idx: int) -> pd.DataFrame:
+    return pd.DataFrame(
+        {
+            "origin_idx": np.array([o_start_idx] * 2, dtype=np.int32),
+            "destination_idx": np.arange(
+                d_start_idx, d_start_idx + 2, dtype=np.int32
+            ),
+            "duration_sec": np.array([60.0, 90.5], dtype=np.float32),
+        }
+    )
+
+
+def start_run(path: Path) -> BlockCheckpoint:
+    """Record a stripe with two blocks, only the first of them finished."""
+    checkpoint = BlockCheckpoint(path, fingerprint="abc", logger=logger)
+    stripe_idx = checkpoint.add_stripe(
+        0, 2, BLOCKS, unroutable=[(0, 4, 2, 5)], n_skipped_pairs=3
+    )
+    checkpoint.add_block(stripe_idx, 0, make_times(0, 0), [(1, 0, 2, 1)])
+    # Stop here, like a killed run, without removing the checkpoint
+    checkpoint._manifest.close()
+    return checkpoint
+
+
+def test_resume_reads_back_finished_blocks(tmp_path: Path) -> None:
+    path = tmp_path / "checkpoint"
+    start_run(path)
+
+    checkpoint = BlockCheckpoint(path, fingerprint="abc", logger=logger)
+    assert len(checkpoint.stripes) == 1
+    assert checkpoint.stripes[0]["blocks"] == BLOCKS
+    assert checkpoint.stripes[0]["unroutable"] == [[0, 4, 2, 5]]
+    assert checkpoint.stripes[0]["n_skipped_pairs"] == 3
+    assert list(checkpoint.finished) == [(0, 0)]
+
+    times, missing = checkpoint.read_block(0, 0)
+    pd.testing.assert_frame_equal(times, make_times(0, 0))
+    assert missing == [(1, 0, 2, 1)]
+
+    # Blocks finished after resuming are appended to the same manifest
+    checkpoint.add_block(0, 1, None, [(0, 2, 2, 4)])
+    checkpoint._manifest.close()
+    resumed = BlockCheckpoint(path, fingerprint="abc", logger=logger)
+    assert list(resumed.finished) == [(0, 0), (0, 1)]
+    assert resumed.read_block(0, 1) == (None, [(0, 2, 2, 4)])
+
+
+def test_changed_fingerprint_starts_over(tmp_path: Path) -> None:
+    path = tmp_path / "checkpoint"
+    start_run(path)
+
+    checkpoint = BlockCheckpoint(path, fingerprint="def", logger=logger)
+    assert checkpoint.stripes == []
+    assert checkpoint.finished == {}
+    assert list(path.iterdir()) == [checkpoint.manifest_file]
+
+
+def test_cut_off_record_is_dropped(tmp_path: Path) -> None:
+    path = tmp_path / "checkpoint"
+    start_run(path)
+    with open(path / "manifest.jsonl", "a") as file:
+        file.write('{"stripe": 0, "block": 1, "fi')
+
+    checkpoint = BlockCheckpoint(path, fingerprint="abc", logger=logger)
+    assert list(checkpoint.finished) == [(0, 0)]
+    checkpoint.add_block(0, 1, make_times(0, 2), [])
+    checkpoint._manifest.close()
+
+    resumed = BlockCheckpoint(path, fingerprint="abc", logger=logger)
+    times, _ = resumed.read_block(0, 1)
+    pd.testing.assert_frame_equal(times, make_times(0, 2))
+
+
+def test_remove_deletes_checkpoint(tmp_path: Path) -> None:
+    path = tmp_path / "checkpoint"
+    checkpoint = BlockCheckpoint(path, fingerprint="abc", logger=logger)
+    checkpoint.add_block(0, 0, make_times(0, 0), [])
+    checkpoint.remove()
+    assert not path.exists()
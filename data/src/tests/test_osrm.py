@@ -0,0 +1,150 @@
+import struct
+
+import numpy as np
+import pytest
+from utils.mock_osrm import _write_fb_table, encode_flatbuffers_table
+from utils.osrm import (
+    FB_ERROR_FIELDS,
+    FB_RESULT_FIELDS,
+    FB_TABLE_FIELDS,
+    OSRMError,
+    decode_flatbuffers_table,
+    decode_polyline,
+    encode_polyline,
+)
+
+
+def test_encode_polyline_matches_reference() -> None:
+    # Example from Google's description of the algorithm, at 1e5 precision
+    lat = np.array([3850000, 4070000, 4325200])
+    lon = np.array([-12020000, -12095000, -12645300])
+    assert encode_polyline(lat, lon) == "_p~iF~ps|U_ulLnnqC_mqNvxq`@"
+
+
+def test_decode_polyline_matches_reference() -> None:
+    lat, lon = decode_polyline("_p~iF~ps|U_ulLnnqC_mqNvxq`@")
+    assert lat.tolist() == [3850000, 4070000, 4325200]
+    assert lon.tolist() == [-12020000, -12095000, -12645300]
+
+
+def test_polyline_round_trip() -> None:
+    # Coordinates at 1e6 precision, including repeated points (zero deltas)
+    # and deltas that need every 5-bit chunk
+    rng = np.random.default_rng(0)
+    lat = rng.integers(-90_000_000, 90_000_000, 500)
+    lon = rng.integers(-180_000_000, 180_000_000, 500)
+    lat[10:13], lon[10:13] = lat[9], lon[9]
+    lat[0], lon[-1] = 0, -180_000_000
+    decoded_lat, decoded_lon = decode_polyline(encode_polyline(lat, lon))
+    np.testing.assert_array_equal(decoded_lat, lat)
+    np.testing.assert_array_equal(decoded_lon, lon)
+
+
+def test_decode_flatbuffers_table_durations() -> None:
+    durations = np.array(
+        [[0.0, 12.5, 30.1, np.nan], [7.2, 0.0, np.nan, 1e6]],
+        dtype=np.float32,
+    )
+    response_data = decode_flatbuffers_table(
+        encode_flatbuffers_table(durations)
+    )
+    assert response_data["code"] == "Ok"
+    assert response_data["format"] == "flatbuffers"
+    # Pairs without a route come back as 0, like OSRM writes them
+    np.testing.assert_array_equal(
+        response_data["durations"],
+        np.nan_to_num(durations, nan=0).ravel(),
+    )
+
+
+def test_decode_flatbuffers_table_error() -> None:
+    body = encode_flatbuffers_table(
+        code="NoSegment", message="Could not find a matching segment"
+    )
+    with pytest.raises(OSRMError, match="matching segment") as e:
+        decode_flatbuffers_table(body)
+    assert e.value.code == "NoSegment"
+
+
+def test_decode_flatbuffers_table_without_durations() -> None:
+    buf = bytearray(4)
+    struct.pack_into("<I", buf, 0, _write_fb_table(buf, [None] * 6))
+    with pytest.raises(ValueError, match="no durations"):
+        decode_flatbuffers_table(bytes(buf))
+
+
+def build_fb_result(
+    durations: np.ndarray | None = None,
+    code: str = "Ok",
+    message: str = "",
+) -> bytes:
+    """
+    Build a Table API response with the reference FlatBuffers builder,
+    following OSRM's fbresult.fbs schema. Also sets fields that the decoder
+    skips over (data version, distances, table size).
+    """
+    flatbuffers = pytest.importorskip("flatbuffers")
+    builder = flatbuffers.Builder(0)
+    data_version = builder.CreateString("2024-10-01")
+    if durations is None:
+        error_code = builder.CreateString(code)
+        error_message = builder.CreateString(message)
+        builder.StartObject(2)
+        builder.PrependUOffsetTRelativeSlot(
+            FB_ERROR_FIELDS["code"], error_code, 0
+        )
+        builder.PrependUOffsetTRelativeSlot(
+            FB_ERROR_FIELDS["message"], error_message, 0
+        )
+        error = builder.EndObject()
+    else:
+        n_rows, n_cols = durations.shape
+        cells = np.nan_to_num(durations, nan=0).ravel().astype(np.float32)
+        duration_vector = builder.CreateNumpyVector(cells)
+        distance_vector = builder.CreateNumpyVector(cells * 10)
+        builder.StartObject(6)
+        builder.PrependUOffsetTRelativeSlot(
+            FB_TABLE_FIELDS["durations"], duration_vector, 0
+        )
+        builder.PrependUint16Slot(FB_TABLE_FIELDS["rows"], n_rows, 0)
+        builder.PrependUint16Slot(FB_TABLE_FIELDS["cols"], n_cols, 0)
+        builder.PrependUOffsetTRelativeSlot(3, distance_vector, 0)
+        table = builder.EndObject()
+    builder.StartObject(6)
+    builder.PrependUOffsetTRelativeSlot(2, data_version, 0)
+    if durations is None:
+        builder.PrependBoolSlot(FB_RESULT_FIELDS["error"], True, False)
+        builder.PrependUOffsetTRelativeSlot(FB_RESULT_FIELDS["code"], error, 0)
+    else:
+        builder.PrependUOffsetTRelativeSlot(
+            FB_RESULT_FIELDS["table"], table, 0
+        )
+    builder.Finish(builder.EndObject())
+    return bytes(builder.Output())
+
+
+def test_decode_flatbuffers_table_from_reference_builder() -> None:
+    durations = np.array(
+        [[0.0, 12.5, np.nan], [7.2, 0.0, 3600.0], [1e6, 0.5, 42.0]],
+        dtype=np.float32,
+    )
+    body = build_fb_result(durations)
+    response_data = decode_flatbuffers_table(body)
+    np.testing.assert_array_equal(
+        response_data["durations"],
+        np.nan_to_num(durations, nan=0).ravel(),
+    )
+    # The mock service's encoder is read the same way
+    np.testing.assert_array_equal(
+        decode_flatbuffers_table(encode_flatbuffers_table(durations))[
+            "durations"
+        ],
+        response_data["durations"],
+    )
+
+
+def test_decode_flatbuffers_table_error_from_reference_builder() -> None:
+    body = build_fb_result(code="TooBig", message="Too many table coordinates")
+    with pytest.raises(OSRMError, match="Too many") as e:
+        decode_flatbuffers_table(body)
+    assert e.value.code == "TooBig"
@@ -0,0 +1,159 @@
+import logging
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pytest
+import requests as r
+from utils.osrm import OSRMError, TableRequestBuilder, parse_request
+from utils.reachability import ReachabilityProbe
+from utils.times import TravelTimeCalculator
+
+ISLAND_MAX_LON = -100.0
+
+
+class IslandRouter:
+    """
+    In-process stand-in for OSRM on a network with a mainland and an
+    island (west of ISLAND_MAX_LON). Points only reach points on their own
+    island, and sink points can be reached but can't leave. Points are
+    picked out by longitude. Bad points fail with NoSegment, and error is
+    raised by every request.
+    """
+
+    def __init__(
+        self,
+        sink_lons: list[float] | None = None,
+        bad_lons: list[float] | None = None,
+        error: Exception | None = None,
+    ) -> None:
+        self.sink_lons = sink_lons or []
+        self.bad_lons = bad_lons or []
+        self.error = error
+        self.n_requests = 0
+
+    def get(self, path: str) -> dict:
+        self.n_requests += 1
+        if self.error is not None:
+            raise self.error
+        _, lon, lat, sources, destinations = parse_request(path)
+        if np.isin(np.round(lon, 6), self.bad_lons).any():
+            raise OSRMError("NoSegment", "Could not find a matching segment")
+
+        island = lon < ISLAND_MAX_LON
+        sink = np.isin(np.round(lon, 6), self.sink_lons)
+        routable = island[sources][:, None] == island[destinations][None, :]
+        routable &= ~sink[sources][:, None] | (
+            sources[:, None] == destinations[None, :]
+        )
+        durations = np.where(routable, 60.0, None)
+        return {"code": "Ok", "durations": durations.tolist()}
+
+    def nearest(self, mode: str, coord: str) -> list[float]:
+        return [float(c) for c in coord.split(",")]
+
+    def close(self) -> None:
+        pass
+
+
+def make_points() -> pd.DataFrame:
+    rng = np.random.default_rng(0)
+    mainland = pd.DataFrame(
+        {"lon": rng.uniform(-90, -88, 30), "lat": rng.uniform(40, 42, 30)}
+    )
+    island = pd.DataFrame(
+        {"lon": rng.uniform(-106, -105, 4), "lat": rng.uniform(40, 42, 4)}
+    )
+    sinks = pd.DataFrame(
+        {"lon": rng.uniform(-90, -88, 3), "lat": rng.uniform(40, 42, 3)}
+    )
+    return pd.concat([mainland, island, sinks], ignore_index=True).round(6)
+
+
+def make_probe(router: IslandRouter, cache_file: Path) -> ReachabilityProbe:
+    return ReachabilityProbe(
+        client=router,
+        mode="car",
+        n_anchors=3,
+        batch_size=8,
+        logger=logging.getLogger(__name__),
+        cache_file=cache_file,
+    )
+
+
+def route_all(router: IslandRouter, points: pd.DataFrame) -> np.ndarray:
+    """Route every pair of points in one table, as booleans."""
+    builder = TableRequestBuilder("car", points, points)
+    response_data = router.get(builder.build(0, 0, len(points), len(points)))
+    return ~pd.isnull(np.array(response_data["durations"], dtype=object))
+
+
+def test_labels_never_rule_out_routable_pairs(tmp_path: Path) -> None:
+    points = make_points()
+    sink_lons = points["lon"].iloc[-3:].tolist()
+    bad_lons = points["lon"].iloc[[5, 31]].tolist()
+    router = IslandRouter(sink_lons=sink_lons, bad_lons=bad_lons)
+    labels = make_probe(router, tmp_path / "labels.parquet").label(points)
+
+    assert labels["is_bad"].tolist() == points["lon"].isin(bad_lons).tolist()
+
+    good = points.loc[~labels["is_bad"]].reset_index(drop=True)
+    good_labels = labels.loc[~labels["is_bad"]].reset_index(drop=True)
+    routed = route_all(IslandRouter(sink_lons=sink_lons), good)
+    keys = list(
+        zip(
+            good_labels["is_bad"],
+            good_labels["to_mask"],
+            good_labels["from_mask"],
+        )
+    )
+    allowed = np.array(
+        [[TravelTimeCalculator._is_routable(o, d) for d in keys] for o in keys]
+    )
+    assert not (routed & ~allowed).any()
+    # Pairs between the mainland and the island, and pairs leaving a sink,
+    # are ruled out
+    assert (~allowed).sum() > 2 * 4 * 29
+
+
+def test_anchors_must_reach_other_points(tmp_path: Path) -> None:
+    points = make_points()
+    # Put a sink right at the median of the points. It can route to itself,
+    # but not to anything else, so it can't be an anchor
+    median = points.median().round(6)
+    points.loc[len(points)] = [median["lon"], median["lat"]]
+    cache_file = tmp_path / "labels.parquet"
+    make_probe(IslandRouter(sink_lons=[median["lon"]]), cache_file).label(
+        points
+    )
+
+    anchors = pd.read_parquet(cache_file).query("is_anchor")
+    assert len(anchors) == 3
+    assert (anchors["lon"] != median["lon"]).all()
+
+
+def test_cached_labels_are_reused(tmp_path: Path) -> None:
+    points = make_points()
+    cache_file = tmp_path / "labels.parquet"
+    labels = make_probe(IslandRouter(), cache_file).label(points)
+
+    router = IslandRouter()
+    cached_labels = make_probe(router, cache_file).label(points)
+    assert router.n_requests == 0
+    pd.testing.assert_frame_equal(labels, cached_labels)
+
+
+@pytest.mark.parametrize(
+    "error",
+    [
+        r.ConnectionError("Connection refused"),
+        r.Timeout("Read timed out"),
+        OSRMError("TooBig", "Too many table coordinates"),
+    ],
+)
+def test_other_errors_are_raised(tmp_path: Path, error: Exception) -> None:
+    cache_file = tmp_path / "labels.parquet"
+    probe = make_probe(IslandRouter(error=error), cache_file)
+    with pytest.raises(type(error)):
+        probe.label(make_points())
+    assert not cache_file.exists()
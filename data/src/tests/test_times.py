@@ -0,0 +1,520 @@
+import argparse
+import asyncio
+import logging
+import multiprocessing
+import socket
+import time
+from collections.abc import Iterator
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pytest
+from utils.constants import DOCKER_ENDPOINT, EARTH_RADIUS_M
+from utils.mock_osrm import serve, synthetic_durations
+from utils.osrm import OSRMError, RoutingBackend, parse_request
+from utils.times import (
+    AsyncTravelTimeCalculator,
+    MissingBlock,
+    MissingPairs,
+    ProcessTravelTimeCalculator,
+    SearchTask,
+    TravelTimeCalculator,
+    TravelTimeConfig,
+    TravelTimeInputs,
+)
+
+logger = logging.getLogger(__name__)
+
+
+class SyntheticRouter:
+    """
+    In-process stand-in for OSRM with durations from synthetic_durations.
+    Requests that include a failing point, picked out by its longitude,
+    fail with NoSegment like they do in OSRM.
+    """
+
+    def __init__(self, failing_lons: list[float] | None = None) -> None:
+        self.failing_lons = failing_lons or []
+        self.n_requests = 0
+
+    def get(self, path: str) -> dict:
+        self.n_requests += 1
+        _, lon, lat, sources, destinations = parse_request(path)
+        if np.isin(np.round(lon, 6), self.failing_lons).any():
+            raise OSRMError("NoSegment", "Could not find a matching segment")
+        durations = synthetic_durations(
+            lon[sources], lat[sources], lon[destinations], lat[destinations]
+        )
+        return {"code": "Ok", "durations": durations}
+
+    def nearest(self, mode: str, coord: str) -> list[float]:
+        return [float(c) for c in coord.split(",")]
+
+    def close(self) -> None:
+        pass
+
+
+class AsyncSyntheticRouter:
+    """SyntheticRouter with the interface of AsyncOSRMClient."""
+
+    def __init__(self, router: SyntheticRouter) -> None:
+        self.router = router
+
+    async def get(self, path: str) -> dict:
+        return self.router.get(path)
+
+
+def make_points(n: int, seed: int, prefix: str) -> pd.DataFrame:
+    """
+    Create points shaped like snapped inputs, with IDs that aren't in the
+    same order as the rows.
+    """
+    rng = np.random.default_rng(seed)
+    lon = rng.uniform(-91.5, -87.5, n).round(6)
+    lat = rng.uniform(37.0, 42.5, n).round(6)
+    return pd.DataFrame(
+        {
+            "id": [f"{prefix}{i:09d}" for i in rng.permutation(n)],
+            "lon": lon,
+            "lat": lat,
+            "lon_snapped": lon,
+            "lat_snapped": lat,
+            "is_snapped": False,
+        }
+    )
+
+
+def make_calculator(
+    params: dict,
+    n_origins: int,
+    n_destinations: int,
+    client: RoutingBackend | None = None,
+    engine: str = "thread",
+    max_split_size: int = 5000,
+) -> TravelTimeCalculator:
+    args = argparse.Namespace(
+        mode="car",
+        year="2024",
+        geography="tract",
+        state="17",
+        centroid_type="weighted",
+        chunk=None,
+        write_to_s3=False,
+        engine=engine,
+    )
+    config = TravelTimeConfig(args, params=params, logger=logger, ncpu=2)
+    if client is not None:
+        config.client = client
+    inputs = TravelTimeInputs(
+        origins=make_points(n_origins, seed=0, prefix="17"),
+        destinations=make_points(n_destinations, seed=1, prefix="18"),
+        chunk=None,
+        max_split_size_origins=max_split_size,
+        max_split_size_destinations=max_split_size,
+    )
+    if engine == "async":
+        return AsyncTravelTimeCalculator(config, inputs, concurrency=2)
+    if engine == "process":
+        return ProcessTravelTimeCalculator(config, inputs, n_workers=2)
+    return TravelTimeCalculator(config, inputs)
+
+
+def all_pairs(calc: TravelTimeCalculator) -> pd.DataFrame:
+    """Every pair of the calculator's points, with its synthetic duration."""
+    durations = synthetic_durations(
+        calc.origins["lon"],
+        calc.origins["lat"],
+        calc.destinations["lon"],
+        calc.destinations["lat"],
+    )
+    o_idx, d_idx = np.indices(durations.shape).reshape(2, -1)
+    return pd.DataFrame(
+        {
+            "origin_idx": o_idx,
+            "destination_idx": d_idx,
+            "origin_id": calc.origins["id"].to_numpy()[o_idx],
+            "destination_id": calc.destinations["id"].to_numpy()[d_idx],
+            "duration_sec": durations.ravel(),
+        }
+    )
+
+
+def split(
+    calc: TravelTimeCalculator, results: list
+) -> tuple[pd.DataFrame, pd.DataFrame]:
+    """Write results into a result matrix and split it, with string IDs."""
+    matrix, row_codes, origin_rows = calc._result_matrix(0, len(calc.origins))
+    calc._fill_matrix(matrix, origin_rows, 0, results)
+    assert not results
+    times, missing_pairs = calc._split_matrix(matrix, row_codes)
+    times = times.astype({"origin_id": str, "destination_id": str})
+    return times, missing_pairs.to_df()
+
+
+def expected_frame(pairs: pd.DataFrame, columns: list[str]) -> pd.DataFrame:
+    return pairs.sort_values(["origin_id", "destination_id"])[
+        columns
+    ].reset_index(drop=True)
+
+
+@pytest.fixture(autouse=True)
+def in_tmp_path(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    # Calculators create their output directories in the working directory
+    monkeypatch.chdir(tmp_path)
+
+
+def test_missing_pairs_to_df() -> None:
+    missing_pairs = MissingPairs(
+        pd.Index(["a", "b", "c"]), pd.Index(["x", "y", "z"])
+    )
+    missing_pairs.add_pairs(np.array([0, 0]), np.array([0, 2]))
+    missing_pairs.add_pairs(np.array([]), np.array([]))
+    missing_pairs.add_pairs(np.array([2]), np.array([1]))
+    assert missing_pairs.n_pairs == 3
+
+    df = missing_pairs.to_df()
+    assert df["origin_id"].tolist() == ["a", "a", "c"]
+    assert df["destination_id"].tolist() == ["x", "z", "y"]
+
+    compact = missing_pairs.to_df(compact=True)
+    assert compact["origin_id"].tolist() == ["a", "c"]
+    assert [ids.tolist() for ids in compact["destination_ids"]] == [
+        ["x", "z"],
+        ["y"],
+    ]
+
+
+def test_missing_pairs_to_df_empty() -> None:
+    missing_pairs = MissingPairs(pd.Index(["a"]), pd.Index(["x"]))
+    assert missing_pairs.to_df().columns.tolist() == [
+        "origin_id",
+        "destination_id",
+    ]
+    compact = missing_pairs.to_df(compact=True)
+    assert len(compact) == 0
+    assert compact.columns.tolist() == ["origin_id", "destination_ids"]
+
+
+def test_fill_and_split_matrix(params: dict) -> None:
+    calc = make_calculator(params, n_origins=6, n_destinations=5)
+    pairs = all_pairs(calc)
+    # Origins 4 and 5 couldn't be routed, and OSRM returned null for one
+    # pair of origin 1
+    null_pair = (pairs["origin_idx"] == 1) & (pairs["destination_idx"] == 2)
+    routed = pairs[pairs["origin_idx"] < 4].copy()
+    routed.loc[null_pair, "duration_sec"] = np.nan
+    results = [
+        routed[["origin_idx", "destination_idx", "duration_sec"]],
+        MissingBlock(4, 0, 6, 5),
+    ]
+
+    times, missing = split(calc, results)
+    is_missing = null_pair | (pairs["origin_idx"] >= 4)
+    pd.testing.assert_frame_equal(
+        times,
+        expected_frame(
+            pairs[~is_missing], ["origin_id", "destination_id", "duration_sec"]
+        ),
+    )
+    pd.testing.assert_frame_equal(
+        missing,
+        expected_frame(pairs[is_missing], ["origin_id", "destination_id"]),
+    )
+
+
+def test_split_matrix_with_max_distance_and_duration(params: dict) -> None:
+    params["times"]["max_distance_m"]["car"] = 250_000
+    params["times"]["max_duration_sec"]["car"] = 9000
+    calc = make_calculator(params, n_origins=40, n_destinations=30)
+    pairs = all_pairs(calc)
+
+    # Great-circle distance of each pair, with the haversine formula
+    lon1, lat1, lon2, lat2 = (
+        np.radians(calc.origins.loc[pairs["origin_idx"], "lon"].to_numpy()),
+        np.radians(calc.origins.loc[pairs["origin_idx"], "lat"].to_numpy()),
+        np.radians(
+            calc.destinations.loc[pairs["destination_idx"], "lon"].to_numpy()
+        ),
+        np.radians(
+            calc.destinations.loc[pairs["destination_idx"], "lat"].to_numpy()
+        ),
+    )
+    hav = (
+        np.sin((lat2 - lat1) / 2) ** 2
+        + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    )
+    too_far = 2 * EARTH_RADIUS_M * np.arcsin(np.sqrt(hav)) > 250_000
+    too_long = ~too_far & (pairs["duration_sec"] > 9000).to_numpy()
+    failed = (pairs["origin_idx"] < 5).to_numpy()
+    assert too_far[failed].any() and too_far[~failed].any()
+    assert too_long.any()
+
+    results = [
+        pairs.loc[~failed, ["origin_idx", "destination_idx", "duration_sec"]],
+        MissingBlock(0, 0, 5, 30),
+    ]
+    times, missing = split(calc, results)
+
+    is_time = ~too_far & ~too_long & ~failed
+    pd.testing.assert_frame_equal(
+        times,
+        expected_frame(
+            pairs[is_time], ["origin_id", "destination_id", "duration_sec"]
+        ),
+    )
+    # Skipped pairs are only counted, even in the failed block, so the
+    # missing pairs are the failed pairs that aren't too far apart
+    pd.testing.assert_frame_equal(
+        missing,
+        expected_frame(
+            pairs[failed & ~too_far], ["origin_id", "destination_id"]
+        ),
+    )
+    assert calc.stats.counts["n_skipped_pairs"] == too_far.sum()
+    assert (
+        calc.stats.counts["n_over_max_duration_pairs"]
+        == (too_long & ~failed).sum()
+    )
+
+
+def run_search(tasks: list[SearchTask]) -> list:
+    """Run search tasks and the tasks they return until none are left."""
+    results = []
+    while tasks:
+        fn, kwargs = tasks.pop()
+        task_results, new_tasks = fn(**kwargs)
+        results.extend(task_results)
+        tasks.extend(new_tasks)
+    return results
+
+
+@pytest.mark.parametrize("fault_isolation", ["quadrant", "group_test"])
+def test_async_search_matches_thread_search(
+    params: dict, fault_isolation: str
+) -> None:
+    params["times"]["fault_isolation"] = fault_isolation
+    frames, n_requests = [], []
+    for engine in ["thread", "async"]:
+        router = SyntheticRouter()
+        calc = make_calculator(
+            params,
+            n_origins=32,
+            n_destinations=24,
+            client=router,
+            engine=engine,
+        )
+        router.failing_lons = [
+            calc.origins["lon"].iloc[5],
+            calc.destinations["lon"].iloc[7],
+        ]
+        block = {
+            "o_start_idx": 0,
+            "d_start_idx": 0,
+            "o_end_idx": len(calc.origins),
+            "d_end_idx": len(calc.destinations),
+            "print_log": False,
+            "cur_depth": 0,
+        }
+        if engine == "async":
+            assert isinstance(calc, AsyncTravelTimeCalculator)
+            calc.client = AsyncSyntheticRouter(router)  # type: ignore[assignment]
+            results = asyncio.run(
+                calc._search_async((calc._binary_search, block))
+            )
+        else:
+            results = run_search([(calc._binary_search, block)])
+        frames.append(split(calc, results))
+        n_requests.append(router.n_requests)
+
+    # Both engines run the same search steps, so send the same requests
+    (thread_times, thread_missing), (async_times, async_missing) = frames
+    pd.testing.assert_frame_equal(async_times, thread_times)
+    pd.testing.assert_frame_equal(async_missing, thread_missing)
+    assert n_requests[0] == n_requests[1]
+
+
+def test_oversized_requests_are_split(params: dict) -> None:
+    params["times"]["max_url_bytes"] = 400
+    router = SyntheticRouter()
+    paths = []
+    get = router.get
+
+    def record_path(path: str) -> dict:
+        paths.append(path)
+        return get(path)
+
+    router.get = record_path  # type: ignore[method-assign]
+    calc = make_calculator(
+        params, n_origins=40, n_destinations=30, client=router
+    )
+    times = calc._calculate_times(0, 0, 40, 30)
+
+    assert len(paths) > 1
+    assert max(len(path) for path in paths) <= 400
+    pairs = all_pairs(calc)
+    pd.testing.assert_frame_equal(
+        times.sort_values(
+            ["origin_idx", "destination_idx"], ignore_index=True
+        ),
+        pairs[["origin_idx", "destination_idx", "duration_sec"]].astype(
+            {"origin_idx": np.int32, "destination_idx": np.int32}
+        ),
+        check_dtype=False,
+    )
+
+
+def run_group_test(
+    calc: TravelTimeCalculator, router: SyntheticRouter
+) -> list:
+    """Search the calculator's whole block by group testing."""
+    kwargs = {
+        "o_start_idx": 0,
+        "d_start_idx": 0,
+        "o_end_idx": len(calc.origins),
+        "d_end_idx": len(calc.destinations),
+        "cur_depth": 0,
+        "axis": 0,
+    }
+    if isinstance(calc, AsyncTravelTimeCalculator):
+        calc.client = AsyncSyntheticRouter(router)  # type: ignore[assignment]
+        return asyncio.run(calc._search_async((calc._group_test, kwargs)))
+    return run_search([(calc._group_test, kwargs)])
+
+
+@pytest.mark.parametrize("engine", ["thread", "async"])
+@pytest.mark.parametrize(
+    "failing_origins,failing_destinations",
+    [([5], []), ([], [7]), ([3, 20], [11])],
+)
+def test_group_test_isolates_failing_points(
+    params: dict,
+    engine: str,
+    failing_origins: list[int],
+    failing_destinations: list[int],
+) -> None:
+    router = SyntheticRouter()
+    calc = make_calculator(
+        params, n_origins=32, n_destinations=24, client=router, engine=engine
+    )
+    router.failing_lons = [
+        *calc.origins["lon"].iloc[failing_origins],
+        *calc.destinations["lon"].iloc[failing_destinations],
+    ]
+    times, missing = split(calc, run_group_test(calc, router))
+
+    pairs = all_pairs(calc)
+    is_missing = pairs["origin_idx"].isin(failing_origins) | pairs[
+        "destination_idx"
+    ].isin(failing_destinations)
+    pd.testing.assert_frame_equal(
+        times,
+        expected_frame(
+            pairs[~is_missing], ["origin_id", "destination_id", "duration_sec"]
+        ),
+    )
+    pd.testing.assert_frame_equal(
+        missing,
+        expected_frame(pairs[is_missing], ["origin_id", "destination_id"]),
+    )
+    # Healthy halves are routed in one request, so far fewer requests are
+    # needed than there are pairs
+    assert router.n_requests < len(pairs) / 2
+
+
+def test_group_test_isolates_bad_origin_of_full_block(params: dict) -> None:
+    # At the default max_recursion_depth, group testing narrows a block much
+    # larger than 2 ** max_recursion_depth down to the bad origin
+    router = SyntheticRouter()
+    calc = make_calculator(
+        params, n_origins=600, n_destinations=900, client=router
+    )
+    router.failing_lons = [calc.origins["lon"].iloc[417]]
+    times, missing = split(calc, run_group_test(calc, router))
+
+    assert len(times) == 599 * 900
+    assert len(missing) == 900
+    assert (missing["origin_id"] == calc.origins["id"].iloc[417]).all()
+    # Two requests per halving of the origins, then two for the bad row
+    assert router.n_requests <= 2 * (np.ceil(np.log2(600)) + 1)
+
+
+@pytest.fixture
+def mock_osrm() -> Iterator[None]:
+    """
+    Mock OSRM service at the endpoint the calculators connect to, with two
+    failing points. Served from a spawned process, since the server forks
+    a process per connection and pytest may have threads running.
+    """
+    host, port = DOCKER_ENDPOINT.removeprefix("http://").split(":")
+    if is_listening(host, int(port)):
+        pytest.skip(f"{DOCKER_ENDPOINT} is already in use")
+    origins = make_points(150, seed=0, prefix="17")
+    destinations = make_points(120, seed=1, prefix="18")
+    failing_points = {
+        f"{origins['lon'].iloc[40]},{origins['lat'].iloc[40]}",
+        f"{destinations['lon'].iloc[90]},{destinations['lat'].iloc[90]}",
+    }
+    server = multiprocessing.get_context("spawn").Process(
+        target=serve,
+        kwargs={
+            "host": host,
+            "port": int(port),
+            "failing_points": failing_points,
+        },
+        daemon=True,
+    )
+    server.start()
+    try:
+        deadline = time.monotonic() + 30
+        while not is_listening(host, int(port)):
+            if not server.is_alive() or time.monotonic() > deadline:
+                pytest.fail("Mock OSRM server did not start")
+            time.sleep(0.05)
+        yield
+    finally:
+        server.terminate()
+        server.join()
+
+
+def is_listening(host: str, port: int) -> bool:
+    with socket.socket() as sock:
+        return sock.connect_ex((host, port)) == 0
+
+
+def test_engines_match(params: dict, mock_osrm: None) -> None:
+    params["times"]["max_recursion_depth"] = 20
+    frames = {}
+    for engine in ["thread", "async", "process"]:
+        calc = make_calculator(
+            params,
+            n_origins=150,
+            n_destinations=120,
+            engine=engine,
+            max_split_size=40,
+        )
+        try:
+            times, missing_pairs = calc.many_to_many()
+            frames[engine] = (times, missing_pairs.to_df())
+            if engine == "thread":
+                # Streaming gives the same results, one stripe of origins
+                # at a time in routing order
+                stripes = pd.concat(
+                    [df for df, _ in calc.iter_many_to_many()],
+                    ignore_index=True,
+                )
+                pd.testing.assert_frame_equal(
+                    stripes.sort_values(
+                        ["origin_id", "destination_id"], ignore_index=True
+                    ),
+                    times,
+                )
+        finally:
+            calc.config.client.close()
+
+    times, missing = frames["thread"]
+    assert len(times) + len(missing) == 150 * 120
+    assert len(missing) == 120 + 150 - 1
+    for engine in ["async", "process"]:
+        pd.testing.assert_frame_equal(frames[engine][0], times)
+        pd.testing.assert_frame_equal(frames[engine][1], missing)
@@ -0,0 +1,131 @@
+import logging
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pyarrow.parquet as pq
+import pytest
+from utils.utils import (
+    hilbert_index,
+    is_sorted_parquet,
+    read_parquet_rows,
+    write_sorted_parquet,
+)
+
+
+def test_hilbert_index_first_order() -> None:
+    # The first-order curve visits the corners of the box in a U shape:
+    # bottom left, top left, top right, bottom right
+    lon = np.array([0.0, 0.0, 1.0, 1.0])
+    lat = np.array([0.0, 1.0, 1.0, 0.0])
+    index = hilbert_index(lon, lat, bounds=(0, 0, 1, 1), order=1)
+    assert index.tolist() == [0, 1, 2, 3]
+
+
+def test_hilbert_index_visits_neighbors_in_order() -> None:
+    # Every cell of the grid gets its own index, and consecutive indices
+    # are adjacent cells
+    order = 4
+    n = 1 << order
+    x, y = np.meshgrid(np.arange(n), np.arange(n))
+    x, y = x.ravel().astype(float), y.ravel().astype(float)
+    index = hilbert_index(x, y, bounds=(0, 0, n - 1, n - 1), order=order)
+    assert sorted(index.tolist()) == list(range(n * n))
+
+    path = np.argsort(index)
+    steps = np.abs(np.diff(x[path])) + np.abs(np.diff(y[path]))
+    assert (steps == 1).all()
+
+
+def test_hilbert_index_clips_points_outside_bounds() -> None:
+    index = hilbert_index(
+        np.array([-5.0, 0.0, 10.0]),
+        np.array([-5.0, 0.0, 0.0]),
+        bounds=(0, 0, 1, 1),
+        order=1,
+    )
+    assert index.tolist() == [0, 0, 3]
+
+
+def make_points(n: int) -> pd.DataFrame:
+    rng = np.random.default_rng(0)
+    return pd.DataFrame(
+        {
+            "geoid": [f"17{i:09d}" for i in rng.permutation(n)],
+            "x_4326": rng.uniform(-91, -87, n),
+            "y_4326": rng.uniform(37, 42, n),
+        }
+    )
+
+
+@pytest.mark.parametrize(
+    "start_idx,end_idx",
+    [(None, None), (0, 10), (25, 75), (90, 200), (-5, 3), (60, 40)],
+)
+@pytest.mark.parametrize("is_sorted", [True, False])
+def test_read_parquet_rows(
+    tmp_path: Path,
+    is_sorted: bool,
+    start_idx: int | None,
+    end_idx: int | None,
+) -> None:
+    points = make_points(100)
+    file = tmp_path / "points.parquet"
+    if is_sorted:
+        write_sorted_parquet(points, file, sort_by="geoid", row_group_size=16)
+    else:
+        points.to_parquet(file, row_group_size=16, index=False)
+    assert is_sorted_parquet(pq.ParquetFile(file), "geoid") == is_sorted
+
+    df, n_rows = read_parquet_rows(
+        file,
+        columns=["geoid", "y_4326"],
+        sort_by="geoid",
+        start_idx=start_idx,
+        end_idx=end_idx,
+    )
+    expected = points.sort_values(by="geoid")[["geoid", "y_4326"]].iloc[
+        max(start_idx or 0, 0) : end_idx
+    ]
+    assert n_rows == 100
+    pd.testing.assert_frame_equal(
+        df.reset_index(drop=True), expected.reset_index(drop=True)
+    )
+
+
+def test_read_parquet_rows_reads_only_needed_row_groups(
+    tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    file = tmp_path / "points.parquet"
+    write_sorted_parquet(
+        make_points(100), file, sort_by="geoid", row_group_size=16
+    )
+    read_row_groups = pq.ParquetFile.read_row_groups
+    calls = []
+
+    def spy(self, row_groups, *args, **kwargs):
+        calls.append(list(row_groups))
+        return read_row_groups(self, row_groups, *args, **kwargs)
+
+    monkeypatch.setattr(pq.ParquetFile, "read_row_groups", spy)
+    df, _ = read_parquet_rows(
+        file, columns=["geoid"], sort_by="geoid", start_idx=20, end_idx=40
+    )
+    assert calls == [[1, 2]]
+    assert len(df) == 20
+
+
+def test_read_parquet_rows_warns_on_unsorted_file(
+    tmp_path: Path, caplog: pytest.LogCaptureFixture
+) -> None:
+    file = tmp_path / "points.parquet"
+    make_points(10).to_parquet(file, index=False)
+    with caplog.at_level(logging.WARNING):
+        read_parquet_rows(file, columns=["geoid"], sort_by="geoid")
+    assert "isn't sorted by geoid" in caplog.text
+
+    caplog.clear()
+    write_sorted_parquet(make_points(10), file, sort_by="geoid")
+    with caplog.at_level(logging.WARNING):
+        read_parquet_rows(file, columns=["geoid"], sort_by="geoid")
+    assert not caplog.text
@@ -0,0 +1,200 @@
+import logging
+import threading
+
+import aiohttp
+import requests as r
+
+from utils.osrm import OSRMError
+
+
+def is_resource_error(e: Exception) -> bool:
+    """
+    Check whether a Table API request failed because the block was too
+    large for OSRM (the table size limit, or a timeout waiting for the
+    response), rather than because of the points in it.
+
+    Connection errors, including timeouts while connecting, don't count.
+    They're also what an OSRM restart looks like, and would shrink blocks
+    for the rest of the run.
+    """
+    if isinstance(e, OSRMError):
+        return e.code == "TooBig" or "Too many table coordinates" in str(e)
+    return isinstance(
+        e, (r.exceptions.ReadTimeout, aiohttp.SocketTimeoutError)
+    )
+
+
+class BlockSizeController:
+    """
+    Class to tune the shape of the blocks sent to the OSRM Table API while
+    routing.
+
+    A many-to-many table request runs one search per origin and per
+    destination, then combines them for every pair. Larger blocks amortize
+    the searches over more pairs, until they become slow or run OSRM out of
+    memory. Starting from the static max_split_size, the controller times a
+    few top-level blocks of each shape and doubles the shorter side while
+    throughput (pairs/sec) improves, blocks stay under a target latency, and
+    the pairs per block stay within a budget. Once a larger shape stops
+    paying off, it goes back to the best shape seen and keeps it.
+
+    Blocks that fail for lack of resources halve the budget to below their
+    size and shrink the shape to fit, after which tuning starts over.
+
+    If fixed_origins is set, only the number of destinations is tuned. This
+    is needed when origins have been reordered within stripes of a set size,
+    since stripes of any other size would no longer cover a contiguous range
+    of origin IDs.
+    """
+
+    # Minimum relative gain in pairs/sec needed to keep growing
+    MIN_GAIN = 0.05
+
+    def __init__(
+        self,
+        n_origins: int,
+        n_destinations: int,
+        max_n_origins: int,
+        max_n_destinations: int,
+        min_split_size: int,
+        max_block_pairs: int,
+        target_block_sec: float,
+        n_samples: int,
+        logger: logging.Logger,
+        fixed_origins: bool = False,
+    ) -> None:
+        self._lock = threading.Lock()
+        self.n_origins = n_origins
+        self.n_destinations = n_destinations
+        self.max_n_origins = max_n_origins
+        self.max_n_destinations = max_n_destinations
+        self.min_split_size = min_split_size
+        self.max_block_pairs = max_block_pairs
+        self.target_block_sec = target_block_sec
+        self.n_samples = n_samples
+        self.logger = logger
+        self.fixed_origins = fixed_origins
+
+        self.settled = False
+        self._samples: list[float] = []
+        self._best: tuple[int, int, float] | None = None
+
+    @property
+    def shape(self) -> tuple[int, int]:
+        """Number of origins and destinations to put in the next blocks."""
+        with self._lock:
+            return self.n_origins, self.n_destinations
+
+    def record(
+        self,
+        n_origins: int,
+        n_destinations: int,
+        elapsed_sec: float,
+        failed: bool = False,
+    ) -> None:
+        """
+        Record the outcome of a top-level block. Only full blocks of the
+        current shape are used to measure throughput, but a failure of any
+        block shrinks the shape.
+
+        Args:
+            n_origins: Number of origins in the block.
+            n_destinations: Number of destinations in the block.
+            elapsed_sec: Time taken to route the block.
+            failed: Whether the block failed for lack of resources.
+        """
+        with self._lock:
+            if failed:
+                self._shrink(n_origins * n_destinations)
+                return
+            if self.settled or (n_origins, n_destinations) != (
+                self.n_origins,
+                self.n_destinations,
+            ):
+                return
+
+            self._samples.append(elapsed_sec)
+            if len(self._samples) < self.n_samples:
+                return
+
+            mean_sec = sum(self._samples) / len(self._samples)
+            rate = n_origins * n_destinations / max(mean_sec, 1e-9)
+            self._samples = []
+            if self._best is None or rate > self._best[2] * (
+                1 + self.MIN_GAIN
+            ):
+                self._best = (n_origins, n_destinations, rate)
+                if mean_sec < self.target_block_sec and self._grow():
+                    self.logger.info(
+                        "Blocks of %sx%s routed at %.0f pairs/sec, "
+                        "trying %sx%s",
+                        n_origins,
+                        n_destinations,
+                        rate,
+                        self.n_origins,
+                        self.n_destinations,
+                    )
+                    return
+
+            self.n_origins, self.n_destinations, best_rate = self._best
+            self.settled = True
+            self.logger.info(
+                "Settled on blocks of %sx%s at %.0f pairs/sec",
+                self.n_origins,
+                self.n_destinations,
+                best_rate,
+            )
+
+    def _grow(self) -> bool:
+        """
+        Double the shorter side of the block, or the longer one if the
+        shorter side can't grow. Returns False if neither side fits.
+        """
+        candidates = [
+            (min(2 * self.n_origins, self.max_n_origins), self.n_destinations),
+            (
+                self.n_origins,
+                min(2 * self.n_destinations, self.max_n_destinations),
+            ),
+        ]
+        if self.fixed_origins:
+            candidates = candidates[1:]
+        elif self.n_destinations < self.n_origins:
+            candidates.reverse()
+        for n_o, n_d in candidates:
+            if (n_o, n_d) != (self.n_origins, self.n_destinations) and (
+                n_o * n_d <= self.max_block_pairs
+            ):
+                self.n_origins, self.n_destinations = n_o, n_d
+                return True
+        return False
+
+    def _shrink(self, failed_pairs: int) -> None:
+        """Halve the longer side until blocks fit under the lowered budget."""
+        # Blocks of an old shape that were already in flight fail too
+        if failed_pairs // 2 >= self.max_block_pairs:
+            return
+        self.max_block_pairs = min(self.max_block_pairs, failed_pairs // 2)
+        while self.n_origins * self.n_destinations > self.max_block_pairs:
+            if self.n_origins >= self.n_destinations and not (
+                self.fixed_origins
+            ):
+                if self.n_origins <= self.min_split_size:
+                    break
+                self.n_origins = max(self.n_origins // 2, self.min_split_size)
+            else:
+                if self.n_destinations <= self.min_split_size:
+                    break
+                self.n_destinations = max(
+                    self.n_destinations // 2, self.min_split_size
+                )
+
+        self.settled = False
+        self._samples = []
+        self._best = None
+        self.logger.warning(
+            "Block of %s pairs ran out of resources, shrinking blocks to %sx%s",
+            failed_pairs,
+            self.n_origins,
+            self.n_destinations,
+        )
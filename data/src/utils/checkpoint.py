@@ -0,0 +1,167 @@
+import json
+import logging
+import os
+import shutil
+import threading
+from pathlib import Path
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.feather as feather
+
+
+class BlockCheckpoint:
+    """
+    Class to checkpoint the top-level blocks of a travel time calculation,
+    so that a rerun of an interrupted chunk only routes the blocks that
+    didn't finish.
+
+    The checkpoint is a directory holding a manifest and a spill file per
+    finished block. The manifest is an append-only JSON Lines file: a header
+    with the fingerprint of the run, then a record for each stripe of blocks
+    when it starts and for each block when it finishes. Routed times are
+    spilled to Arrow IPC files, and missing blocks are kept in the manifest.
+
+    A rerun replays the recorded stripes with exactly the same blocks, since
+    adaptive block shapes differ between runs, and reads back the results of
+    the blocks that finished. Checkpoints whose fingerprint doesn't match
+    (e.g. because the inputs or parameters changed) are discarded.
+    """
+
+    def __init__(
+        self, path: Path, fingerprint: str, logger: logging.Logger
+    ) -> None:
+        self.path = path
+        self.manifest_file = path / "manifest.jsonl"
+        self.fingerprint = fingerprint
+        self.logger = logger
+        self._lock = threading.Lock()
+
+        # Stripes and finished blocks recorded by earlier runs
+        self.stripes: list[dict] = []
+        self.finished: dict[tuple[int, int], dict] = {}
+        self._load()
+
+        self.path.mkdir(parents=True, exist_ok=True)
+        self._manifest = open(self.manifest_file, "a")
+        if not self.manifest_file.stat().st_size:
+            self._append({"fingerprint": self.fingerprint})
+
+    def _load(self) -> None:
+        """Read the manifest of an earlier run, if there is a valid one."""
+        if not self.manifest_file.exists():
+            return
+        with open(self.manifest_file) as file:
+            lines = file.read().splitlines()
+
+        records = []
+        for line in lines:
+            try:
+                records.append(json.loads(line))
+            except json.JSONDecodeError:
+                # The last line may be cut short if the run was killed
+                # while writing it. Drop it so new records start on a line
+                # of their own
+                with open(self.manifest_file, "w") as file:
+                    file.writelines(
+                        json.dumps(record) + "\n" for record in records
+                    )
+                break
+        if not records or records[0].get("fingerprint") != self.fingerprint:
+            self.logger.warning(
+                "Checkpoint at %s doesn't match the current inputs and "
+                "parameters. Starting over",
+                self.path,
+            )
+            shutil.rmtree(self.path)
+            return
+
+        for record in records[1:]:
+            if "blocks" in record:
+                self.stripes.append(record)
+            else:
+                self.finished[(record["stripe"], record["block"])] = record
+
+    def _append(self, record: dict) -> None:
+        """Append a record to the manifest and flush it to disk."""
+        # Block indices may be NumPy integers
+        self._manifest.write(json.dumps(record, default=int) + "\n")
+        self._manifest.flush()
+        os.fsync(self._manifest.fileno())
+
+    def add_stripe(
+        self,
+        o_start_idx: int,
+        o_end_idx: int,
+        blocks: list[dict],
+        unroutable: list[tuple[int, int, int, int]],
+        n_skipped_pairs: int,
+    ) -> int:
+        """
+        Record a stripe of blocks before it's routed.
+
+        Returns:
+            The index of the stripe.
+        """
+        with self._lock:
+            record = {
+                "stripe": len(self.stripes),
+                "o_start_idx": o_start_idx,
+                "o_end_idx": o_end_idx,
+                "blocks": blocks,
+                "unroutable": unroutable,
+                "n_skipped_pairs": n_skipped_pairs,
+            }
+            self.stripes.append(record)
+            self._append(record)
+            return record["stripe"]
+
+    def add_block(
+        self,
+        stripe_idx: int,
+        block_idx: int,
+        times: pd.DataFrame | None,
+        missing: list[tuple[int, int, int, int]],
+    ) -> None:
+        """
+        Record a finished block. Its times are written to a temporary file
+        that is only renamed into place once complete, so a block is never
+        recorded with a partial spill file.
+        """
+        spill_file = None
+        if times is not None and len(times):
+            spill_file = f"block-{stripe_idx}-{block_idx}.arrow"
+            tmp_path = self.path / f"{spill_file}.tmp"
+            feather.write_feather(
+                pa.Table.from_pandas(times, preserve_index=False),
+                tmp_path,
+                compression="uncompressed",
+            )
+            os.replace(tmp_path, self.path / spill_file)
+
+        record = {
+            "stripe": stripe_idx,
+            "block": block_idx,
+            "file": spill_file,
+            "missing": missing,
+        }
+        with self._lock:
+            self.finished[(stripe_idx, block_idx)] = record
+            self._append(record)
+
+    def read_block(
+        self, stripe_idx: int, block_idx: int
+    ) -> tuple[pd.DataFrame | None, list[tuple[int, int, int, int]]]:
+        """Read back the times and missing blocks of a finished block."""
+        record = self.finished[(stripe_idx, block_idx)]
+        times = (
+            feather.read_feather(self.path / record["file"])
+            if record["file"]
+            else None
+        )
+        return times, [tuple(block) for block in record["missing"]]
+
+    def remove(self) -> None:
+        """Delete the checkpoint, once its chunk's outputs are written."""
+        self._manifest.close()
+        shutil.rmtree(self.path, ignore_errors=True)
@@ -2,6 +2,14 @@
 # Compose file for endpoint setup
 DOCKER_ENDPOINT = "http://127.0.0.1:5333"
 
+# Mean radius of the Earth in meters, used for great-circle distances
+EARTH_RADIUS_M = 6371008.8
+
+# Rows per row group of the origin and destination point files. Chunked
+# travel time jobs read only the row groups covering their chunk, so smaller
+# groups mean less data read beyond the chunk boundaries
+OD_ROW_GROUP_SIZE = 1000
+
 # Base URL for TIGER/Line shapefiles
 TIGER_BASE_URL = "https://www2.census.gov/geo/tiger/"
 
@@ -68,12 +76,30 @@ DATASET_DICT: dict = {
                 "calc_n_destinations",
                 "calc_n_pairs",
                 "calc_n_missing_pairs",
+                "calc_n_fault_isolation_requests",
+                "calc_n_skipped_pairs",
+                "calc_skipped_pairs_share",
+                "calc_n_over_max_duration_pairs",
+                "calc_snap_time_sec",
+                "calc_routing_time_sec",
+                "calc_write_time_sec",
+                "calc_n_requests",
+                "calc_request_latency_p50_ms",
+                "calc_request_latency_p90_ms",
+                "calc_request_latency_p99_ms",
+                "calc_request_latency_max_ms",
+                "calc_bytes_sent",
+                "calc_bytes_received",
+                "calc_tasks_per_depth",
                 "git_commit_sha_short",
                 "git_commit_sha_long",
                 "param_network_buffer_m",
                 "param_destination_buffer_m",
                 "param_max_split_size",
                 "param_use_snapped",
+                "param_fault_isolation",
+                "param_max_distance_m",
+                "param_max_duration_sec",
                 "file_input_origins_md5",
                 "file_input_destinations_md5",
             ],
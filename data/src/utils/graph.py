@@ -0,0 +1,367 @@
+import math
+from pathlib import Path
+
+import numpy as np
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import dijkstra
+from scipy.spatial import cKDTree
+
+from utils.constants import EARTH_RADIUS_M
+from utils.osrm import parse_request
+from utils.utils import sphere_coords
+
+# Rough speeds (km/h) by OSM highway tag, loosely following the default OSRM
+# profiles. Ways with tags missing from a mode's table aren't routable by it
+MODE_SPEEDS_KPH = {
+    "car": {
+        "motorway": 90,
+        "motorway_link": 45,
+        "trunk": 85,
+        "trunk_link": 40,
+        "primary": 65,
+        "primary_link": 30,
+        "secondary": 55,
+        "secondary_link": 25,
+        "tertiary": 40,
+        "tertiary_link": 20,
+        "unclassified": 25,
+        "residential": 25,
+        "living_street": 10,
+        "service": 15,
+    },
+    "bicycle": {
+        "primary": 15,
+        "primary_link": 15,
+        "secondary": 15,
+        "secondary_link": 15,
+        "tertiary": 15,
+        "tertiary_link": 15,
+        "unclassified": 15,
+        "residential": 15,
+        "living_street": 15,
+        "service": 15,
+        "track": 12,
+        "path": 12,
+        "cycleway": 15,
+        "footway": 6,
+        "pedestrian": 6,
+    },
+    "foot": {
+        "trunk": 5,
+        "trunk_link": 5,
+        "primary": 5,
+        "primary_link": 5,
+        "secondary": 5,
+        "secondary_link": 5,
+        "tertiary": 5,
+        "tertiary_link": 5,
+        "unclassified": 5,
+        "residential": 5,
+        "living_street": 5,
+        "service": 5,
+        "track": 5,
+        "path": 5,
+        "cycleway": 5,
+        "footway": 5,
+        "pedestrian": 5,
+        "steps": 2,
+    },
+}
+
+# Modes that can only travel one way down oneway streets
+ONEWAY_MODES = ["car", "bicycle"]
+
+
+class GraphRouter:
+    """
+    Class to route between points in-process on a compact road graph, as a
+    stand-in for a running OSRM service.
+
+    The graph is a scipy.sparse matrix of travel times in seconds between
+    nodes. Points are snapped to their nearest node and many-to-many
+    durations are computed with Dijkstra's algorithm, a batch of source
+    nodes at a time. Requests and responses follow the OSRM Table and
+    Nearest APIs, so the router can be used anywhere an OSRMClient is. It's
+    much slower than OSRM, so it's meant for small states and tests.
+    """
+
+    def __init__(
+        self,
+        lon: np.ndarray,
+        lat: np.ndarray,
+        from_idx: np.ndarray,
+        to_idx: np.ndarray,
+        duration_sec: np.ndarray,
+        batch_size: int = 32,
+    ) -> None:
+        # Nodes are reported with 6 digits of precision, like OSRM
+        self.lon = np.round(np.asarray(lon, dtype=np.float64), 6)
+        self.lat = np.round(np.asarray(lat, dtype=np.float64), 6)
+        self.batch_size = batch_size
+        self.n_nodes = len(self.lon)
+
+        # Keep only the fastest edge between each pair of nodes. OSRM
+        # reports durations in tenths of a second, so no edge is free
+        from_idx = np.asarray(from_idx, dtype=np.int64)
+        to_idx = np.asarray(to_idx, dtype=np.int64)
+        duration_sec = np.maximum(np.asarray(duration_sec), 0.1)
+        order = np.lexsort((duration_sec, to_idx, from_idx))
+        keys = from_idx[order] * self.n_nodes + to_idx[order]
+        _, first = np.unique(keys, return_index=True)
+        keep = order[first]
+        self.graph = csr_matrix(
+            (
+                duration_sec[keep].astype(np.float32),
+                (
+                    from_idx[keep].astype(np.int32),
+                    to_idx[keep].astype(np.int32),
+                ),
+            ),
+            shape=(self.n_nodes, self.n_nodes),
+        )
+        self.n_edges = self.graph.nnz
+        self._tree = cKDTree(sphere_coords(self.lon, self.lat))
+
+    @classmethod
+    def from_ways(
+        cls,
+        node_ids: np.ndarray,
+        lon: np.ndarray,
+        lat: np.ndarray,
+        way_lengths: np.ndarray,
+        speed_kph: np.ndarray,
+        oneway: np.ndarray,
+        batch_size: int = 32,
+    ) -> "GraphRouter":
+        """
+        Build a router from the nodes of a set of ways, listed way after
+        way. Consecutive nodes of each way are joined by an edge timed by
+        its great-circle length and the way's speed.
+
+        Args:
+            node_ids: IDs of the nodes of every way, concatenated.
+            lon: Longitude of each node in node_ids.
+            lat: Latitude of each node in node_ids.
+            way_lengths: Number of nodes in each way.
+            speed_kph: Speed along each way.
+            oneway: 1 if a way is oneway in its direction, -1 if it's oneway
+                against it, and 0 otherwise.
+            batch_size: Number of source nodes to route at once.
+        """
+        node_ids = np.asarray(node_ids)
+        unique_ids, first_idx, node_idx = np.unique(
+            node_ids, return_index=True, return_inverse=True
+        )
+
+        # Edges join every node to the next one, except across ways
+        way_lengths = np.asarray(way_lengths)
+        is_last = np.zeros(len(node_ids), dtype=bool)
+        is_last[np.cumsum(way_lengths) - 1] = True
+        starts = np.flatnonzero(~is_last)
+        ends = starts + 1
+        way_idx = np.repeat(np.arange(len(way_lengths)), way_lengths)[starts]
+
+        xyz = sphere_coords(lon, lat)
+        chord = np.linalg.norm(xyz[starts] - xyz[ends], axis=1)
+        length_m = 2 * EARTH_RADIUS_M * np.arcsin(np.minimum(chord / 2, 1))
+        duration_sec = length_m / (np.asarray(speed_kph)[way_idx] / 3.6)
+
+        # Oneway ways only get edges in one direction
+        oneway = np.asarray(oneway)[way_idx]
+        from_idx = np.concatenate(
+            [node_idx[starts][oneway >= 0], node_idx[ends][oneway <= 0]]
+        )
+        to_idx = np.concatenate(
+            [node_idx[ends][oneway >= 0], node_idx[starts][oneway <= 0]]
+        )
+        duration_sec = np.concatenate(
+            [duration_sec[oneway >= 0], duration_sec[oneway <= 0]]
+        )
+        return cls(
+            lon=np.asarray(lon)[first_idx],
+            lat=np.asarray(lat)[first_idx],
+            from_idx=from_idx,
+            to_idx=to_idx,
+            duration_sec=duration_sec,
+            batch_size=batch_size,
+        )
+
+    @classmethod
+    def from_osm(
+        cls, path: str | Path, mode: str, batch_size: int = 32
+    ) -> "GraphRouter":
+        """
+        Build a router from the ways of an OSM extract that are routable by
+        the mode. Requires the osmium package from the graph extra.
+
+        Args:
+            path: Path to the .osm.pbf file.
+            mode: Travel mode, used to pick the speed of each way.
+            batch_size: Number of source nodes to route at once.
+        """
+        import osmium
+
+        speeds = MODE_SPEEDS_KPH[mode]
+
+        class WayHandler(osmium.SimpleHandler):
+            def __init__(self) -> None:
+                super().__init__()
+                self.node_ids: list[int] = []
+                self.lon: list[float] = []
+                self.lat: list[float] = []
+                self.way_lengths: list[int] = []
+                self.speed_kph: list[float] = []
+                self.oneway: list[int] = []
+
+            def way(self, w) -> None:
+                highway = w.tags.get("highway")
+                if highway not in speeds or len(w.nodes) < 2:
+                    return
+                oneway = 0
+                if mode in ONEWAY_MODES:
+                    tag = w.tags.get("oneway", "no")
+                    if tag in ["yes", "true", "1"] or (
+                        highway == "motorway" and tag != "no"
+                    ):
+                        oneway = 1
+                    elif tag == "-1":
+                        oneway = -1
+                for node in w.nodes:
+                    self.node_ids.append(node.ref)
+                    self.lon.append(node.lon)
+                    self.lat.append(node.lat)
+                self.way_lengths.append(len(w.nodes))
+                self.speed_kph.append(speeds[highway])
+                self.oneway.append(oneway)
+
+        handler = WayHandler()
+        handler.apply_file(str(path), locations=True)
+        return cls.from_ways(
+            node_ids=np.array(handler.node_ids, dtype=np.int64),
+            lon=np.array(handler.lon),
+            lat=np.array(handler.lat),
+            way_lengths=np.array(handler.way_lengths),
+            speed_kph=np.array(handler.speed_kph, dtype=np.float64),
+            oneway=np.array(handler.oneway),
+            batch_size=batch_size,
+        )
+
+    @classmethod
+    def from_grid(
+        cls,
+        bounds: tuple[float, float, float, float],
+        spacing_m: float,
+        speed_kph: float,
+        batch_size: int = 32,
+    ) -> "GraphRouter":
+        """
+        Build a router on a synthetic street grid covering a bounding box.
+        Every node is joined to its four neighbors by two-way streets.
+
+        Args:
+            bounds: Tuple of (min_lon, min_lat, max_lon, max_lat).
+            spacing_m: Approximate distance between neighboring nodes.
+            speed_kph: Speed along every street.
+            batch_size: Number of source nodes to route at once.
+        """
+        min_lon, min_lat, max_lon, max_lat = bounds
+        deg_m = math.radians(1) * EARTH_RADIUS_M
+        mid_lat = math.radians((min_lat + max_lat) / 2)
+        n_lat = max(int((max_lat - min_lat) * deg_m / spacing_m), 1) + 1
+        n_lon = (
+            max(
+                int(
+                    (max_lon - min_lon) * deg_m * math.cos(mid_lat) / spacing_m
+                ),
+                1,
+            )
+            + 1
+        )
+        lon, lat = np.meshgrid(
+            np.linspace(min_lon, max_lon, n_lon),
+            np.linspace(min_lat, max_lat, n_lat),
+        )
+
+        # Streets run along each row and each column of the grid
+        node_idx = np.arange(n_lat * n_lon).reshape(n_lat, n_lon)
+        rows = np.column_stack(
+            [node_idx[:, :-1].ravel(), node_idx[:, 1:].ravel()]
+        )
+        cols = np.column_stack(
+            [node_idx[:-1, :].ravel(), node_idx[1:, :].ravel()]
+        )
+        edges = np.concatenate([rows, cols])
+        return cls.from_ways(
+            node_ids=edges.ravel(),
+            lon=lon.ravel()[edges.ravel()],
+            lat=lat.ravel()[edges.ravel()],
+            way_lengths=np.full(len(edges), 2),
+            speed_kph=np.full(len(edges), speed_kph, dtype=np.float64),
+            oneway=np.zeros(len(edges), dtype=int),
+            batch_size=batch_size,
+        )
+
+    def snap(self, lon: np.ndarray, lat: np.ndarray) -> np.ndarray:
+        """Get the index of the nearest graph node to each point."""
+        _, node_idx = self._tree.query(sphere_coords(lon, lat))
+        return node_idx
+
+    def table(
+        self, source_nodes: np.ndarray, destination_nodes: np.ndarray
+    ) -> np.ndarray:
+        """
+        Compute the travel time from every source node to every destination
+        node. Each unique source is routed once, batch_size at a time.
+
+        Returns:
+            A float64 array of durations in seconds, with a row per source
+            and a column per destination. Unreachable pairs are NaN.
+        """
+        unique_sources, source_row = np.unique(
+            source_nodes, return_inverse=True
+        )
+        durations = np.empty((len(unique_sources), len(destination_nodes)))
+        for start in range(0, len(unique_sources), self.batch_size):
+            batch = unique_sources[start : start + self.batch_size]
+            dist = dijkstra(self.graph, directed=True, indices=batch)
+            durations[start : start + len(batch)] = dist[:, destination_nodes]
+
+        durations = np.round(durations[source_row], 1)
+        durations[np.isinf(durations)] = np.nan
+        return durations
+
+    def get(self, path: str) -> dict:
+        """
+        Answer an OSRM Table or Nearest API request.
+
+        Args:
+            path: Request path and query string, starting from the service
+                name e.g. "/table/v1/car/...".
+
+        Raises:
+            ValueError: If the request isn't a Table or Nearest request.
+        """
+        service, lon, lat, sources, destinations = parse_request(path)
+        node_idx = self.snap(lon, lat)
+        if service == "nearest":
+            location = [
+                float(self.lon[node_idx[0]]),
+                float(self.lat[node_idx[0]]),
+            ]
+            return {"code": "Ok", "waypoints": [{"location": location}]}
+
+        durations = self.table(node_idx[sources], node_idx[destinations])
+        return {"code": "Ok", "durations": durations}
+
+    def nearest(self, mode: str, coord: str) -> list[float]:
+        """
+        Snap a single "lon,lat" coordinate string to the nearest graph node.
+
+        Returns:
+            The snapped coordinate as a [lon, lat] list.
+        """
+        response_data = self.get(f"/nearest/v1/{mode}/{coord}")
+        return response_data["waypoints"][0]["location"]
+
+    def close(self) -> None:
+        """Nothing to close, kept for compatibility with OSRMClient."""
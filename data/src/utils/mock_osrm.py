@@ -0,0 +1,340 @@
+import argparse
+import json
+import socketserver
+import struct
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from urllib.parse import urlsplit
+
+import numpy as np
+
+from utils.constants import DOCKER_ENDPOINT, EARTH_RADIUS_M
+from utils.osrm import (
+    FB_ERROR_FIELDS,
+    FB_RESULT_FIELDS,
+    FB_TABLE_FIELDS,
+    FLATBUFFERS_CONTENT_TYPE,
+    parse_request,
+    request_format,
+)
+from utils.utils import sphere_coords
+
+
+def synthetic_durations(
+    src_lon: np.ndarray,
+    src_lat: np.ndarray,
+    dst_lon: np.ndarray,
+    dst_lat: np.ndarray,
+    speed_kph: float = 50,
+    detour_factor: float = 1.3,
+) -> np.ndarray:
+    """
+    Deterministic stand-in for OSRM durations: the great-circle distance
+    between each pair, stretched by a detour factor and driven at a constant
+    speed. Rounded to tenths of a second like OSRM.
+
+    Returns:
+        A float64 array with a row per source and a column per destination.
+    """
+    cos_angle = np.clip(
+        sphere_coords(src_lon, src_lat) @ sphere_coords(dst_lon, dst_lat).T,
+        -1,
+        1,
+    )
+    distance_m = EARTH_RADIUS_M * np.arccos(cos_angle)
+    return np.round(distance_m * detour_factor / (speed_kph / 3.6), 1)
+
+
+# Field of a FlatBuffers table to encode: a struct format character and a
+# scalar ("?", "H", "I"), or a reference to a "string", a "floats" vector,
+# or a nested "table" (a list of fields indexed by field ID)
+FlatBuffersField = tuple[str, object] | None
+
+
+def _write_fb_table(buf: bytearray, fields: list[FlatBuffersField]) -> int:
+    """
+    Append a FlatBuffers table to the buffer, preceded by its vtable and
+    followed by everything it references, so that offsets always point
+    forward. Every field gets a 4-byte slot.
+
+    Returns:
+        The position of the table in the buffer.
+    """
+    slots = []
+    table_size = 4
+    for field in fields:
+        slots.append(table_size if field is not None else 0)
+        table_size += 4 if field is not None else 0
+
+    buf.extend(bytes(-len(buf) % 2))
+    vtable_pos = len(buf)
+    buf.extend(
+        struct.pack(
+            f"<{2 + len(fields)}H", 4 + 2 * len(fields), table_size, *slots
+        )
+    )
+    buf.extend(bytes(-len(buf) % 4))
+    table_pos = len(buf)
+    buf.extend(
+        struct.pack("<i", table_pos - vtable_pos) + bytes(table_size - 4)
+    )
+
+    for field, slot in zip(fields, slots):
+        if field is None:
+            continue
+        kind, value = field
+        slot_pos = table_pos + slot
+        if kind in ["?", "H", "I"]:
+            struct.pack_into(f"<{kind}", buf, slot_pos, value)
+            continue
+        if kind == "table":
+            child_pos = _write_fb_table(buf, value)  # type: ignore[arg-type]
+        else:
+            data = (
+                str(value).encode() + b"\0"
+                if kind == "string"
+                else np.asarray(value, dtype="<f4").tobytes()
+            )
+            length = len(data) - 1 if kind == "string" else len(data) // 4
+            buf.extend(bytes(-len(buf) % 4))
+            child_pos = len(buf)
+            buf.extend(struct.pack("<I", length) + data)
+        struct.pack_into("<I", buf, slot_pos, child_pos - slot_pos)
+    return table_pos
+
+
+def encode_flatbuffers_table(
+    durations: np.ndarray | None = None,
+    code: str = "Ok",
+    message: str = "",
+) -> bytes:
+    """
+    Encode a Table API response in OSRM's FlatBuffers format, with either
+    durations or an error. Only sets the fields read by
+    decode_flatbuffers_table. Like OSRM, pairs without a route are written
+    as 0.
+
+    Args:
+        durations: Durations with a row per source and a column per
+            destination, for a successful response.
+        code: Error code e.g. "NoSegment", for an error response.
+        message: Error message, for an error response.
+
+    Returns:
+        The response body.
+    """
+    result: list[FlatBuffersField] = [None] * (
+        max(FB_RESULT_FIELDS.values()) + 1
+    )
+    if durations is None:
+        error: list[FlatBuffersField] = [None] * (
+            max(FB_ERROR_FIELDS.values()) + 1
+        )
+        error[FB_ERROR_FIELDS["code"]] = ("string", code)
+        error[FB_ERROR_FIELDS["message"]] = ("string", message)
+        result[FB_RESULT_FIELDS["error"]] = ("?", True)
+        result[FB_RESULT_FIELDS["code"]] = ("table", error)
+    else:
+        n_rows, n_cols = durations.shape
+        table: list[FlatBuffersField] = [None] * (
+            max(FB_TABLE_FIELDS.values()) + 1
+        )
+        table[FB_TABLE_FIELDS["durations"]] = (
+            "floats",
+            np.nan_to_num(durations, nan=0).ravel(),
+        )
+        table[FB_TABLE_FIELDS["rows"]] = ("H", min(n_rows, 0xFFFF))
+        table[FB_TABLE_FIELDS["cols"]] = ("H", min(n_cols, 0xFFFF))
+        result[FB_RESULT_FIELDS["table"]] = ("table", table)
+
+    buf = bytearray(4)
+    struct.pack_into("<I", buf, 0, _write_fb_table(buf, result))
+    return bytes(buf)
+
+
+class MockOSRMServer(socketserver.ForkingMixIn, HTTPServer):
+    """
+    Lightweight local stand-in for an OSRM service, used to test and
+    benchmark the travel time calculator without Docker or a real network.
+
+    Implements the Table and Nearest APIs for requests built by
+    TableRequestBuilder. Table durations come from synthetic_durations, as
+    JSON or FlatBuffers depending on the requested format. Nearest requests
+    return the coordinate unchanged. Each connection is
+    served by a forked process, so concurrent requests don't contend for the
+    GIL, as with a multi-threaded OSRM.
+
+    Latency is simulated as a fixed cost per request plus a cost per source
+    and destination, mirroring the one-to-many searches OSRM runs for each
+    table. Table requests that include a failing point return the same
+    error as OSRM does for a point it can't snap, and tables with more than
+    max_table_size pairs fail like OSRM's own table size limit.
+    """
+
+    block_on_close = False
+
+    def __init__(
+        self,
+        host: str = "127.0.0.1",
+        port: int = 0,
+        latency_ms: float = 0,
+        search_ms: float = 0,
+        failing_points: set[str] | None = None,
+        max_table_size: int | None = None,
+        speed_kph: float = 50,
+    ) -> None:
+        super().__init__((host, port), MockOSRMHandler)
+        self.latency_ms = latency_ms
+        self.search_ms = search_ms
+        self.failing_points = failing_points or set()
+        self.max_table_size = max_table_size
+        self.speed_kph = speed_kph
+
+    @property
+    def endpoint(self) -> str:
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def _is_failing(self, lon: np.ndarray, lat: np.ndarray) -> bool:
+        """Check whether any coordinate is one of the failing points."""
+        if not self.failing_points:
+            return False
+        coords = np.char.add(
+            np.char.add(np.round(lon, 6).astype(str), ","),
+            np.round(lat, 6).astype(str),
+        )
+        return not self.failing_points.isdisjoint(coords.tolist())
+
+    def respond(self, path: str) -> tuple[int, dict]:
+        """
+        Answer a request path with an HTTP status code and a response, with
+        any durations as an array.
+        """
+        try:
+            service, lon, lat, sources, destinations = parse_request(path)
+        except ValueError as e:
+            return 400, {"code": "InvalidUrl", "message": str(e)}
+
+        if service == "nearest":
+            location = [round(float(lon[0]), 6), round(float(lat[0]), 6)]
+            return 200, {"code": "Ok", "waypoints": [{"location": location}]}
+
+        time.sleep(
+            (
+                self.latency_ms
+                + self.search_ms * (len(sources) + len(destinations))
+            )
+            / 1000
+        )
+        if self._is_failing(lon, lat):
+            return 400, {
+                "code": "NoSegment",
+                "message": "Could not find a matching segment for coordinate",
+            }
+        if (
+            self.max_table_size is not None
+            and len(sources) * len(destinations) > self.max_table_size
+        ):
+            return 400, {
+                "code": "TooBig",
+                "message": "Too many table coordinates",
+            }
+
+        durations = synthetic_durations(
+            lon[sources],
+            lat[sources],
+            lon[destinations],
+            lat[destinations],
+            speed_kph=self.speed_kph,
+        )
+        return 200, {"code": "Ok", "durations": durations}
+
+
+class MockOSRMHandler(BaseHTTPRequestHandler):
+    """Request handler of MockOSRMServer. Keeps connections alive."""
+
+    protocol_version = "HTTP/1.1"
+    server: MockOSRMServer
+
+    # Headers and body are sent in separate writes. Without TCP_NODELAY,
+    # the body waits for the client to acknowledge the headers, which adds
+    # up to the client's delayed ACK timeout to every keep-alive request
+    disable_nagle_algorithm = True
+
+    # Request URLs can run to megabytes, well past the 64 KB line limit of
+    # the standard library server
+    MAX_REQUEST_LINE_BYTES = 2**27
+
+    def handle_one_request(self) -> None:
+        self.raw_requestline = self.rfile.readline(self.MAX_REQUEST_LINE_BYTES)
+        if not self.raw_requestline:
+            self.close_connection = True
+            return
+        if not self.parse_request():
+            return
+        self.do_GET()
+        self.wfile.flush()
+
+    def do_GET(self) -> None:
+        status, response_data = self.server.respond(self.path)
+        if request_format(self.path) == "flatbuffers":
+            content_type = FLATBUFFERS_CONTENT_TYPE
+            body = (
+                encode_flatbuffers_table(response_data["durations"])
+                if status == 200
+                else encode_flatbuffers_table(
+                    code=response_data["code"],
+                    message=response_data["message"],
+                )
+            )
+        else:
+            content_type = "application/json"
+            body = json.dumps(
+                response_data, default=np.ndarray.tolist
+            ).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args) -> None:
+        pass
+
+
+def serve(**kwargs) -> None:
+    """Run a MockOSRMServer until interrupted. Takes its arguments."""
+    with MockOSRMServer(**kwargs) as server:
+        server.serve_forever()
+
+
+def main() -> None:
+    default = urlsplit(DOCKER_ENDPOINT)
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", type=str, default=default.hostname)
+    parser.add_argument("--port", type=int, default=default.port)
+    parser.add_argument("--latency-ms", type=float, default=0)
+    parser.add_argument("--search-ms", type=float, default=0)
+    parser.add_argument("--max-table-size", type=int)
+    parser.add_argument("--speed-kph", type=float, default=50)
+    parser.add_argument(
+        "--failing-points",
+        type=str,
+        default="",
+        help='Points to fail on, as "lon,lat" separated by semicolons. '
+        "Coordinates must be written as Python floats with up to 6 digits",
+    )
+    args = parser.parse_args()
+    serve(
+        host=args.host,
+        port=args.port,
+        latency_ms=args.latency_ms,
+        search_ms=args.search_ms,
+        failing_points=set(args.failing_points.split(";")) - {""},
+        max_table_size=args.max_table_size,
+        speed_kph=args.speed_kph,
+    )
+
+
+if __name__ == "__main__":
+    main()
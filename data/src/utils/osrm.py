@@ -0,0 +1,580 @@
+import asyncio
+import json
+import struct
+import threading
+from typing import Protocol
+from urllib.parse import parse_qs, quote, unquote, urlsplit
+
+import aiohttp
+import numpy as np
+import pandas as pd
+import requests as r
+from requests.adapters import HTTPAdapter
+from yarl import URL
+
+# Content type of OSRM responses in the FlatBuffers format
+FLATBUFFERS_CONTENT_TYPE = "application/x-flatbuffers"
+
+# Field IDs of the FlatBuffers tables read from OSRM responses. See
+# fbresult.fbs and table.fbs in include/engine/api/flatbuffers/ of
+# osrm-backend
+FB_RESULT_FIELDS = {"error": 0, "code": 1, "table": 5}
+FB_ERROR_FIELDS = {"code": 0, "message": 1}
+FB_TABLE_FIELDS = {"durations": 0, "rows": 1, "cols": 2}
+
+
+class OSRMError(ValueError):
+    """
+    Error response from OSRM, with its error code e.g. "NoSegment" or
+    "TooBig". Transport errors such as timeouts are raised as they are by
+    the HTTP client, so they can be told apart from OSRM rejecting a
+    request.
+    """
+
+    def __init__(self, code: str, message: str) -> None:
+        super().__init__(message)
+        self.code = code
+
+
+def format_coords(lon: np.ndarray, lat: np.ndarray) -> np.ndarray:
+    """
+    Format arrays of longitude and latitude as OSRM coordinate strings in
+    bulk. Uses the shortest round-trip float representation, which matches
+    Python's own f-string formatting of floats.
+
+    Args:
+        lon: Array of longitudes.
+        lat: Array of latitudes.
+
+    Returns:
+        An array of strings in the format "lon,lat".
+    """
+    lon_str = np.asarray(lon, dtype=np.float64).astype(str)
+    lat_str = np.asarray(lat, dtype=np.float64).astype(str)
+    return np.char.add(np.char.add(lon_str, ","), lat_str)
+
+
+def encode_polyline(lat: np.ndarray, lon: np.ndarray) -> str:
+    """
+    Encode integer coordinates using Google's polyline algorithm, fully
+    vectorized. See:
+    https://developers.google.com/maps/documentation/utilities/polylinealgorithm
+
+    Args:
+        lat: Array of latitudes, already scaled to integers by the precision
+            of the polyline (e.g. 1e5 or 1e6).
+        lon: Array of longitudes, scaled the same way.
+
+    Returns:
+        The encoded polyline string.
+    """
+    values = np.column_stack([lat, lon]).astype(np.int64)
+    deltas = np.diff(values, axis=0, prepend=np.zeros((1, 2), np.int64))
+    deltas = deltas.ravel()
+    shifted = np.where(deltas < 0, ~(deltas << 1), deltas << 1)
+
+    # Split each value into 5-bit chunks, smallest first. Every chunk except
+    # the last gets a continuation bit, then all are offset by 63 into the
+    # printable ASCII range
+    shifts = np.arange(0, 35, 5)
+    chunks = (shifted[:, None] >> shifts) & 0x1F
+    n_chunks = np.maximum(1, ((shifted[:, None] >> shifts) > 0).sum(axis=1))
+    positions = np.arange(len(shifts))[None, :]
+    chunks |= np.where(positions < (n_chunks - 1)[:, None], 0x20, 0)
+    chunks += 63
+    mask = positions < n_chunks[:, None]
+    return chunks[mask].astype(np.uint8).tobytes().decode("ascii")
+
+
+def decode_polyline(polyline: str) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Decode a polyline string into integer coordinates, fully vectorized. The
+    inverse of encode_polyline.
+
+    Args:
+        polyline: The encoded polyline string.
+
+    Returns:
+        A tuple of arrays of latitudes and longitudes, still scaled by the
+        precision of the polyline.
+    """
+    chunks = np.frombuffer(polyline.encode("ascii"), dtype=np.uint8)
+    chunks = chunks.astype(np.int64) - 63
+
+    # Each value ends at the first chunk without a continuation bit. Shift
+    # every chunk into place within its value and sum them
+    ends = np.flatnonzero((chunks & 0x20) == 0)
+    starts = np.concatenate([[0], ends[:-1] + 1])
+    positions = np.arange(len(chunks)) - np.repeat(starts, ends - starts + 1)
+    values = np.add.reduceat((chunks & 0x1F) << (5 * positions), starts)
+    deltas = np.where(values & 1, ~(values >> 1), values >> 1)
+    coords = np.cumsum(deltas.reshape(-1, 2), axis=0)
+    return coords[:, 0], coords[:, 1]
+
+
+def _fb_field(buf: bytes, table_pos: int, field_id: int) -> int | None:
+    """Position of a field of a FlatBuffers table, or None if it's unset."""
+    vtable_pos = table_pos - struct.unpack_from("<i", buf, table_pos)[0]
+    vtable_size = struct.unpack_from("<H", buf, vtable_pos)[0]
+    entry_pos = 4 + 2 * field_id
+    if entry_pos >= vtable_size:
+        return None
+    offset = struct.unpack_from("<H", buf, vtable_pos + entry_pos)[0]
+    return table_pos + offset if offset else None
+
+
+def _fb_deref(buf: bytes, pos: int) -> int:
+    """Follow the offset stored at a position of a FlatBuffers buffer."""
+    return pos + struct.unpack_from("<I", buf, pos)[0]
+
+
+def _fb_string(buf: bytes, field_pos: int | None) -> str:
+    """Read the string referenced by a FlatBuffers field."""
+    if field_pos is None:
+        return ""
+    pos = _fb_deref(buf, field_pos)
+    length = struct.unpack_from("<I", buf, pos)[0]
+    return buf[pos + 4 : pos + 4 + length].decode()
+
+
+def decode_flatbuffers_table(body: bytes) -> dict:
+    """
+    Decode a Table API response in OSRM's FlatBuffers format. Only the few
+    offsets leading to the durations are read, and the durations themselves
+    are mapped straight from the response body into a NumPy array, so no
+    Python object is built per cell.
+
+    Args:
+        body: Raw response body.
+
+    Returns:
+        A dict like the parsed JSON response, except that the durations are
+        a flat, read-only float32 array (row-major, one row per source) and
+        "format" is set to "flatbuffers". Unlike JSON, where they are null,
+        OSRM writes pairs without a route as 0, so they can't be told apart
+        from 0-second routes.
+
+    Raises:
+        OSRMError: If the response is an error.
+        ValueError: If the response has no durations.
+    """
+    root = _fb_deref(body, 0)
+    error_pos = _fb_field(body, root, FB_RESULT_FIELDS["error"])
+    if error_pos is not None and body[error_pos]:
+        code_pos = _fb_field(body, root, FB_RESULT_FIELDS["code"])
+        if code_pos is None:
+            raise OSRMError("", "Unknown error")
+        error = _fb_deref(body, code_pos)
+        raise OSRMError(
+            _fb_string(body, _fb_field(body, error, FB_ERROR_FIELDS["code"])),
+            _fb_string(
+                body, _fb_field(body, error, FB_ERROR_FIELDS["message"])
+            ),
+        )
+
+    table_pos = _fb_field(body, root, FB_RESULT_FIELDS["table"])
+    durations_pos = (
+        _fb_field(
+            body, _fb_deref(body, table_pos), FB_TABLE_FIELDS["durations"]
+        )
+        if table_pos is not None
+        else None
+    )
+    if durations_pos is None:
+        raise ValueError("Response has no durations")
+    vector_pos = _fb_deref(body, durations_pos)
+    n_cells = struct.unpack_from("<I", body, vector_pos)[0]
+    durations = np.frombuffer(
+        body, dtype="<f4", count=n_cells, offset=vector_pos + 4
+    )
+    return {"code": "Ok", "durations": durations, "format": "flatbuffers"}
+
+
+def format_indices(indices: np.ndarray, n_coords: int) -> str:
+    """
+    Format coordinate indices for the sources/destinations parameters of a
+    Table API request. OSRM doesn't accept index ranges, but it does accept
+    "all" when the indices are exactly every coordinate in order.
+    """
+    if len(indices) == n_coords and np.array_equal(
+        indices, np.arange(n_coords)
+    ):
+        return "all"
+    return ";".join(indices.astype(str).tolist())
+
+
+def parse_request(
+    path: str,
+) -> tuple[str, np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Parse the path of an OSRM Table or Nearest API request, as built by
+    TableRequestBuilder. Used by the services that stand in for OSRM.
+
+    Args:
+        path: Request path and query string, starting from the service
+            name e.g. "/table/v1/car/...".
+
+    Returns:
+        A tuple of the service name, the longitudes and latitudes of the
+        coordinates, and the indices of the coordinates used as sources and
+        as destinations.
+
+    Raises:
+        ValueError: If the request isn't a Table or Nearest request.
+    """
+    url = urlsplit(path)
+    parts = url.path.strip("/").split("/")
+    if len(parts) != 4 or parts[0] not in ["table", "nearest"]:
+        raise ValueError(f"Unsupported request: {url.path[:100]}")
+
+    coords = unquote(parts[3]).removesuffix(".flatbuffers")
+    coords = coords.removesuffix(".json")
+    if coords.startswith("polyline"):
+        encoding, polyline = coords.rstrip(")").split("(", 1)
+        scale = 10 ** (5 if encoding == "polyline" else 6)
+        lat_int, lon_int = decode_polyline(polyline)
+        lon, lat = lon_int / scale, lat_int / scale
+    else:
+        lon_lat = np.array(
+            [coord.split(",") for coord in coords.split(";")],
+            dtype=np.float64,
+        )
+        lon, lat = lon_lat[:, 0], lon_lat[:, 1]
+
+    query = parse_qs(url.query)
+    indices = []
+    for param in ["sources", "destinations"]:
+        value = query.get(param, ["all"])[0]
+        indices.append(
+            np.arange(len(lon))
+            if value == "all"
+            else np.array(value.split(";"), dtype=np.int64)
+        )
+    return parts[0], lon, lat, indices[0], indices[1]
+
+
+def request_format(path: str) -> str:
+    """Response format of an OSRM request, either 'json' or 'flatbuffers'."""
+    return (
+        "flatbuffers"
+        if urlsplit(path).path.endswith(".flatbuffers")
+        else "json"
+    )
+
+
+class TableRequestBuilder:
+    """
+    Class to build OSRM Table API requests for blocks of origins and
+    destinations.
+
+    Coordinates are prepared once for every input point and then reused by
+    each block, so building a request is only a slice, a de-duplication, and
+    a string join (or a vectorized polyline encoding).
+
+    Coordinates can be sent as plain "lon,lat" text or encoded as a
+    polyline with 5 or 6 digits of precision, which shrinks request URLs
+    several times over. Snapped coordinates come back from OSRM with 6
+    digits of precision, so "polyline6" is lossless for them.
+
+    Responses can be requested as JSON or in OSRM's binary FlatBuffers
+    format, which decode_flatbuffers_table reads without parsing the
+    durations. The travel time calculators always use JSON: FlatBuffers
+    responses write pairs without a route as 0, and OSRM's schema has no
+    field that tells them apart from real 0-second routes.
+    """
+
+    VALID_ENCODINGS = ["text", "polyline", "polyline6"]
+    VALID_RESPONSE_FORMATS = ["json", "flatbuffers"]
+
+    def __init__(
+        self,
+        mode: str,
+        origins: pd.DataFrame,
+        destinations: pd.DataFrame,
+        lon_col: str = "lon",
+        lat_col: str = "lat",
+        encoding: str = "text",
+        response_format: str = "json",
+    ) -> None:
+        if encoding not in self.VALID_ENCODINGS:
+            raise ValueError(
+                f"Invalid encoding, must be one of: {self.VALID_ENCODINGS}"
+            )
+        if response_format not in self.VALID_RESPONSE_FORMATS:
+            raise ValueError(
+                "Invalid response_format, must be one of: "
+                f"{self.VALID_RESPONSE_FORMATS}"
+            )
+        self.mode = mode
+        self.encoding = encoding
+        # Format is given as a suffix of the coordinates. JSON is the default
+        self.format_suffix = (
+            ".flatbuffers" if response_format == "flatbuffers" else ""
+        )
+
+        # Keys used to de-duplicate coordinates. For text, these are the
+        # coordinate strings themselves. For polylines, they are the scaled
+        # integer coordinates packed into a single int64
+        self.origin_keys: np.ndarray
+        self.destination_keys: np.ndarray
+        self.origin_ints: np.ndarray
+        self.destination_ints: np.ndarray
+        if encoding == "text":
+            self.origin_keys = format_coords(
+                origins[lon_col].to_numpy(), origins[lat_col].to_numpy()
+            )
+            self.destination_keys = format_coords(
+                destinations[lon_col].to_numpy(),
+                destinations[lat_col].to_numpy(),
+            )
+        else:
+            self.precision = 5 if encoding == "polyline" else 6
+            self.origin_ints = self._scale_coords(
+                origins[lon_col].to_numpy(), origins[lat_col].to_numpy()
+            )
+            self.destination_ints = self._scale_coords(
+                destinations[lon_col].to_numpy(),
+                destinations[lat_col].to_numpy(),
+            )
+            self.origin_keys = self._pack_coords(self.origin_ints)
+            self.destination_keys = self._pack_coords(self.destination_ints)
+
+    def _scale_coords(self, lon: np.ndarray, lat: np.ndarray) -> np.ndarray:
+        """Scale coordinates to integers as an (n, 2) array of lat, lon."""
+        scale = 10**self.precision
+        return np.column_stack(
+            [
+                np.round(np.asarray(lat, dtype=np.float64) * scale),
+                np.round(np.asarray(lon, dtype=np.float64) * scale),
+            ]
+        ).astype(np.int64)
+
+    def _pack_coords(self, coords: np.ndarray) -> np.ndarray:
+        """Pack scaled lat, lon pairs into a single non-negative int64."""
+        lat_offset, lon_offset = 90 * 10**6, 180 * 10**6
+        return ((coords[:, 0] + lat_offset) << 29) | (
+            coords[:, 1] + lon_offset
+        )
+
+    def build(
+        self,
+        o_start_idx: int,
+        d_start_idx: int,
+        o_end_idx: int,
+        d_end_idx: int,
+    ) -> str:
+        """
+        Build the path and query string of a Table API request for the block
+        of origins and destinations specified by the indices. See:
+        https://project-osrm.org/docs/v5.5.1/api/#table-service
+
+        Returns:
+            The request path, starting from "/table/v1/".
+        """
+        o_keys = self.origin_keys[o_start_idx:o_end_idx]
+        d_keys = self.destination_keys[d_start_idx:d_end_idx]
+
+        # De-duplicate coordinates shared by origins and destinations. The
+        # inverse maps each origin and destination back to its position in
+        # the unique coordinate list
+        all_keys = np.concatenate([o_keys, d_keys])
+        _, first_idx, inverse = np.unique(
+            all_keys, return_index=True, return_inverse=True
+        )
+
+        # Order unique coordinates by first appearance, so that origins come
+        # first and the sources are usually a plain 0..n range
+        order = np.argsort(first_idx)
+        rank = np.empty_like(order)
+        rank[order] = np.arange(len(order))
+        first_idx = first_idx[order]
+        inverse = rank[inverse]
+
+        if self.encoding == "text":
+            coords = ";".join(all_keys[first_idx].tolist())
+        else:
+            all_ints = np.concatenate(
+                [
+                    self.origin_ints[o_start_idx:o_end_idx],
+                    self.destination_ints[d_start_idx:d_end_idx],
+                ]
+            )[first_idx]
+            polyline = encode_polyline(all_ints[:, 0], all_ints[:, 1])
+            coords = f"{self.encoding}({quote(polyline, safe='')})"
+
+        n_coords = len(first_idx)
+        return (
+            f"/table/v1/{self.mode}/"
+            + coords
+            + self.format_suffix
+            + "?sources="
+            + format_indices(inverse[: len(o_keys)], n_coords)
+            + "&destinations="
+            + format_indices(inverse[len(o_keys) :], n_coords)
+        )
+
+
+class RoutingBackend(Protocol):
+    """
+    Interface of the services used to snap and route points. Requests are
+    OSRM API paths and responses are parsed OSRM JSON, so an in-process
+    backend can stand in for a running OSRM service. Table durations may be
+    returned as a NumPy array instead of nested lists. Clients that receive
+    responses over the network add their size in bytes as response_bytes.
+    """
+
+    def get(self, path: str) -> dict: ...
+
+    def nearest(self, mode: str, coord: str) -> list[float]: ...
+
+    def close(self) -> None: ...
+
+
+class OSRMClient:
+    """
+    Class to send requests to a running OSRM service.
+
+    Each thread gets its own keep-alive session, but all sessions share a
+    single connection pool, so TCP connections are reused across requests
+    and across the worker threads of the travel time calculator.
+    """
+
+    def __init__(
+        self,
+        endpoint: str,
+        pool_size: int,
+        connect_timeout: float,
+        read_timeout: float,
+    ) -> None:
+        self.endpoint = endpoint
+        self.pool_size = pool_size
+        self.timeout = (connect_timeout, read_timeout)
+        self._adapter = HTTPAdapter(
+            pool_connections=1,
+            pool_maxsize=pool_size,
+            pool_block=True,
+        )
+        self._local = threading.local()
+
+    @property
+    def session(self) -> r.Session:
+        """Keep-alive session belonging to the calling thread."""
+        session = getattr(self._local, "session", None)
+        if session is None:
+            session = r.Session()
+            session.mount("http://", self._adapter)
+            session.mount("https://", self._adapter)
+            self._local.session = session
+        return session
+
+    def get(self, path: str) -> dict:
+        """
+        Send a GET request to the OSRM service and return the parsed
+        response. FlatBuffers responses are decoded with
+        decode_flatbuffers_table. Anything else is parsed as JSON, which is
+        also how OSRM answers requests it can't parse.
+
+        Args:
+            path: Request path and query string, starting from the service
+                name e.g. "/table/v1/car/...".
+
+        Raises:
+            OSRMError: If OSRM returns a non-200 status code.
+        """
+        response = self.session.get(self.endpoint + path, timeout=self.timeout)
+        content_type = response.headers.get("Content-Type", "")
+        if content_type.startswith(FLATBUFFERS_CONTENT_TYPE):
+            response_data = decode_flatbuffers_table(response.content)
+        else:
+            response_data = response.json()
+            if response.status_code != 200:
+                raise OSRMError(
+                    response_data.get("code", ""), response_data["message"]
+                )
+        response_data["response_bytes"] = len(response.content)
+        return response_data
+
+    def nearest(self, mode: str, coord: str) -> list[float]:
+        """
+        Snap a single "lon,lat" coordinate string to the OSM network using the
+        OSRM Nearest API.
+
+        Returns:
+            The snapped coordinate as a [lon, lat] list.
+        """
+        response_data = self.get(f"/nearest/v1/{mode}/{coord}")
+        return response_data["waypoints"][0]["location"]
+
+    def close(self) -> None:
+        """Close all pooled connections."""
+        self._adapter.close()
+
+
+class AsyncOSRMClient:
+    """
+    Class to send concurrent requests to a running OSRM service from an
+    asyncio event loop.
+
+    The number of in-flight requests is bounded by a semaphore. Response
+    bodies are decoded in a worker thread after the semaphore is released,
+    so the next request goes out while the previous one is still decoding.
+    Must be used as an async context manager.
+    """
+
+    def __init__(
+        self,
+        endpoint: str,
+        concurrency: int,
+        connect_timeout: float,
+        read_timeout: float,
+    ) -> None:
+        self.endpoint = endpoint
+        self.concurrency = concurrency
+        self.timeout = aiohttp.ClientTimeout(
+            connect=connect_timeout, sock_read=read_timeout
+        )
+        self._session: aiohttp.ClientSession
+        self._semaphore: asyncio.Semaphore
+
+    async def __aenter__(self) -> "AsyncOSRMClient":
+        self._semaphore = asyncio.Semaphore(self.concurrency)
+        self._session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=self.concurrency),
+            timeout=self.timeout,
+        )
+        return self
+
+    async def __aexit__(self, *args) -> None:
+        await self._session.close()
+
+    async def get(self, path: str) -> dict:
+        """
+        Send a GET request to the OSRM service and return the parsed
+        response, decoded like OSRMClient.get.
+
+        Args:
+            path: Request path and query string, starting from the service
+                name e.g. "/table/v1/car/...".
+
+        Raises:
+            OSRMError: If OSRM returns a non-200 status code.
+        """
+        # Coordinates are already URL-safe. Marking the URL as encoded skips
+        # re-quoting what can be a very long string
+        url = URL(self.endpoint + path, encoded=True)
+        async with self._semaphore:
+            async with self._session.get(url) as response:
+                status = response.status
+                content_type = response.headers.get("Content-Type", "")
+                body = await response.read()
+
+        if content_type.startswith(FLATBUFFERS_CONTENT_TYPE):
+            response_data = decode_flatbuffers_table(body)
+        else:
+            response_data = await asyncio.to_thread(json.loads, body)
+            if status != 200:
+                raise OSRMError(
+                    response_data.get("code", ""), response_data["message"]
+                )
+        response_data["response_bytes"] = len(body)
+        return response_data
@@ -0,0 +1,224 @@
+import json
+import os
+import resource
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+from collections.abc import Iterator
+from contextlib import AbstractContextManager, contextmanager, nullcontext
+from pathlib import Path
+from types import FrameType
+
+from utils.logging import create_logger
+
+logger = create_logger(__name__)
+
+# Profiling is enabled by the --profile flag of each script, or by setting
+# this environment variable to anything other than 0 or an empty string
+PROFILE_ENV_VAR = "OPENTIMES_PROFILE"
+
+# Profiler of the current run, used by stage(). Set while a Profiler is open
+_active_profiler: "Profiler | None" = None
+
+
+class StageStats:
+    """Totals of every call to one profiling stage."""
+
+    __slots__ = ("calls", "wall_sec", "cpu_sec", "tracemalloc_peak_bytes")
+
+    def __init__(self) -> None:
+        self.calls = 0
+        self.wall_sec = 0.0
+        self.cpu_sec = 0.0
+        self.tracemalloc_peak_bytes = 0
+
+
+class Profiler:
+    """
+    Class to profile a run of one of the pipeline scripts. Must be used as a
+    context manager around the run. Code inside marks its stages (e.g.
+    loading, snapping, routing, writing) with stage().
+
+    Records for each stage its wall time, CPU time, and the peak memory
+    traced by tracemalloc. Stages can be nested, and a stage entered more
+    than once (e.g. once per chunk) is summed. A background thread also
+    samples the Python stack of every thread at a fixed interval, so
+    threads waiting on I/O or locks show up too. Worker processes aren't
+    sampled.
+
+    On exit, writes a JSON summary and the sampled stacks in the folded
+    format read by flamegraph.pl and speedscope, with each stack prefixed by
+    the stages it was sampled in. tracemalloc slows down code that
+    allocates many small objects, so timings are somewhat inflated.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        output_dir: Path | None = None,
+        interval_sec: float = 0.01,
+    ) -> None:
+        self.name = name
+        self.output_dir = (
+            output_dir
+            if output_dir is not None
+            else Path.cwd() / "output" / "profile"
+        )
+        self.interval_sec = interval_sec
+
+        self.stages: dict[str, StageStats] = {}
+        self.samples: Counter[tuple[str, ...]] = Counter()
+        self._stage_stack: list[str] = []
+        self._stage_peaks: list[int] = []
+        self._run_peak = 0
+        self._stop = threading.Event()
+        self._sampler = threading.Thread(
+            target=self._sample, name="profiler", daemon=True
+        )
+
+    def __enter__(self) -> "Profiler":
+        global _active_profiler
+        tracemalloc.start()
+        self._start_time = time.time()
+        self._start_cpu_time = time.process_time()
+        self._sampler.start()
+        _active_profiler = self
+        return self
+
+    def __exit__(self, *args) -> None:
+        global _active_profiler
+        _active_profiler = None
+        self._stop.set()
+        self._sampler.join()
+        self._update_peaks()
+        tracemalloc.stop()
+        self.write()
+
+    def _update_peaks(self) -> None:
+        """
+        Fold the traced memory peak since the last stage boundary into every
+        open stage, then reset it, so that nested stages each get their own
+        peak.
+        """
+        _, peak = tracemalloc.get_traced_memory()
+        self._run_peak = max(self._run_peak, peak)
+        self._stage_peaks = [max(p, peak) for p in self._stage_peaks]
+        tracemalloc.reset_peak()
+
+    @contextmanager
+    def stage(self, name: str) -> Iterator[None]:
+        """Time a stage of the run. Stages are named by their nesting."""
+        self._update_peaks()
+        self._stage_stack.append(name)
+        self._stage_peaks.append(0)
+        key = "/".join(self._stage_stack)
+        start_time, start_cpu_time = time.time(), time.process_time()
+        try:
+            yield
+        finally:
+            self._update_peaks()
+            stats = self.stages.setdefault(key, StageStats())
+            stats.calls += 1
+            stats.wall_sec += time.time() - start_time
+            stats.cpu_sec += time.process_time() - start_cpu_time
+            stats.tracemalloc_peak_bytes = max(
+                stats.tracemalloc_peak_bytes, self._stage_peaks.pop()
+            )
+            self._stage_stack.pop()
+
+    @staticmethod
+    def _frame_label(frame: FrameType) -> str:
+        """Name a stack frame as module.function, with no spaces."""
+        module = frame.f_globals.get("__name__", "?")
+        return f"{module}.{frame.f_code.co_name}".replace(" ", "_")
+
+    def _sample(self) -> None:
+        """Sample the stacks of all other threads until stopped."""
+        sampler_id = threading.get_ident()
+        while not self._stop.wait(self.interval_sec):
+            stages = tuple(self._stage_stack) or ("(no stage)",)
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == sampler_id:
+                    continue
+                stack: list[str] = []
+                cur_frame: FrameType | None = frame
+                while cur_frame is not None:
+                    stack.append(self._frame_label(cur_frame))
+                    cur_frame = cur_frame.f_back
+                self.samples[stages + tuple(reversed(stack))] += 1
+
+    def summary(self) -> dict:
+        """Get the JSON summary of the run."""
+        leaf_samples: Counter[str] = Counter()
+        for stack, count in self.samples.items():
+            leaf_samples[stack[-1]] += count
+        return {
+            "name": self.name,
+            "argv": sys.argv,
+            "wall_sec": time.time() - self._start_time,
+            "cpu_sec": time.process_time() - self._start_cpu_time,
+            "tracemalloc_peak_bytes": self._run_peak,
+            "max_rss_bytes": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            * 1024,
+            "sample_interval_sec": self.interval_sec,
+            "n_samples": sum(self.samples.values()),
+            "stages": {
+                key: {
+                    "calls": stats.calls,
+                    "wall_sec": stats.wall_sec,
+                    "cpu_sec": stats.cpu_sec,
+                    "tracemalloc_peak_bytes": stats.tracemalloc_peak_bytes,
+                }
+                for key, stats in self.stages.items()
+            },
+            "top_functions": [
+                {"function": function, "samples": count}
+                for function, count in leaf_samples.most_common(20)
+            ],
+        }
+
+    def write(self) -> None:
+        """Write the JSON summary and the folded stacks of the run."""
+        self.output_dir.mkdir(parents=True, exist_ok=True)
+        file_stem = f"{self.name}-{time.strftime('%Y%m%dT%H%M%S')}"
+        summary_file = self.output_dir / f"{file_stem}.json"
+        with open(summary_file, "w") as file:
+            json.dump(self.summary(), file, indent=2)
+        stacks_file = self.output_dir / f"{file_stem}.folded"
+        with open(stacks_file, "w") as file:
+            file.writelines(
+                f"{';'.join(stack)} {count}\n"
+                for stack, count in sorted(self.samples.items())
+            )
+        logger.info("Wrote profile to: %s and %s", summary_file, stacks_file)
+
+
+def profile(name: str, enabled: bool = False) -> AbstractContextManager:
+    """
+    Profile the code run inside the returned context manager, if enabled by
+    the argument or by the PROFILE_ENV_VAR environment variable. Does
+    nothing otherwise.
+
+    Args:
+        name: Name of the run, used for the output files. Must be a valid
+            file name.
+        enabled: Whether to profile, e.g. from a --profile flag.
+    """
+    if enabled or os.getenv(PROFILE_ENV_VAR, "") not in ["", "0"]:
+        return Profiler(name)
+    return nullcontext()
+
+
+@contextmanager
+def stage(name: str) -> Iterator[None]:
+    """
+    Mark a stage of the run for the active profiler. Does nothing when the
+    run isn't profiled. Stages should be entered from the main thread.
+    """
+    if _active_profiler is None:
+        yield
+        return
+    with _active_profiler.stage(name):
+        yield
@@ -0,0 +1,254 @@
+import logging
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from utils.osrm import OSRMError, RoutingBackend, TableRequestBuilder
+
+
+class ReachabilityProbe:
+    """
+    Class to cheaply classify points before table routing by probing each
+    one against a few anchor points.
+
+    Every point gets two bitmasks: which anchors it can reach (to_mask) and
+    which anchors can reach it (from_mask). If an origin can reach a
+    destination, it can also reach every anchor that the destination
+    reaches, and it is reached by every anchor that reaches the origin. Pairs
+    that break either rule can never be routed, so they can go straight to
+    missing pairs. Points that make OSRM fail outright are flagged as bad.
+    Only OSRM errors saying that a point can't be routed count as failures.
+    Any other error, e.g. a timeout, is raised, so that a flaky service
+    never leaves wrong labels in the cache.
+
+    Labels are cached to a Parquet file keyed by coordinates, along with the
+    anchors they were probed against, so later runs for the same mode, year,
+    and state only need to probe new points.
+    """
+
+    LABEL_COLS = ["to_mask", "from_mask", "is_bad"]
+
+    # OSRM error codes returned when a point can't be snapped to or routed
+    # on the network
+    UNREACHABLE_CODES = ["NoSegment", "NoRoute"]
+
+    def __init__(
+        self,
+        client: RoutingBackend,
+        mode: str,
+        n_anchors: int,
+        batch_size: int,
+        logger: logging.Logger,
+        cache_file: Path | None = None,
+        encoding: str = "text",
+    ) -> None:
+        self.client = client
+        self.mode = mode
+        self.n_anchors = n_anchors
+        self.batch_size = batch_size
+        self.logger = logger
+        self.cache_file = cache_file
+        self.encoding = encoding
+        self.n_requests = 0
+
+    def _load_cache(self) -> pd.DataFrame | None:
+        if self.cache_file and self.cache_file.exists():
+            return pd.read_parquet(self.cache_file)
+        return None
+
+    def _save_cache(self, labels: pd.DataFrame) -> None:
+        if self.cache_file:
+            self.cache_file.parent.mkdir(parents=True, exist_ok=True)
+            labels.to_parquet(self.cache_file, engine="pyarrow", index=False)
+
+    def _table_durations(
+        self,
+        builder: TableRequestBuilder,
+        o_start_idx: int,
+        d_start_idx: int,
+        o_end_idx: int,
+        d_end_idx: int,
+    ) -> np.ndarray | None:
+        """
+        Return the durations of a table request as an object array with a
+        row per origin, or None if OSRM can't route one of its points.
+
+        Raises:
+            OSRMError: If OSRM fails for any other reason.
+        """
+        self.n_requests += 1
+        try:
+            response_data = self.client.get(
+                builder.build(o_start_idx, d_start_idx, o_end_idx, d_end_idx)
+            )
+        except OSRMError as e:
+            if e.code in self.UNREACHABLE_CODES:
+                return None
+            raise
+        return np.array(response_data["durations"], dtype=object).reshape(
+            o_end_idx - o_start_idx, d_end_idx - d_start_idx
+        )
+
+    def _select_anchors(self, points: pd.DataFrame) -> pd.DataFrame:
+        """
+        Pick anchors from the points closest to the median coordinate. Each
+        candidate must route to and from a different point: the next closest
+        candidate for the first anchor, then every anchor picked so far. This
+        rules out bad points and points stranded on a small island of the
+        network.
+        """
+        median = points[["lon", "lat"]].median()
+        distance = (points["lon"] - median["lon"]) ** 2 + (
+            points["lat"] - median["lat"]
+        ) ** 2
+        candidates = points.loc[distance.sort_values().index].reset_index(
+            drop=True
+        )
+
+        anchor_idx: list[int] = []
+        for i in range(len(candidates) - 1):
+            others = anchor_idx or [i + 1]
+            group = candidates.iloc[[i, *others]]
+            builder = TableRequestBuilder(
+                self.mode, group, group, encoding=self.encoding
+            )
+            durations = self._table_durations(
+                builder, 0, 0, len(group), len(group)
+            )
+            if (
+                durations is not None
+                and not pd.isnull(durations[0, 1:]).any()
+                and not pd.isnull(durations[1:, 0]).any()
+            ):
+                anchor_idx.append(i)
+            if len(anchor_idx) == self.n_anchors:
+                break
+
+        if not anchor_idx:
+            raise ValueError("No routable anchor points found")
+        return candidates.iloc[anchor_idx].reset_index(drop=True)
+
+    def _probe_batch(
+        self,
+        to_builder: TableRequestBuilder,
+        from_builder: TableRequestBuilder,
+        start_idx: int,
+        end_idx: int,
+        labels: dict[str, np.ndarray],
+    ) -> None:
+        """
+        Probe a batch of points against all anchors in both directions. If
+        either request fails, the batch is split in half until the bad
+        points are isolated.
+        """
+        n_anchors = len(from_builder.origin_keys)
+        to_anchors = self._table_durations(
+            to_builder, start_idx, 0, end_idx, n_anchors
+        )
+        from_anchors = (
+            self._table_durations(
+                from_builder, 0, start_idx, n_anchors, end_idx
+            )
+            if to_anchors is not None
+            else None
+        )
+
+        if to_anchors is None or from_anchors is None:
+            if end_idx - start_idx <= 1:
+                labels["is_bad"][start_idx] = True
+                return
+            mid_idx = (start_idx + end_idx) // 2
+            for s, e in [(start_idx, mid_idx), (mid_idx, end_idx)]:
+                self._probe_batch(to_builder, from_builder, s, e, labels)
+            return
+
+        bits = np.left_shift(1, np.arange(n_anchors))
+        to_reached = ~pd.isnull(to_anchors)
+        from_reached = ~pd.isnull(from_anchors).T
+        labels["to_mask"][start_idx:end_idx] = to_reached.astype(int) @ bits
+        labels["from_mask"][start_idx:end_idx] = (
+            from_reached.astype(int) @ bits
+        )
+
+    def label(self, points: pd.DataFrame) -> pd.DataFrame:
+        """
+        Label points with their reachability masks, probing only the points
+        that aren't already in the cache.
+
+        Args:
+            points: DataFrame of unique coordinates with 'lon' and 'lat'
+                columns, in the form they will be sent to OSRM.
+
+        Returns:
+            The input points with to_mask, from_mask, and is_bad columns.
+        """
+        points = points[["lon", "lat"]].reset_index(drop=True)
+        cache = self._load_cache()
+        if cache is None and len(points) < 2:
+            # Anchors are checked against another point, so a lone point is
+            # left unlabeled and routed as usual
+            return points.assign(to_mask=0, from_mask=0, is_bad=False)
+        if cache is not None:
+            anchors = cache.loc[cache["is_anchor"], ["lon", "lat"]]
+            anchors = anchors.reset_index(drop=True)
+            known = cache.loc[~cache["is_anchor"]]
+        else:
+            anchors = self._select_anchors(points)
+            known = pd.DataFrame(
+                columns=["lon", "lat", *self.LABEL_COLS, "is_anchor"]
+            )
+
+        new_points = (
+            points.merge(
+                known[["lon", "lat"]],
+                on=["lon", "lat"],
+                how="left",
+                indicator=True,
+            )
+            .query("_merge == 'left_only'")
+            .drop(columns="_merge")
+            .reset_index(drop=True)
+        )
+
+        if len(new_points):
+            self.logger.info(
+                "Probing reachability of %s points against %s anchors",
+                len(new_points),
+                len(anchors),
+            )
+            new_labels = {
+                "to_mask": np.zeros(len(new_points), dtype=np.int64),
+                "from_mask": np.zeros(len(new_points), dtype=np.int64),
+                "is_bad": np.zeros(len(new_points), dtype=bool),
+            }
+            to_builder = TableRequestBuilder(
+                self.mode, new_points, anchors, encoding=self.encoding
+            )
+            from_builder = TableRequestBuilder(
+                self.mode, anchors, new_points, encoding=self.encoding
+            )
+            for start_idx in range(0, len(new_points), self.batch_size):
+                end_idx = min(start_idx + self.batch_size, len(new_points))
+                self._probe_batch(
+                    to_builder, from_builder, start_idx, end_idx, new_labels
+                )
+
+            new_points = new_points.assign(**new_labels, is_anchor=False)
+            anchor_rows = anchors.assign(
+                to_mask=0, from_mask=0, is_bad=False, is_anchor=True
+            )
+            known = pd.concat(
+                [df for df in [known, new_points] if len(df)],
+                ignore_index=True,
+            )
+            self._save_cache(
+                pd.concat([anchor_rows, known], ignore_index=True)
+            )
+
+        labels = points.merge(
+            known[["lon", "lat", *self.LABEL_COLS]],
+            on=["lon", "lat"],
+            how="left",
+        )
+        return labels
@@ -0,0 +1,54 @@
+from multiprocessing.shared_memory import SharedMemory
+
+import numpy as np
+
+# Name, dtype, and shape of each shared array, enough for another process
+# to attach to it
+SharedArraySpecs = dict[str, tuple[str, str, tuple[int, ...]]]
+
+
+class SharedArrays:
+    """
+    Class to share read-only NumPy arrays with worker processes through
+    shared memory, so they're copied once rather than pickled with every
+    task. Must be used as a context manager by the process that creates the
+    arrays, which frees the memory on exit. Workers attach with attach().
+    """
+
+    def __init__(self, arrays: dict[str, np.ndarray]) -> None:
+        self.arrays = arrays
+        self._blocks: list[SharedMemory] = []
+        self.specs: SharedArraySpecs = {}
+
+    def __enter__(self) -> "SharedArrays":
+        for key, array in self.arrays.items():
+            array = np.ascontiguousarray(array)
+            block = SharedMemory(create=True, size=max(array.nbytes, 1))
+            self._blocks.append(block)
+            np.ndarray(array.shape, array.dtype, buffer=block.buf)[:] = array
+            self.specs[key] = (block.name, array.dtype.str, array.shape)
+        return self
+
+    def __exit__(self, *args) -> None:
+        for block in self._blocks:
+            block.close()
+            block.unlink()
+        self._blocks = []
+
+    @staticmethod
+    def attach(
+        specs: SharedArraySpecs,
+    ) -> tuple[dict[str, np.ndarray], list[SharedMemory]]:
+        """
+        Attach to arrays shared by another process.
+
+        Returns:
+            The arrays by name, and their shared memory blocks, which must be
+            kept referenced for as long as the arrays are used.
+        """
+        arrays, blocks = {}, []
+        for key, (name, dtype, shape) in specs.items():
+            block = SharedMemory(name=name)
+            blocks.append(block)
+            arrays[key] = np.ndarray(shape, np.dtype(dtype), buffer=block.buf)
+        return arrays, blocks
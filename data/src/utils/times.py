@@ -1,19 +1,53 @@
 import argparse
+import asyncio
+import copy
+import hashlib
+import json
 import logging
+import multiprocessing
 import os
 import re
+import threading
 import time
-from concurrent.futures import ThreadPoolExecutor
+from collections import defaultdict, deque
+from collections.abc import Callable, Generator, Iterable, Iterator
+from concurrent.futures import (
+    Executor,
+    Future,
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+)
+from contextlib import AbstractContextManager, contextmanager
 from pathlib import Path
 from typing import Any, Literal
 
+import fsspec
+import numpy as np
 import pandas as pd
-import requests as r
-
-from utils.constants import DOCKER_ENDPOINT
+import pyarrow as pa
+import pyarrow.parquet as pq
+from scipy.spatial import cKDTree
+
+from utils.block_size import BlockSizeController, is_resource_error
+from utils.checkpoint import BlockCheckpoint
+from utils.constants import DOCKER_ENDPOINT, EARTH_RADIUS_M
+from utils.graph import MODE_SPEEDS_KPH, GraphRouter
+from utils.logging import create_logger
+from utils.osrm import (
+    AsyncOSRMClient,
+    OSRMClient,
+    RoutingBackend,
+    TableRequestBuilder,
+    format_coords,
+)
+from utils.profiling import stage
+from utils.reachability import ReachabilityProbe
+from utils.shared import SharedArrays, SharedArraySpecs
 from utils.utils import (
-    create_empty_df,
     format_time,
+    hilbert_index,
+    read_parquet_rows,
+    sphere_coords,
 )
 
 
@@ -33,11 +67,17 @@ class TravelTimeArgs:
         self.centroid_type: str
         self.chunk: str | None
         self.write_to_s3: bool
+        self.engine: str = "thread"
+        self.backend: str = "osrm"
+        self.concurrency: int | None = None
+        self.stream: bool = False
 
         self._args_to_attr(args)
         self._validate_mode(params, self.mode)
         self._validate_centroid_type(self.centroid_type)
         self._validate_chunk(self.chunk)
+        self._validate_engine(self.engine)
+        self._validate_backend(self.backend, self.engine)
 
     def _args_to_attr(self, args: argparse.Namespace) -> None:
         for k, v in vars(args).items():
@@ -56,6 +96,24 @@ class TravelTimeArgs:
                 f"of: {valid_centroid_types}"
             )
 
+    def _validate_engine(self, engine: str) -> None:
+        valid_engines = ["thread", "async", "process"]
+        if engine not in valid_engines:
+            raise ValueError(
+                f"Invalid engine, must be one of: {valid_engines}"
+            )
+
+    def _validate_backend(self, backend: str, engine: str) -> None:
+        valid_backends = ["osrm", "graph"]
+        if backend not in valid_backends:
+            raise ValueError(
+                f"Invalid backend, must be one of: {valid_backends}"
+            )
+        if backend == "graph" and engine != "thread":
+            raise ValueError(
+                "The graph backend only supports the thread engine"
+            )
+
     def _validate_chunk(self, chunk: str | None) -> None:
         if chunk and not re.match(r"^\d+-\d+_\d+-\d+$", chunk):
             raise ValueError(
@@ -136,6 +194,40 @@ class TravelTimePaths:
             else "part-0.parquet"
         )
 
+    @property
+    def reachability_file(self) -> Path:
+        """
+        Cache of pre-flight reachability labels. Shared by all geographies
+        and centroid types of a mode, year, and state.
+        """
+        return Path(
+            Path.cwd(),
+            "intermediate/reachability",
+            f"mode={self.args.mode}/year={self.args.year}",
+            f"state={self.args.state}",
+            "reachability.parquet",
+        )
+
+    @property
+    def checkpoint_dir(self) -> Path:
+        """Block checkpoint of the current chunk of a times calculation."""
+        return Path(
+            Path.cwd(),
+            "intermediate/checkpoints",
+            self._output_path,
+            f"chunk={self.args.chunk if self.args.chunk else 'all'}",
+        )
+
+    @property
+    def network_file(self) -> Path:
+        """OSM extract of the state, used by the graph routing backend."""
+        return Path(
+            Path.cwd(),
+            "intermediate/osmextract",
+            f"year={self.args.year}/geography=state/state={self.args.state}",
+            f"{self.args.state}.osm.pbf",
+        )
+
     def _setup_paths(self) -> None:
         """Sets up all input and output paths."""
         self.input = self._create_input_paths()
@@ -213,29 +305,81 @@ class TravelTimePaths:
             path = self.input["files"][f"{dataset}_file"]
         return str(path) if location == "s3" else path
 
+    @contextmanager
+    def open_parquet_writer(
+        self, dataset: str, schema: pa.Schema, location: str = "local"
+    ) -> Iterator[pq.ParquetWriter]:
+        """
+        Open a Parquet writer for an output file. Each batch written becomes
+        one or more row groups, so batches should be written in sorted order.
+
+        Args:
+            dataset: The dataset name (e.g., 'times', 'origins', 'metadata').
+            schema: Arrow schema of the batches that will be written.
+            location: Either 'local' or 's3'.
+        """
+        path = self.get_path(dataset, path_type="output", location=location)
+        with fsspec.open(
+            str(path), "wb", **self.storage_options[location]
+        ) as file:
+            with pq.ParquetWriter(
+                file,
+                schema,
+                compression=self.compression_type,
+                compression_level=self.compression_level,
+            ) as writer:
+                yield writer
+
     def write_to_parquet(
-        self, df: pd.DataFrame, dataset: str, location: str = "local"
+        self,
+        data: pd.DataFrame | Iterable[pa.RecordBatch],
+        dataset: str,
+        location: str = "local",
+        schema: pa.Schema | None = None,
     ) -> None:
         """
-        Write a DataFrame to an output Parquet file.
+        Write a DataFrame or a stream of Arrow record batches to an output
+        Parquet file. Streams are written batch by batch, so they never need
+        to be held in memory all at once.
 
         Args:
+            data: A DataFrame or an iterable of record batches.
             dataset: The dataset name (e.g., 'times', 'origins', 'metadata').
             location: Either 'local' or 's3'.
+            schema: Schema of the record batches. Required if the stream
+                may be empty, otherwise taken from the first batch.
         """
-        df.to_parquet(
-            self.get_path(dataset, path_type="output", location=location),
-            engine="pyarrow",
-            compression=self.compression_type,
-            compression_level=self.compression_level,
-            index=False,
-            storage_options=self.storage_options[location],
-        )
+        if isinstance(data, pd.DataFrame):
+            data.to_parquet(
+                self.get_path(dataset, path_type="output", location=location),
+                engine="pyarrow",
+                compression=self.compression_type,
+                compression_level=self.compression_level,
+                index=False,
+                storage_options=self.storage_options[location],
+            )
+            return
+
+        batches = iter(data)
+        first_batch = next(batches, None)
+        if schema is None:
+            if first_batch is None:
+                raise ValueError("Cannot infer schema from an empty stream")
+            schema = first_batch.schema
+
+        with self.open_parquet_writer(dataset, schema, location) as writer:
+            if first_batch is not None:
+                writer.write_batch(first_batch)
+            for batch in batches:
+                writer.write_batch(batch)
 
 
 class TravelTimeInputs:
     """
     Class to hold input data and chunk settings for travel time calculations.
+    Origins and destinations are subset to the chunk, unless the number of
+    points before subsetting is given, meaning they were loaded already
+    subset.
     """
 
     def __init__(
@@ -245,13 +389,22 @@ class TravelTimeInputs:
         chunk: str | None,
         max_split_size_origins: int,
         max_split_size_destinations: int,
+        n_origins_full: int | None = None,
+        n_destinations_full: int | None = None,
     ) -> None:
         self.origins = origins
         self.destinations = destinations
 
         # "full" is the original (before chunk subsetting) number of origins
-        self.n_origins_full: int = len(self.origins)
-        self.n_destinations_full: int = len(self.destinations)
+        self._is_subset = n_origins_full is not None
+        self.n_origins_full: int = (
+            n_origins_full if n_origins_full is not None else len(origins)
+        )
+        self.n_destinations_full: int = (
+            n_destinations_full
+            if n_destinations_full is not None
+            else len(destinations)
+        )
 
         self.chunk = chunk
         self.o_chunk_start_idx: int
@@ -273,29 +426,48 @@ class TravelTimeInputs:
             max_split_size_destinations, self.d_chunk_size
         )
 
+        # Time spent snapping the points to the OSM network, set by
+        # TravelTimeConfig.snap_inputs. Stays 0 if the points aren't snapped
+        self.snap_time_sec: float = 0.0
+
+    @staticmethod
+    def parse_chunk(chunk: str) -> tuple[int, int, int, int]:
+        """
+        Parse a chunk string into the origin start and end indices, then the
+        destination start and end indices.
+        """
+        o_chunk, d_chunk = chunk.split("_")
+        o_chunk_start_idx, o_chunk_end_idx = o_chunk.split("-")
+        d_chunk_start_idx, d_chunk_end_idx = d_chunk.split("-")
+        return (
+            int(o_chunk_start_idx),
+            int(o_chunk_end_idx),
+            int(d_chunk_start_idx),
+            int(d_chunk_end_idx),
+        )
+
     def _set_chunk_attributes(self) -> None:
         """Sets the origin chunk indices given the input chunk string."""
         if self.chunk:
-            o_chunk, d_chunk = self.chunk.split("_")
-            o_chunk_start_idx, o_chunk_end_idx = o_chunk.split("-")
-            d_chunk_start_idx, d_chunk_end_idx = d_chunk.split("-")
-            self.o_chunk_start_idx = int(o_chunk_start_idx)
-            self.o_chunk_end_idx = int(o_chunk_end_idx)
-            self.o_chunk_size = int(o_chunk_end_idx) - int(o_chunk_start_idx)
-            self.d_chunk_start_idx = int(d_chunk_start_idx)
-            self.d_chunk_end_idx = int(d_chunk_end_idx)
-            self.d_chunk_size = int(d_chunk_end_idx) - int(d_chunk_start_idx)
+            (
+                self.o_chunk_start_idx,
+                self.o_chunk_end_idx,
+                self.d_chunk_start_idx,
+                self.d_chunk_end_idx,
+            ) = self.parse_chunk(self.chunk)
+            self.o_chunk_size = self.o_chunk_end_idx - self.o_chunk_start_idx
+            self.d_chunk_size = self.d_chunk_end_idx - self.d_chunk_start_idx
 
     def _subset_origins(self) -> None:
         """Sets the origins chunk (if chunk is specified)."""
-        if self.chunk:
+        if self.chunk and not self._is_subset:
             self.origins = self.origins.iloc[
                 self.o_chunk_start_idx : self.o_chunk_end_idx
             ]
 
     def _subset_destinations(self) -> None:
         """Sets the destinations chunk (if chunk is specified)."""
-        if self.chunk:
+        if self.chunk and not self._is_subset:
             self.destinations = self.destinations.iloc[
                 self.d_chunk_start_idx : self.d_chunk_end_idx
             ]
@@ -311,6 +483,7 @@ class TravelTimeConfig:
         "weighted": {"geoid": "id", "x_4326_wt": "lon", "y_4326_wt": "lat"},
         "unweighted": {"geoid": "id", "x_4326": "lon", "y_4326": "lat"},
     }
+    VALID_GRAPH_NETWORKS = ["osm", "grid"]
 
     def __init__(
         self,
@@ -319,6 +492,7 @@ class TravelTimeConfig:
         logger: logging.Logger,
         ncpu: int | None = None,
         verbose: bool = False,
+        client: RoutingBackend | None = None,
     ) -> None:
         self.args = TravelTimeArgs(args, params)
         self.params = params
@@ -334,20 +508,140 @@ class TravelTimeConfig:
         self.ncpu = ncpu if ncpu else os.cpu_count()
         self.verbose = verbose
 
-    def _load_od_file(self, path: str) -> pd.DataFrame:
-        """Load an origins or destinations file and prep for routing."""
-        df = (
-            pd.read_parquet(self.paths.get_path(path, path_type="input"))
-            .loc[:, list(self.OD_COLS[self.args.centroid_type].keys())]
-            .rename(columns=self.OD_COLS[self.args.centroid_type])
-            .sort_values(by="id")
+        # Shared client used for both snapping and routing. Either a running
+        # OSRM service or an in-process graph router. Can be passed in to
+        # share it between the configs of several jobs
+        self.client: RoutingBackend = (
+            client if client is not None else self._create_client()
+        )
+
+    def _create_client(self) -> RoutingBackend:
+        """Create the routing backend selected by the backend argument."""
+        if self.args.backend == "osrm":
+            # The connection pool is sized so each routing thread can keep
+            # its own connection alive
+            return OSRMClient(
+                endpoint=DOCKER_ENDPOINT,
+                pool_size=self.ncpu,
+                connect_timeout=self.params["times"]["connect_timeout_sec"],
+                read_timeout=self.params["times"]["read_timeout_sec"],
+            )
+
+        start_time = time.time()
+        graph_params = self.params["times"]["graph_backend"]
+        if graph_params["network"] not in self.VALID_GRAPH_NETWORKS:
+            raise ValueError(
+                "Invalid graph_backend network, must be one of: "
+                f"{self.VALID_GRAPH_NETWORKS}"
+            )
+        if graph_params["network"] == "osm":
+            router = GraphRouter.from_osm(
+                self.paths.network_file,
+                mode=self.args.mode,
+                batch_size=graph_params["batch_size"],
+            )
+        else:
+            # The grid covers every input point, plus some margin so that
+            # points on the edge still snap to a nearby node
+            points = pd.concat(
+                [
+                    self._load_od_file("origins")[0],
+                    self._load_od_file("destinations")[0],
+                ]
+            )
+            margin = 0.01
+            router = GraphRouter.from_grid(
+                bounds=(
+                    points["lon"].min() - margin,
+                    points["lat"].min() - margin,
+                    points["lon"].max() + margin,
+                    points["lat"].max() + margin,
+                ),
+                spacing_m=graph_params["grid_spacing_m"],
+                speed_kph=MODE_SPEEDS_KPH[self.args.mode]["residential"],
+                batch_size=graph_params["batch_size"],
+            )
+
+        self.logger.info(
+            "Built %s graph with %s nodes and %s edges in %s",
+            graph_params["network"],
+            router.n_nodes,
+            router.n_edges,
+            format_time(time.time() - start_time),
+        )
+        return router
+
+    def _load_od_file(
+        self,
+        path: str,
+        start_idx: int | None = None,
+        end_idx: int | None = None,
+    ) -> tuple[pd.DataFrame, int]:
+        """
+        Load an origins or destinations file and prep for routing. Only
+        reads the needed columns and, if given, the range of rows (in GEOID
+        order) of a chunk.
+
+        Returns:
+            The points, and the total number of rows of the file.
+        """
+        columns = self.OD_COLS[self.args.centroid_type]
+        df, n_rows = read_parquet_rows(
+            self.paths.get_path(path, path_type="input"),
+            columns=list(columns.keys()),
+            sort_by="geoid",
+            start_idx=start_idx,
+            end_idx=end_idx,
+        )
+        return df.rename(columns=columns), n_rows
+
+    def load_od_files(self) -> tuple[pd.DataFrame, pd.DataFrame]:
+        """Load the default origins and destinations of every chunk."""
+        return (
+            self._load_od_file("origins")[0],
+            self._load_od_file("destinations")[0],
         )
-        return df
 
-    def load_default_inputs(self, snap: bool = True) -> TravelTimeInputs:
-        """Load default origins/destinations and optionally snap them."""
-        origins = self._load_od_file("origins")
-        destinations = self._load_od_file("destinations")
+    def load_default_inputs(
+        self,
+        snap: bool = True,
+        od_points: tuple[pd.DataFrame, pd.DataFrame] | None = None,
+        snap_cache: dict[str, list[float]] | None = None,
+    ) -> TravelTimeInputs:
+        """
+        Load default origins/destinations and optionally snap them.
+
+        Args:
+            snap: Snap the points of the chunk to the OSM network.
+            od_points: Origins and destinations from load_od_files, to reuse
+                for several chunks. Loaded from the input files if None.
+            snap_cache: Snapped coordinates by "lon,lat" string. Points
+                already in it aren't snapped again, and new ones are added.
+        """
+        if od_points is not None:
+            # Points shared between chunks are subset in memory
+            origins, destinations = od_points
+            n_full: dict[str, int | None] = {}
+        else:
+            # Otherwise only the rows of the chunk are read
+            o_start_idx: int | None = None
+            o_end_idx: int | None = None
+            d_start_idx: int | None = None
+            d_end_idx: int | None = None
+            if self.args.chunk:
+                o_start_idx, o_end_idx, d_start_idx, d_end_idx = (
+                    TravelTimeInputs.parse_chunk(self.args.chunk)
+                )
+            origins, n_origins_full = self._load_od_file(
+                "origins", o_start_idx, o_end_idx
+            )
+            destinations, n_destinations_full = self._load_od_file(
+                "destinations", d_start_idx, d_end_idx
+            )
+            n_full = {
+                "n_origins_full": n_origins_full,
+                "n_destinations_full": n_destinations_full,
+            }
 
         inputs = TravelTimeInputs(
             origins=origins,
@@ -355,316 +649,2194 @@ class TravelTimeConfig:
             chunk=self.args.chunk,
             max_split_size_origins=self.params["times"]["max_split_size"],
             max_split_size_destinations=self.params["times"]["max_split_size"],
+            **n_full,
         )
 
         if snap:
-            self.logger.info(
-                f"Snapping {len(inputs.origins)} origins to OSM network"
-            )
-            inputs.origins = snap_df_to_osm(inputs.origins, self.args.mode)
-            self.logger.info(
-                f"Snapping {len(inputs.destinations)} destinations to OSM network"
-            )
-            inputs.destinations = snap_df_to_osm(
-                inputs.destinations, self.args.mode
-            )
+            self.snap_inputs(inputs, snap_cache)
 
         return inputs
 
-
-class TravelTimeCalculator:
-    """
-    Class to calculate travel times between origins and destinations.
-    Uses chunked requests to the OSRM Table API for calculation.
-    """
-
-    def __init__(
+    def snap_inputs(
         self,
-        config: TravelTimeConfig,
         inputs: TravelTimeInputs,
+        snap_cache: dict[str, list[float]] | None = None,
     ) -> None:
-        self.config = config
-        self.inputs = inputs
+        """
+        Snap the origins and destinations of the inputs to the OSM network.
 
-    def _calculate_times(
-        self,
-        origins: pd.DataFrame,
-        destinations: pd.DataFrame,
-    ) -> pd.DataFrame:
+        Args:
+            inputs: Inputs to snap in place.
+            snap_cache: Snapped coordinates by "lon,lat" string, as in
+                load_default_inputs.
         """
-        Sends the travel time calculation request to the OSRM Table API.
-        Responsible for taking an origin/destination input, transforming it to
-        the required JSON format, and parsing the response.
+        snap_start_time = time.time()
+        self.logger.info(
+            f"Snapping {len(inputs.origins)} origins to OSM network"
+        )
+        inputs.origins = snap_df_to_osm(
+            inputs.origins, self.args.mode, self.client, snap_cache
+        )
+        self.logger.info(
+            f"Snapping {len(inputs.destinations)} destinations to OSM network"
+        )
+        inputs.destinations = snap_df_to_osm(
+            inputs.destinations, self.args.mode, self.client, snap_cache
+        )
+        inputs.snap_time_sec = time.time() - snap_start_time
 
-        Returns:
-            DataFrame containing origin IDs, destination IDs, travel durations,
-            and distances.
-        """
-
-        def _col_dict(x) -> dict:
-            """Helper to convert DataFrames to dicts for API requests."""
-            use_snapped = self.config.params["times"]["use_snapped"]
-            col_suffix = "_snapped" if use_snapped else ""
-            return {
-                "id": x["id"],
-                "lon": x[f"lon{col_suffix}"],
-                "lat": x[f"lat{col_suffix}"],
-            }
 
-        # If there is only one origin and one destination e.g. the state of
-        # Alaska, return a DataFrame of the coordinate pair
-        if (
-            len(origins) == 1
-            and len(destinations) == 1
-            and (origins["id"] == destinations["id"]).all()
-        ):
-            self.config.logger.warning(
-                "Only one origin and destination. "
-                "Returning constructed DataFrame"
-            )
-            df = pd.DataFrame(
-                {
-                    "origin_id": origins["id"],
-                    "destination_id": destinations["id"],
-                    "duration_sec": 0.0,
-                }
-            )
-            return df
+class RoutingStats:
+    """
+    Thread-safe counters collected by the travel time calculator while
+    routing e.g. the number of requests sent to OSRM.
+    """
 
-        # Convert origin and destination points to the style of an OSRM API
-        # request: https://project-osrm.org/docs/v5.5.1/api/#table-service
-        origins_list = origins.apply(_col_dict, axis=1).tolist()
-        destinations_list = destinations.apply(_col_dict, axis=1).tolist()
-        coords_set = {
-            (item["id"], item["lon"], item["lat"])
-            for item in origins_list + destinations_list
-        }
-        coords_list = list(coords_set)
-
-        # Record the indices of the unique coordinate set relative to the
-        # original list orders so we can later recover GEOIDs
-        origins_index = [
-            coords_list.index((item["id"], item["lon"], item["lat"]))
-            for item in origins_list
-            if (item["id"], item["lon"], item["lat"]) in coords_set
-        ]
-        destinations_index = [
-            coords_list.index((item["id"], item["lon"], item["lat"]))
-            for item in destinations_list
-            if (item["id"], item["lon"], item["lat"]) in coords_set
-        ]
-        request_body = (
-            DOCKER_ENDPOINT
-            + f"/table/v1/{self.config.args.mode}/"
-            + ";".join([f"{lon},{lat}" for _, lon, lat in coords_list])
-            + f"?sources={';'.join([str(i) for i in origins_index])}"
-            + f"&destinations={';'.join([str(i) for i in destinations_index])}"
-        )
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self.counts: dict[str, int] = defaultdict(int)
 
-        # Make the actual request to the OSRM API running in Docker
-        response = r.get(request_body)
-        response_data = response.json()
-        if response.status_code != 200:
-            raise ValueError(response_data["message"])
-
-        # Parse the response data and convert it to a DataFrame. Recover the
-        # origin and destination indices and append them to the DataFrame
-        durations = [i for sl in response_data["durations"] for i in sl]
-        origin_ids = origins["id"].repeat(len(destinations)).tolist()
-        destination_ids = destinations["id"].tolist() * (len(origins))
-        df = pd.DataFrame(
-            {
-                "origin_id": origin_ids,
-                "destination_id": destination_ids,
-                "duration_sec": durations,
-            }
-        )
+        self.tasks_per_depth: dict[int, int] = defaultdict(int)
 
-        return df
+        # Wall time of every table request, in seconds
+        self.request_latencies: list[float] = []
 
-    def _binary_search(
+    def increment(self, **counts: int) -> None:
+        """Add the given values to the named counters."""
+        with self._lock:
+            for name, value in counts.items():
+                self.counts[name] += value
+
+    def add_latencies(self, *latencies: float) -> None:
+        """Record the wall time of one or more table requests."""
+        with self._lock:
+            self.request_latencies.extend(latencies)
+
+    def latency_percentiles_ms(
+        self, percentiles: list[float]
+    ) -> list[float | None]:
+        """
+        Get percentiles of the table request latencies in milliseconds, or
+        None for each if no requests were sent.
+        """
+        with self._lock:
+            if not self.request_latencies:
+                return [None] * len(percentiles)
+            values = np.percentile(self.request_latencies, percentiles)
+        return [float(value) * 1000 for value in values]
+
+    def depth_histogram(self) -> list[int]:
+        """Get the number of block search tasks at each depth, from 0."""
+        with self._lock:
+            if not self.tasks_per_depth:
+                return []
+            return [
+                self.tasks_per_depth.get(depth, 0)
+                for depth in range(max(self.tasks_per_depth) + 1)
+            ]
+
+    def count_task(self, depth: int) -> None:
+        """Count one block search task at the given recursion depth."""
+        with self._lock:
+            self.tasks_per_depth[depth] += 1
+
+
+class MissingBlock:
+    """
+    Block of origin/destination pairs that couldn't be routed, kept as index
+    ranges until it's written into a result matrix.
+    """
+
+    __slots__ = ("o_start_idx", "d_start_idx", "o_end_idx", "d_end_idx")
+
+    def __init__(
         self,
         o_start_idx: int,
         d_start_idx: int,
         o_end_idx: int,
         d_end_idx: int,
-        print_log: bool,
-        cur_depth: int,
-        origins: pd.DataFrame,
-        destinations: pd.DataFrame,
-    ) -> list[pd.DataFrame]:
-        """
-        Recursively split the origins and destinations into smaller chunks.
-
-        Necessary because OSRM will terminate certain unroutable requests.
-        Binary searching all origins and destinations will return the routable
-        values around the unroutable ones.
-
-        Higher depth levels will use a fallback router to ensure we're not
-        simply querying the same unroutable values over and over.
-        """
-        start_time = time.time()
+    ) -> None:
+        self.o_start_idx = o_start_idx
+        self.d_start_idx = d_start_idx
+        self.o_end_idx = o_end_idx
+        self.d_end_idx = d_end_idx
 
-        # If indices are out-of-bounds return an empty list
-        if o_start_idx >= o_end_idx or d_start_idx >= d_end_idx:
-            return []
 
-        # Create an empty DataFrame to return in case of exceptions
-        empty_df = create_empty_df(
-            o_start_idx,
-            d_start_idx,
-            o_end_idx,
-            d_end_idx,
-            origins["id"],
-            destinations["id"],
-        )
+# Result of routing (part of) a block: either a DataFrame of times or a
+# block of pairs that couldn't be routed
+BlockResult = pd.DataFrame | MissingBlock
 
-        # Stop recursion if the chunks are too small (i.e. equal to 1)
-        if (o_end_idx - o_start_idx <= 1) and (d_end_idx - d_start_idx <= 1):
-            try:
-                df = self._calculate_times(
-                    origins=origins.iloc[o_start_idx:o_end_idx],
-                    destinations=destinations.iloc[d_start_idx:d_end_idx],
-                )
-                return [df]
-            except Exception as e:
-                if print_log or self.config.verbose:
-                    self.config.logger.warning(
-                        f"{e}. Returning empty DataFrame"
-                    )
-                return [empty_df]
 
-        max_depth = self.config.params["times"]["max_recursion_depth"]
-        if cur_depth >= max_depth:
-            if print_log or self.config.verbose:
-                self.config.logger.warning(
-                    f"Max recursion depth {max_depth} reached. "
-                    "Returning empty DataFrame"
-                )
-            return [empty_df]
+class MissingPairs:
+    """
+    Class to collect the missing pairs of a calculation as integer ID codes
+    (the rank of each ID among the sorted IDs) rather than as rows of IDs.
 
-        try:
-            # Do time calculation if none of the minimal conditioners were met
-            times = self._calculate_times(
-                origins=origins.iloc[o_start_idx:o_end_idx],
-                destinations=destinations.iloc[d_start_idx:d_end_idx],
-            )
+    Pairs must be added in ID order, as they are when split out of a result
+    matrix, so they never need to be sorted. Rows of IDs are only built when
+    the pairs are written, either as one row per pair or in a compact form
+    with one row per origin.
+    """
 
-            if print_log or self.config.verbose:
-                elapsed_time = time.time() - start_time
-                self.config.logger.info(
-                    "From origins %s-%s to destinations %s-%s, routed %s pairs (%s missing) in %s",
-                    o_start_idx,
-                    o_end_idx,
-                    d_start_idx,
-                    d_end_idx,
-                    (o_end_idx - o_start_idx) * (d_end_idx - d_start_idx),
-                    len(times[times["duration_sec"].isnull()]),
-                    format_time(elapsed_time),
-                )
+    def __init__(
+        self, origin_ids: pd.Index, destination_ids: pd.Index
+    ) -> None:
+        self.origin_ids = origin_ids.to_numpy()
+        self.destination_ids = destination_ids.to_numpy()
+        self.pairs: list[tuple[np.ndarray, np.ndarray]] = []
 
-            return [times]
+    @property
+    def n_pairs(self) -> int:
+        return sum(len(o) for o, _ in self.pairs)
 
-        # If the request fails, split the origins/destinations into
-        # quadrants and start a binary search
-        except Exception as e:
-            if "No path could be found for input" in str(e):
-                self.config.logger.warning(f"{e}. Returning empty DataFrame")
-                return [empty_df]
+    def add_pairs(self, o_codes: np.ndarray, d_codes: np.ndarray) -> None:
+        if len(o_codes):
+            self.pairs.append((o_codes, d_codes))
 
-            if print_log or self.config.verbose:
-                self.config.logger.warning(f"{e}. Starting binary search...")
-            osi, oei, dsi, dei = o_start_idx, o_end_idx, d_start_idx, d_end_idx
-            mo, md = (osi + oei) // 2, (dsi + dei) // 2
-            # fmt: off
-            return (
-                self._binary_search(osi, dsi, mo, md, False, cur_depth + 1, origins, destinations)
-                + self._binary_search(mo, dsi, oei, md, False, cur_depth + 1, origins, destinations)
-                + self._binary_search(osi, md, mo, dei, False, cur_depth + 1, origins, destinations)
-                + self._binary_search(mo, md, oei, dei, False, cur_depth + 1, origins, destinations)
-            )
-            # fmt: on
+    def extend(self, other: "MissingPairs") -> None:
+        self.pairs.extend(other.pairs)
 
-    def many_to_many(self) -> pd.DataFrame:
+    def to_df(self, compact: bool = False) -> pd.DataFrame:
         """
-        Entrypoint to calculate times for all combinations of origins and
-        destinations in inputs. Includes an optional second pass which performs
-        a more intensive (time-consuming) search for missing pairs from the
-        first pass.
+        Expand the missing pairs into a DataFrame sorted by IDs.
 
-        Returns:
-            DataFrame containing origin IDs, destination IDs, and travel
-            durations for all inputs.
+        Args:
+            compact: If True, return one row per origin with a list of all its
+                missing destination IDs, instead of one row per pair.
         """
-        results = []
-        max_spl_o = self.inputs.max_split_size_origins
-        n_oc = self.inputs.n_origins
-        m_spl_d = self.inputs.max_split_size_destinations
-        n_dc = self.inputs.n_destinations
-
-        with ThreadPoolExecutor(self.config.ncpu) as executor:
-            futures = []
-            for o in range(0, n_oc, max_spl_o):
-                for d in range(0, n_dc, m_spl_d):
-                    futures.append(
-                        executor.submit(
-                            self._binary_search,
-                            o_start_idx=o,
-                            d_start_idx=d,
-                            o_end_idx=min(o + max_spl_o, n_oc),
-                            d_end_idx=min(d + m_spl_d, n_dc),
-                            print_log=True,
-                            cur_depth=0,
-                            origins=self.inputs.origins,
-                            destinations=self.inputs.destinations,
-                        )
-                    )
-            for future in futures:
-                results.extend(future.result())
-
-        # Return empty result set if nothing is routable
-        if len(results) == 0:
-            results_df = pd.DataFrame(
-                columns=[
-                    "origin_id",
-                    "destination_id",
-                    "duration_sec",
-                ]
-            )
+        if self.pairs:
+            o_codes = np.concatenate([o for o, _ in self.pairs])
+            d_codes = np.concatenate([d for _, d in self.pairs])
         else:
-            results_df = (
-                pd.concat(results, ignore_index=True, copy=False)
-                .set_index(["origin_id", "destination_id"])
-                .sort_index()
+            o_codes = d_codes = np.empty(0, dtype=np.int32)
+        if not compact:
+            return pd.DataFrame(
+                {
+                    "origin_id": self.origin_ids[o_codes],
+                    "destination_id": self.destination_ids[d_codes],
+                }
             )
 
-        del results
-        return results_df
+        starts = np.flatnonzero(np.diff(o_codes, prepend=-1) != 0)
+        destination_ids = self.destination_ids[d_codes]
+        return pd.DataFrame(
+            {
+                "origin_id": self.origin_ids[o_codes[starts]],
+                "destination_ids": np.split(destination_ids, starts[1:])
+                if len(starts)
+                else [],
+            }
+        )
+
+
+# A search step to run on the executor: a calculator method and its kwargs.
+# Each step returns the DataFrames it routed and any follow-up steps
+SearchTask = tuple[Callable[..., Any], dict[str, Any]]
+
+# Search logic written once for every engine, as a generator that yields the
+# blocks it needs routed (as o_start_idx, d_start_idx, o_end_idx, d_end_idx)
+# and is sent back each block's DataFrame, or the exception raised routing
+# it. Engines only differ in how they send the requests. Returns the results
+# and follow-up tasks of the step
+SearchStep = Generator[
+    list[tuple[int, int, int, int]],
+    list["pd.DataFrame | Exception"],
+    tuple[list[BlockResult], list[SearchTask]],
+]
 
 
-def snap_df_to_osm(df: pd.DataFrame, mode: str) -> pd.DataFrame:
+class BlockSearch:
     """
-    Snap a DataFrame of lat/lon points to the OpenStreetMap network using
-    the OSRM Nearest API.
+    Class to run the search tasks of a group of blocks (e.g. one stripe of
+    origins) on a shared executor.
 
-    Args:
-        df: DataFrame containing the columns 'id', 'lat', and 'lon'.
-        mode: Travel mode to use for snapping.
+    When a block fails, its sub-blocks are resubmitted to the executor as
+    new tasks instead of being searched recursively in the same thread, so
+    idle workers can pick them up. The future resolves with the results of
+    every task once all of them, including resubmitted ones, are done.
     """
-    coords_list = df.apply(lambda x: f"{x['lon']},{x['lat']}", axis=1).tolist()
-    request_endpoint = DOCKER_ENDPOINT + f"/nearest/v1/{mode}/"
 
-    # Snap each input coordinate to the OSM grid. The OSRM Nearest API only
-    # takes one coordinate pair at a time
-    snapped_list = []
-    for coord in coords_list:
-        request_body = request_endpoint + coord
-        response = r.get(request_body)
-        response_data = response.json()
-        if response.status_code != 200:
-            raise ValueError(response_data["message"])
+    def __init__(self, executor: Executor, stats: RoutingStats):
+        self.executor = executor
+        self.stats = stats
+        self.future: Future[list[BlockResult]] = Future()
+        self._results: list[BlockResult] = []
+        self._lock = threading.Lock()
+        # Starts at 1 so the search can't finish while still being started
+        self._n_pending = 1
+
+    def start(self, tasks: list[SearchTask]) -> "BlockSearch":
+        """Submit the initial tasks of the search."""
+        for task in tasks:
+            self._submit(task)
+        self._finish_task([])
+        return self
+
+    def _submit(self, task: SearchTask) -> None:
+        fn, kwargs = task
+        with self._lock:
+            self._n_pending += 1
+        self.stats.count_task(kwargs["cur_depth"])
+        self.executor.submit(fn, **kwargs).add_done_callback(self._on_done)
+
+    def _on_done(self, future: Future) -> None:
+        try:
+            results, tasks = future.result()
+            for task in tasks:
+                self._submit(task)
+        except Exception as e:
+            if not self.future.done():
+                self.future.set_exception(e)
+            return
+        self._finish_task(results)
+
+    def _finish_task(self, results: list[BlockResult]) -> None:
+        with self._lock:
+            self._results.extend(results)
+            self._n_pending -= 1
+            finished = self._n_pending == 0
+        if finished and not self.future.done():
+            self.future.set_result(self._results)
+
+
+def parse_table_response(
+    response_data: dict,
+    o_start_idx: int,
+    d_start_idx: int,
+    o_end_idx: int,
+    d_end_idx: int,
+) -> pd.DataFrame:
+    """
+    Parse the response data of a Table API request and convert it to a
+    DataFrame. Durations are decoded straight into a float32 array (null
+    durations become NaN) and each pair is identified by the integer
+    indices of its origin and destination rather than by their IDs.
+
+    Raises:
+        ValueError: If the number of durations doesn't match the block.
+    """
+    n_o, n_d = o_end_idx - o_start_idx, d_end_idx - d_start_idx
+    durations = np.asarray(response_data["durations"], dtype=np.float32)
+    if durations.size != n_o * n_d:
+        raise ValueError(
+            f"Expected {n_o * n_d} durations, got {durations.size}"
+        )
+    return pd.DataFrame(
+        {
+            "origin_idx": np.repeat(
+                np.arange(o_start_idx, o_end_idx, dtype=np.int32), n_d
+            ),
+            "destination_idx": np.tile(
+                np.arange(d_start_idx, d_end_idx, dtype=np.int32), n_o
+            ),
+            "duration_sec": durations.reshape(-1),
+        }
+    )
+
+
+class TravelTimeCalculator:
+    """
+    Class to calculate travel times between origins and destinations.
+    Uses chunked requests to the OSRM Table API for calculation.
+    """
+
+    VALID_FAULT_ISOLATION = ["group_test", "quadrant"]
+    VALID_DURATION_DTYPES = ["float32", "float64", "uint32"]
+    VALID_SPATIAL_ORDERS = ["id", "hilbert"]
+
+    # Smallest range of origins that pairs are pruned over when there is a
+    # maximum distance
+    MIN_REGION_ORIGINS = 128
+
+    # Value of result matrix cells with neither a time nor a missing pair,
+    # e.g. pairs skipped for being too far apart. Missing pairs are NaN
+    NO_RESULT = -1.0
+    # Number of result matrix cells split into times and missing pairs at
+    # once, which bounds the memory used by the split
+    SPLIT_SLICE_CELLS = 1 << 22
+
+    def __init__(
+        self,
+        config: TravelTimeConfig,
+        inputs: TravelTimeInputs,
+    ) -> None:
+        self.config = config
+        self.inputs = inputs
+
+        # Number of blocks to keep queued ahead of the stripe being streamed
+        self.max_pending_blocks = 2 * self.config.ncpu
 
-        snapped_list.append(response_data["waypoints"][0]["location"])
+        # Origins and destinations in routing order. Block indices refer to
+        # these, not to the inputs. Each group is a contiguous range of points
+        # sharing a reachability label (None if there was no pre-flight)
+        self.origins = self.inputs.origins.reset_index(drop=True)
+        self.destinations = self.inputs.destinations.reset_index(drop=True)
+        self.origin_groups = self._single_group(self.origins)
+        self.destination_groups = self._single_group(self.destinations)
+
+        use_snapped = self.config.params["times"]["use_snapped"]
+        col_suffix = "_snapped" if use_snapped else ""
+        self.lon_col, self.lat_col = f"lon{col_suffix}", f"lat{col_suffix}"
+
+        self.spatial_order: str = self.config.params["times"]["spatial_order"]
+        if self.spatial_order not in self.VALID_SPATIAL_ORDERS:
+            raise ValueError(
+                "Invalid spatial_order, must be one of: "
+                f"{self.VALID_SPATIAL_ORDERS}"
+            )
+        if self.spatial_order == "hilbert":
+            self._order_by_hilbert()
+        if self.config.params["times"]["preflight"]["enabled"]:
+            self._run_preflight()
+
+        # Routed pairs are kept as integer indices into the origins and
+        # destinations. On output, each index is mapped to the rank of its
+        # ID, so sorting by code sorts by ID and the ID columns are written
+        # as dictionaries without ever building one string per pair
+        self._origin_codes, self._origin_id_dtype = self._id_codes(
+            self.origins["id"]
+        )
+        self._destination_codes, self._destination_id_dtype = self._id_codes(
+            self.destinations["id"]
+        )
+        # Pairs further apart than this great-circle distance are skipped
+        # rather than routed. None routes every pair
+        self.max_distance_m: float | None = self.config.params["times"][
+            "max_distance_m"
+        ].get(self.config.args.mode)
+        if self.max_distance_m is not None:
+            self._origin_xyz = sphere_coords(
+                self.origins[self.lon_col], self.origins[self.lat_col]
+            )
+            self._destination_xyz = sphere_coords(
+                self.destinations[self.lon_col],
+                self.destinations[self.lat_col],
+            )
+            angle = self.max_distance_m / EARTH_RADIUS_M
+            self._max_chord = 2 * np.sin(angle / 2)
+            self._min_cos = np.cos(angle)
+
+        # Routed pairs with a duration above this are dropped before
+        # writing. None keeps every pair
+        self.max_duration_sec: float | None = self.config.params["times"][
+            "max_duration_sec"
+        ].get(self.config.args.mode)
+
+        self.duration_dtype: str = self.config.params["times"][
+            "duration_dtype"
+        ]
+        if self.duration_dtype not in self.VALID_DURATION_DTYPES:
+            raise ValueError(
+                "Invalid duration_dtype, must be one of: "
+                f"{self.VALID_DURATION_DTYPES}"
+            )
+
+        # Coordinate strings for every origin and destination are formatted
+        # once here and then sliced for each block request
+        self.request_builder = TableRequestBuilder(
+            mode=self.config.args.mode,
+            origins=self.origins,
+            destinations=self.destinations,
+            lon_col=self.lon_col,
+            lat_col=self.lat_col,
+            encoding=self.config.params["times"]["coordinate_encoding"],
+        )
+        self.max_url_bytes: int = self.config.params["times"]["max_url_bytes"]
+        self.stats = RoutingStats()
+
+        # Top-level blocks start at the static max split sizes. If enabled,
+        # their shape is then tuned from the timings of earlier blocks
+        self.block_size: BlockSizeController | None = None
+        adaptive_params = self.config.params["times"]["adaptive_block_size"]
+        if adaptive_params["enabled"]:
+            self.block_size = BlockSizeController(
+                n_origins=self.inputs.max_split_size_origins,
+                n_destinations=self.inputs.max_split_size_destinations,
+                max_n_origins=max(self.inputs.n_origins, 1),
+                max_n_destinations=max(self.inputs.n_destinations, 1),
+                min_split_size=adaptive_params["min_split_size"],
+                max_block_pairs=adaptive_params["max_block_pairs"],
+                target_block_sec=adaptive_params["target_block_sec"],
+                n_samples=adaptive_params["n_samples"],
+                logger=self.config.logger,
+                fixed_origins=self.spatial_order == "hilbert"
+                or self.config.params["times"]["preflight"]["enabled"],
+            )
+
+        self.fault_isolation: str = self.config.params["times"][
+            "fault_isolation"
+        ]
+        if self.fault_isolation not in self.VALID_FAULT_ISOLATION:
+            raise ValueError(
+                "Invalid fault_isolation, must be one of: "
+                f"{self.VALID_FAULT_ISOLATION}"
+            )
+
+        # Finished top-level blocks are checkpointed so an interrupted chunk
+        # can resume. Block indices refer to the routing order, so it's part
+        # of the checkpoint's fingerprint
+        self.checkpoint: BlockCheckpoint | None = None
+        if self.config.params["times"]["checkpoint"]["enabled"]:
+            self.checkpoint = BlockCheckpoint(
+                path=self.config.paths.checkpoint_dir,
+                fingerprint=self._fingerprint(),
+                logger=self.config.logger,
+            )
+            if self.checkpoint.finished:
+                self.config.logger.info(
+                    "Resuming from checkpoint with %s finished blocks",
+                    len(self.checkpoint.finished),
+                )
+
+    def _fingerprint(self) -> str:
+        """
+        Hash of everything that determines the routed blocks and their
+        results: the origins and destinations in routing order, their
+        reachability groups, the routing backend, and the times parameters.
+        """
+        hash_md5 = hashlib.md5()
+        for df in [self.origins, self.destinations]:
+            hash_md5.update(df["id"].astype(str).str.cat(sep=",").encode())
+            hash_md5.update(
+                df[[self.lon_col, self.lat_col]].to_numpy().tobytes()
+            )
+        hash_md5.update(
+            json.dumps(
+                [
+                    self.config.args.mode,
+                    self.config.args.backend,
+                    self.config.params["times"],
+                    [group[:2] for group in self.origin_groups],
+                    [group[:2] for group in self.destination_groups],
+                ],
+                default=int,
+            ).encode()
+        )
+        return hash_md5.hexdigest()
+
+    @staticmethod
+    def _id_codes(ids: pd.Series) -> tuple[np.ndarray, pd.CategoricalDtype]:
+        """
+        Map each ID to its rank among the sorted IDs. Returns the ranks and a
+        categorical dtype whose categories are the sorted IDs.
+        """
+        ids_arr = ids.to_numpy()
+        order = np.argsort(ids_arr, kind="stable")
+        codes = np.empty(len(order), dtype=np.int32)
+        codes[order] = np.arange(len(order), dtype=np.int32)
+        return codes, pd.CategoricalDtype(ids_arr[order])
+
+    @staticmethod
+    def _single_group(df: pd.DataFrame) -> list[tuple[int, int, Any]]:
+        """Treat all points as one unlabeled group."""
+        return [(0, len(df), None)] if len(df) else []
+
+    def _order_by_hilbert(self) -> None:
+        """
+        Reorder points along a Hilbert curve over their combined bounding
+        box, so that the points of each block are close together in space.
+
+        Destinations are reordered globally. Origins are only reordered
+        within each stripe of max_split_size_origins origins, so stripes
+        still cover the same range of IDs and the output of each stripe can
+        be written in ID order.
+        """
+        points = pd.concat(
+            [
+                df[[self.lon_col, self.lat_col]]
+                for df in [self.origins, self.destinations]
+            ]
+        )
+        bounds = (
+            points[self.lon_col].min(),
+            points[self.lat_col].min(),
+            points[self.lon_col].max(),
+            points[self.lat_col].max(),
+        )
+
+        o_index = hilbert_index(
+            self.origins[self.lon_col], self.origins[self.lat_col], bounds
+        )
+        o_stripe = (
+            np.arange(len(self.origins)) // self.inputs.max_split_size_origins
+        )
+        o_order = np.lexsort((o_index, o_stripe))
+        self.origins = self.origins.iloc[o_order].reset_index(drop=True)
+
+        d_index = hilbert_index(
+            self.destinations[self.lon_col],
+            self.destinations[self.lat_col],
+            bounds,
+        )
+        d_order = np.argsort(d_index, kind="stable")
+        self.destinations = self.destinations.iloc[d_order].reset_index(
+            drop=True
+        )
+
+    def _run_preflight(self) -> None:
+        """
+        Label every origin and destination with a reachability probe, then
+        reorder each so that points sharing a label are contiguous.
+        """
+        start_time = time.time()
+        preflight = self.config.params["times"]["preflight"]
+        probe = ReachabilityProbe(
+            client=self.config.client,
+            mode=self.config.args.mode,
+            n_anchors=preflight["n_anchors"],
+            batch_size=preflight["batch_size"],
+            logger=self.config.logger,
+            cache_file=self.config.paths.reachability_file,
+            encoding=self.config.params["times"]["coordinate_encoding"],
+        )
+        points = (
+            pd.concat(
+                [
+                    df[[self.lon_col, self.lat_col]]
+                    for df in [self.origins, self.destinations]
+                ]
+            )
+            .set_axis(["lon", "lat"], axis=1)
+            .drop_duplicates()
+        )
+        labels = probe.label(points)
+
+        self.origins, self.origin_groups = self._group_by_label(
+            self.origins, labels, self.inputs.max_split_size_origins
+        )
+        self.destinations, self.destination_groups = self._group_by_label(
+            self.destinations, labels
+        )
+        self.config.logger.info(
+            "Pre-flight labeled %s points into %s origin and %s destination "
+            "groups (%s bad) with %s requests in %s",
+            len(points),
+            len(self.origin_groups),
+            len(self.destination_groups),
+            labels["is_bad"].sum(),
+            probe.n_requests,
+            format_time(time.time() - start_time),
+        )
+
+    def _group_by_label(
+        self,
+        df: pd.DataFrame,
+        labels: pd.DataFrame,
+        stripe_size: int | None = None,
+    ) -> tuple[pd.DataFrame, list[tuple[int, int, Any]]]:
+        """
+        Sort points by their reachability label, keeping the existing order
+        within each label, and find the range of each label. If a stripe
+        size is given, points are only sorted within each stripe, so stripes
+        still cover the same points in the same order.
+
+        Returns:
+            The sorted points and a list of (start index, end index, label)
+            tuples, where the label is (is_bad, to_mask, from_mask).
+        """
+        if len(df) == 0:
+            return df, []
+
+        df_labels = (
+            df[[self.lon_col, self.lat_col]]
+            .set_axis(["lon", "lat"], axis=1)
+            .merge(labels, on=["lon", "lat"], how="left")
+        )
+        stripe = np.arange(len(df)) // (stripe_size or len(df))
+        keys = np.column_stack(
+            [
+                stripe,
+                df_labels[["is_bad", "to_mask", "from_mask"]].to_numpy(
+                    dtype="int64"
+                ),
+            ]
+        )
+        order = np.lexsort(keys[:, ::-1].T)
+        keys = keys[order]
+        df = df.iloc[order].reset_index(drop=True)
+
+        breaks = np.flatnonzero((np.diff(keys, axis=0) != 0).any(axis=1)) + 1
+        starts = np.concatenate([[0], breaks])
+        ends = np.concatenate([breaks, [len(df)]])
+        groups = [
+            (
+                int(s),
+                int(e),
+                (bool(keys[s, 1]), int(keys[s, 2]), int(keys[s, 3])),
+            )
+            for s, e in zip(starts, ends)
+        ]
+        return df, groups
+
+    @staticmethod
+    def _is_routable(o_label: Any, d_label: Any) -> bool:
+        """
+        Check whether any pair between two groups of points can possibly be
+        routed, given their reachability labels. Unlabeled groups always can.
+        """
+        if o_label is None or d_label is None:
+            return True
+        o_bad, o_to, o_from = o_label
+        d_bad, d_to, d_from = d_label
+        if o_bad or d_bad:
+            return False
+        return (d_to & ~o_to) == 0 and (o_from & ~d_from) == 0
+
+    def _get_single_pair_df(
+        self,
+        o_start_idx: int,
+        d_start_idx: int,
+        o_end_idx: int,
+        d_end_idx: int,
+    ) -> pd.DataFrame | None:
+        """
+        If there is only one origin and one destination and they are the same
+        point e.g. the state of Alaska, return a DataFrame of the coordinate
+        pair. Otherwise return None.
+        """
+        if (
+            o_end_idx - o_start_idx == 1
+            and d_end_idx - d_start_idx == 1
+            and self._same_id(o_start_idx, d_start_idx)
+        ):
+            self.config.logger.warning(
+                "Only one origin and destination. "
+                "Returning constructed DataFrame"
+            )
+            df = pd.DataFrame(
+                {
+                    "origin_idx": np.array([o_start_idx], dtype=np.int32),
+                    "destination_idx": np.array([d_start_idx], dtype=np.int32),
+                    "duration_sec": np.zeros(1, dtype=np.float32),
+                }
+            )
+            return df
+        return None
+
+    def _same_id(self, o_idx: int, d_idx: int) -> bool:
+        """Check whether an origin and a destination have the same ID."""
+        return (
+            self.origins["id"].iloc[o_idx]
+            == self.destinations["id"].iloc[d_idx]
+        )
+
+    def _calculate_times(
+        self,
+        o_start_idx: int,
+        d_start_idx: int,
+        o_end_idx: int,
+        d_end_idx: int,
+    ) -> pd.DataFrame:
+        """
+        Sends the travel time calculation request to the OSRM Table API.
+        Responsible for taking a block of origin/destination indices,
+        transforming it to the required request format, and parsing the
+        response.
+
+        Returns:
+            DataFrame containing origin IDs, destination IDs, and travel
+            durations.
+        """
+        idx = (o_start_idx, d_start_idx, o_end_idx, d_end_idx)
+        single_pair_df = self._get_single_pair_df(*idx)
+        if single_pair_df is not None:
+            return single_pair_df
+
+        # Convert origin and destination points to the style of an OSRM API
+        # request: https://project-osrm.org/docs/v5.5.1/api/#table-service
+        request_path = self.request_builder.build(*idx)
+
+        # Split the block in half and route each half separately if the
+        # request URL would be too large to send
+        halves = self._split_oversized_block(request_path, *idx)
+        if halves:
+            return pd.concat(
+                [self._calculate_times(*half) for half in halves],
+                ignore_index=True,
+            )
+
+        # Make the actual request to the OSRM API running in Docker
+        request_start_time = time.time()
+        try:
+            response_data = self.config.client.get(request_path)
+        finally:
+            self.stats.add_latencies(time.time() - request_start_time)
+        self.stats.increment(
+            bytes_received=response_data.get("response_bytes", 0)
+        )
+        return parse_table_response(response_data, *idx)
+
+    def _split_oversized_block(
+        self,
+        request_path: str,
+        o_start_idx: int,
+        d_start_idx: int,
+        o_end_idx: int,
+        d_end_idx: int,
+    ) -> list[tuple[int, int, int, int]]:
+        """
+        Check a block's request against the URL byte budget. Returns the two
+        halves of the block (split along its larger side) if the request is
+        too large, otherwise records the request and returns an empty list.
+        """
+        idx = (o_start_idx, d_start_idx, o_end_idx, d_end_idx)
+        n_o, n_d = o_end_idx - o_start_idx, d_end_idx - d_start_idx
+        if len(request_path) > self.max_url_bytes and n_o * n_d > 1:
+            return self._split_block(*idx, axis=self._longest_axis(*idx))
+
+        self.stats.increment(
+            n_requests=1, bytes_sent=len(request_path), n_pairs_sent=n_o * n_d
+        )
+        return []
+
+    def _binary_search(
+        self,
+        o_start_idx: int,
+        d_start_idx: int,
+        o_end_idx: int,
+        d_end_idx: int,
+        print_log: bool,
+        cur_depth: int,
+    ) -> tuple[list[BlockResult], list[SearchTask]]:
+        """
+        Route a block, splitting the origins and destinations into smaller
+        chunks if the request fails. Runs _binary_search_step, sending its
+        requests from the calling thread.
+
+        Rather than recursing, the sub-blocks of a failed block are returned
+        as new search tasks, which BlockSearch resubmits to the executor so
+        they can run in parallel on any idle worker.
+
+        Returns:
+            The routed DataFrames and the search tasks of any sub-blocks.
+        """
+        return self._run_search_step(
+            self._binary_search_step(
+                o_start_idx,
+                d_start_idx,
+                o_end_idx,
+                d_end_idx,
+                print_log,
+                cur_depth,
+            )
+        )
+
+    def _binary_search_step(
+        self,
+        o_start_idx: int,
+        d_start_idx: int,
+        o_end_idx: int,
+        d_end_idx: int,
+        print_log: bool,
+        cur_depth: int,
+    ) -> SearchStep:
+        """
+        Search step of _binary_search, shared by all engines.
+
+        Necessary because OSRM will terminate certain unroutable requests.
+        Binary searching all origins and destinations will return the routable
+        values around the unroutable ones.
+        """
+        start_time = time.time()
+
+        # If indices are out-of-bounds return an empty list
+        if o_start_idx >= o_end_idx or d_start_idx >= d_end_idx:
+            return [], []
+
+        # Block of missing pairs to return in case of exceptions
+        idx = (o_start_idx, d_start_idx, o_end_idx, d_end_idx)
+        empty_block = MissingBlock(*idx)
+
+        # Stop recursion if the chunks are too small (i.e. equal to 1)
+        if (o_end_idx - o_start_idx <= 1) and (d_end_idx - d_start_idx <= 1):
+            self._count_fault_isolation(cur_depth)
+            (times,) = yield [idx]
+            if isinstance(times, Exception):
+                if print_log or self.config.verbose:
+                    self.config.logger.warning(
+                        f"{times}. Returning empty DataFrame"
+                    )
+                return [empty_block], []
+            return [times], []
+
+        max_depth = self.config.params["times"]["max_recursion_depth"]
+        if cur_depth >= max_depth:
+            if print_log or self.config.verbose:
+                self.config.logger.warning(
+                    f"Max recursion depth {max_depth} reached. "
+                    "Returning empty DataFrame"
+                )
+            return [empty_block], []
+
+        # Do time calculation if none of the minimal conditioners were met
+        self._count_fault_isolation(cur_depth)
+        (times,) = yield [idx]
+        if not isinstance(times, Exception):
+            elapsed_time = time.time() - start_time
+            self._record_block_size(*idx, cur_depth, elapsed_time)
+
+            if print_log or self.config.verbose:
+                self.config.logger.info(
+                    "From origins %s-%s to destinations %s-%s, routed %s pairs (%s missing) in %s",
+                    o_start_idx,
+                    o_end_idx,
+                    d_start_idx,
+                    d_end_idx,
+                    (o_end_idx - o_start_idx) * (d_end_idx - d_start_idx),
+                    len(times[times["duration_sec"].isnull()]),
+                    format_time(elapsed_time),
+                )
+
+            return [times], []
+
+        # If the request fails, isolate the points causing the failure,
+        # either by group testing or by splitting into quadrants
+        e = times
+        self._record_block_size(
+            *idx, cur_depth, time.time() - start_time, error=e
+        )
+        if "No path could be found for input" in str(e):
+            self.config.logger.warning(f"{e}. Returning empty DataFrame")
+            return [empty_block], []
+
+        if self.fault_isolation == "group_test":
+            if print_log or self.config.verbose:
+                self.config.logger.warning(f"{e}. Starting group testing...")
+            return (
+                yield from self._group_test_step(
+                    *idx, cur_depth, self._longest_axis(*idx)
+                )
+            )
+
+        if print_log or self.config.verbose:
+            self.config.logger.warning(f"{e}. Starting binary search...")
+        return [], self._quadrant_tasks(*idx, cur_depth + 1)
+
+    def _run_search_step(
+        self, step: SearchStep
+    ) -> tuple[list[BlockResult], list[SearchTask]]:
+        """
+        Run a search step to the end, routing the blocks it asks for one
+        after another.
+        """
+        try:
+            blocks = next(step)
+            while True:
+                blocks = step.send([self._try_route(*b) for b in blocks])
+        except StopIteration as stop:
+            return stop.value
+
+    def _try_route(
+        self,
+        o_start_idx: int,
+        d_start_idx: int,
+        o_end_idx: int,
+        d_end_idx: int,
+    ) -> pd.DataFrame | Exception:
+        """Route a block for a search step, returning any error raised."""
+        try:
+            return self._calculate_times(
+                o_start_idx, d_start_idx, o_end_idx, d_end_idx
+            )
+        except Exception as e:
+            return e
+
+    def _record_block_size(
+        self,
+        o_start_idx: int,
+        d_start_idx: int,
+        o_end_idx: int,
+        d_end_idx: int,
+        cur_depth: int,
+        elapsed_time: float,
+        error: Exception | None = None,
+    ) -> None:
+        """
+        Report the outcome of a top-level block to the block size controller.
+        Only failures caused by the size of the block are reported as such.
+        """
+        if self.block_size is None or cur_depth > 0:
+            return
+        if error is not None and not is_resource_error(error):
+            return
+        self.block_size.record(
+            o_end_idx - o_start_idx,
+            d_end_idx - d_start_idx,
+            elapsed_time,
+            failed=error is not None,
+        )
+
+    def _quadrant_tasks(
+        self,
+        o_start_idx: int,
+        d_start_idx: int,
+        o_end_idx: int,
+        d_end_idx: int,
+        cur_depth: int,
+    ) -> list[SearchTask]:
+        """Search tasks for the four quadrants of a failed block."""
+        osi, oei, dsi, dei = o_start_idx, o_end_idx, d_start_idx, d_end_idx
+        mo, md = (osi + oei) // 2, (dsi + dei) // 2
+        return [
+            (
+                self._binary_search,
+                {
+                    "o_start_idx": q[0],
+                    "d_start_idx": q[1],
+                    "o_end_idx": q[2],
+                    "d_end_idx": q[3],
+                    "print_log": False,
+                    "cur_depth": cur_depth,
+                },
+            )
+            for q in [
+                (osi, dsi, mo, md),
+                (mo, dsi, oei, md),
+                (osi, md, mo, dei),
+                (mo, md, oei, dei),
+            ]
+        ]
+
+    def _count_fault_isolation(self, cur_depth: int) -> None:
+        """Count requests sent while isolating a failed block."""
+        if cur_depth > 0:
+            self.stats.increment(n_fault_isolation_requests=1)
+
+    @staticmethod
+    def _longest_axis(
+        o_start_idx: int, d_start_idx: int, o_end_idx: int, d_end_idx: int
+    ) -> int:
+        """Return 0 if a block has more origins than destinations, else 1."""
+        return 0 if o_end_idx - o_start_idx >= d_end_idx - d_start_idx else 1
+
+    @staticmethod
+    def _split_block(
+        o_start_idx: int,
+        d_start_idx: int,
+        o_end_idx: int,
+        d_end_idx: int,
+        axis: int,
+    ) -> list[tuple[int, int, int, int]]:
+        """Split a block in half along origins (axis 0) or destinations."""
+        if axis == 0:
+            mo = (o_start_idx + o_end_idx) // 2
+            return [
+                (o_start_idx, d_start_idx, mo, d_end_idx),
+                (mo, d_start_idx, o_end_idx, d_end_idx),
+            ]
+        md = (d_start_idx + d_end_idx) // 2
+        return [
+            (o_start_idx, d_start_idx, o_end_idx, md),
+            (o_start_idx, md, o_end_idx, d_end_idx),
+        ]
+
+    def _plan_group_test(
+        self,
+        o_start_idx: int,
+        d_start_idx: int,
+        o_end_idx: int,
+        d_end_idx: int,
+        cur_depth: int,
+        axis: int,
+    ) -> tuple[int, list[tuple[int, int, int, int]]] | None:
+        """
+        Decide how to split a failed block during group testing. Returns the
+        axis to split along and the two halves, or None if the block can't
+        be split any further (a single pair or the max recursion depth,
+        tested like in _binary_search_step).
+        """
+        n_o, n_d = o_end_idx - o_start_idx, d_end_idx - d_start_idx
+        max_depth = self.config.params["times"]["max_recursion_depth"]
+        if n_o * n_d <= 1 or cur_depth >= max_depth:
+            if self.config.verbose and n_o * n_d > 1:
+                self.config.logger.warning(
+                    f"Max recursion depth {max_depth} reached. "
+                    "Returning empty DataFrame"
+                )
+            return None
+        if (n_o if axis == 0 else n_d) <= 1:
+            axis = 1 - axis
+        idx = (o_start_idx, d_start_idx, o_end_idx, d_end_idx)
+        return axis, self._split_block(*idx, axis=axis)
+
+    def _group_test(
+        self,
+        o_start_idx: int,
+        d_start_idx: int,
+        o_end_idx: int,
+        d_end_idx: int,
+        cur_depth: int,
+        axis: int,
+        switched: bool = False,
+    ) -> tuple[list[BlockResult], list[SearchTask]]:
+        """
+        Run _group_test_step, sending its requests from the calling thread.
+        Failed halves are returned as new search tasks.
+        """
+        return self._run_search_step(
+            self._group_test_step(
+                o_start_idx,
+                d_start_idx,
+                o_end_idx,
+                d_end_idx,
+                cur_depth,
+                axis,
+                switched,
+            )
+        )
+
+    def _group_test_step(
+        self,
+        o_start_idx: int,
+        d_start_idx: int,
+        o_end_idx: int,
+        d_end_idx: int,
+        cur_depth: int,
+        axis: int,
+        switched: bool = False,
+    ) -> SearchStep:
+        """
+        Isolate the points that make a failed block fail using adaptive
+        group testing, an alternative to splitting into quadrants.
+
+        The block is split in half along one axis (0 for origins, 1 for
+        destinations) and both halves are routed. A half that succeeds is
+        done in one request; a half that fails is split again along the same
+        axis. A single bad point is found in O(log n) requests. If both
+        halves fail, the fault most likely lies along the other axis (e.g. one
+        bad destination shared by every origin), so the block is split along
+        that axis instead. Once a failing block is down to a single origin
+        (or destination), that point is the fault, so its pairs are missing.
+        If the halves fail along both axes, the faults are spread across both
+        and each quadrant is searched separately.
+
+        Halving doesn't count towards max_recursion_depth, since the halves
+        shrink down to single points after about log2(n) splits. Searching
+        quadrants counts as one level of depth, as in _binary_search_step.
+        """
+        idx = (o_start_idx, d_start_idx, o_end_idx, d_end_idx)
+        plan = self._plan_group_test(*idx, cur_depth, axis)
+        if plan is None:
+            return [MissingBlock(*idx)], []
+
+        axis, halves = plan
+        self.stats.increment(n_fault_isolation_requests=len(halves))
+        outcomes = yield halves
+        dfs = [
+            self._group_test_result(half, outcome)
+            for half, outcome in zip(halves, outcomes)
+        ]
+        n_o, n_d = o_end_idx - o_start_idx, d_end_idx - d_start_idx
+        other_size = n_d if axis == 0 else n_o
+        if all(df is None for df in dfs):
+            # Every split of a single point's pairs fails, so it's the point
+            # that can't be routed
+            if other_size == 1:
+                return [MissingBlock(*idx)], []
+            if not switched:
+                return (
+                    yield from self._group_test_step(
+                        *idx, cur_depth, 1 - axis, switched=True
+                    )
+                )
+            # Halves fail along both axes, so the faults are spread across
+            # origins and destinations. Search each quadrant instead
+            return [], self._quadrant_tasks(*idx, cur_depth + 1)
+
+        tasks: list[SearchTask] = [
+            (
+                self._group_test,
+                {
+                    "o_start_idx": half[0],
+                    "d_start_idx": half[1],
+                    "o_end_idx": half[2],
+                    "d_end_idx": half[3],
+                    "cur_depth": cur_depth,
+                    "axis": axis,
+                },
+            )
+            for half, df in zip(halves, dfs)
+            if df is None
+        ]
+        return [df for df in dfs if df is not None], tasks
+
+    def _group_test_result(
+        self,
+        half: tuple[int, int, int, int],
+        times: pd.DataFrame | Exception,
+    ) -> BlockResult | None:
+        """
+        Result of one half of a failed block during group testing. None if
+        the request failed, or all missing pairs if OSRM found no path.
+        """
+        if not isinstance(times, Exception):
+            return times
+        if "No path could be found for input" in str(times):
+            return MissingBlock(*half)
+        if self.config.verbose:
+            self.config.logger.warning(f"{times}. Splitting block further")
+        return None
+
+    def many_to_many(self) -> tuple[pd.DataFrame, MissingPairs]:
+        """
+        Entrypoint to calculate times for all combinations of origins and
+        destinations in inputs. Includes an optional second pass which performs
+        a more intensive (time-consuming) search for missing pairs from the
+        first pass.
+
+        The results of each stripe are written into a preallocated matrix as
+        they arrive, so block results are freed while routing continues.
+
+        Returns:
+            DataFrame containing origin IDs, destination IDs, and travel
+            durations for all routable pairs, and the missing pairs.
+        """
+        matrix, row_codes, origin_rows = self._result_matrix(
+            0, len(self.origins)
+        )
+        for _, _, stripe_results in self._iter_stripe_results():
+            self._fill_matrix(matrix, origin_rows, 0, stripe_results)
+        with stage("split"):
+            return self._split_matrix(matrix, row_codes)
+
+    def iter_many_to_many(
+        self,
+    ) -> Iterator[tuple[pd.DataFrame, MissingPairs]]:
+        """
+        Streaming version of many_to_many. Yields the results of one stripe
+        of origins (one block of origins to all destinations) at a time, in
+        origin order and sorted by origin and destination ID. Only a bounded
+        number of blocks are queued ahead of the stripe being
+        yielded, so peak memory depends on the stripe size rather than the
+        chunk size.
+
+        Yields:
+            DataFrames containing origin IDs, destination IDs, and travel
+            durations for one stripe of origins, and its missing pairs.
+        """
+        for o_start_idx, o_end_idx, results in self._iter_stripe_results():
+            with stage("split"):
+                matrix, row_codes, origin_rows = self._result_matrix(
+                    o_start_idx, o_end_idx
+                )
+                self._fill_matrix(matrix, origin_rows, o_start_idx, results)
+                combined = self._split_matrix(matrix, row_codes)
+            del matrix
+            yield combined
+
+    def _iter_stripe_results(
+        self,
+    ) -> Iterator[tuple[int, int, list[BlockResult]]]:
+        """
+        Route each stripe of origins and yield its origin range and block
+        results, in origin order. Stripes are only started once fewer than max_pending_blocks
+        blocks are queued, so later stripes use the block shape tuned from
+        the timings of earlier ones.
+        """
+        with self._create_executor() as executor:
+            pending: deque[
+                tuple[int, int, list[BlockSearch], list[BlockResult], int]
+            ] = deque()
+            n_pending = 0
+            for (
+                stripe_idx,
+                o_start_idx,
+                o_end_idx,
+                blocks,
+                done,
+            ) in self._iter_stripes_to_route():
+                searches = [
+                    self._start_search(executor, stripe_idx, block_idx, block)
+                    for block_idx, block in blocks
+                ]
+                pending.append(
+                    (o_start_idx, o_end_idx, searches, done, len(blocks))
+                )
+                n_pending += len(blocks)
+                while n_pending >= self.max_pending_blocks:
+                    o_start_idx, o_end_idx, searches, done, n_blocks = (
+                        pending.popleft()
+                    )
+                    n_pending -= n_blocks
+                    yield (
+                        o_start_idx,
+                        o_end_idx,
+                        [
+                            result
+                            for search in searches
+                            for result in search.future.result()
+                        ]
+                        + done,
+                    )
+
+            while pending:
+                o_start_idx, o_end_idx, searches, done, _ = pending.popleft()
+                yield (
+                    o_start_idx,
+                    o_end_idx,
+                    [
+                        result
+                        for search in searches
+                        for result in search.future.result()
+                    ]
+                    + done,
+                )
+
+    def _create_executor(self) -> AbstractContextManager[Executor]:
+        """Executor that runs the block search tasks."""
+        return ThreadPoolExecutor(self.config.ncpu)
+
+    def _start_search(
+        self,
+        executor: Executor,
+        stripe_idx: int,
+        block_idx: int,
+        block: dict,
+    ) -> BlockSearch:
+        """
+        Start searching a top-level block on the executor. Its results are
+        checkpointed once the search, including any sub-blocks, is done.
+        """
+        search = BlockSearch(executor, self.stats).start(
+            [(self._binary_search, block)]
+        )
+        if self.checkpoint is not None:
+            search.future.add_done_callback(
+                lambda future: self._checkpoint_block(
+                    stripe_idx, block_idx, future
+                )
+            )
+        return search
+
+    def _checkpoint_block(
+        self,
+        stripe_idx: int,
+        block_idx: int,
+        future: "Future[list[BlockResult]] | asyncio.Future",
+    ) -> None:
+        """Add the results of a finished top-level block to the checkpoint."""
+        if (
+            self.checkpoint is None
+            or future.cancelled()
+            or future.exception() is not None
+        ):
+            return
+        results = future.result()
+        times = [r for r in results if isinstance(r, pd.DataFrame)]
+        try:
+            self.checkpoint.add_block(
+                stripe_idx,
+                block_idx,
+                pd.concat(times, ignore_index=True) if times else None,
+                [
+                    (r.o_start_idx, r.d_start_idx, r.o_end_idx, r.d_end_idx)
+                    for r in results
+                    if isinstance(r, MissingBlock)
+                ],
+            )
+        except Exception as e:
+            self.config.logger.warning(
+                "Failed to checkpoint block %s of stripe %s: %s",
+                block_idx,
+                stripe_idx,
+                e,
+            )
+
+    def _iter_stripes_to_route(
+        self,
+    ) -> Iterator[
+        tuple[int, int, int, list[tuple[int, dict]], list[BlockResult]]
+    ]:
+        """
+        Yield each stripe of origins as its index, its origin range, the
+        blocks left to route (with their index in the stripe), and the
+        results that are already known: unroutable blocks, and blocks
+        finished by an earlier run.
+
+        Stripes recorded in the checkpoint are replayed with the same
+        blocks. New stripes start where they end and are recorded before
+        they're routed.
+        """
+        if self.checkpoint is None:
+            for stripe_idx, (
+                o_start_idx,
+                o_end_idx,
+                blocks,
+                unroutable,
+            ) in enumerate(self._iter_stripes()):
+                yield (
+                    stripe_idx,
+                    o_start_idx,
+                    o_end_idx,
+                    list(enumerate(blocks)),
+                    unroutable,
+                )
+            return
+
+        o_start_idx = 0
+        for stripe in list(self.checkpoint.stripes):
+            self.stats.increment(n_skipped_pairs=stripe["n_skipped_pairs"])
+            done: list[BlockResult] = [
+                MissingBlock(*block) for block in stripe["unroutable"]
+            ]
+            blocks = []
+            for block_idx, block in enumerate(stripe["blocks"]):
+                if (
+                    stripe["stripe"],
+                    block_idx,
+                ) not in self.checkpoint.finished:
+                    blocks.append((block_idx, block))
+                    continue
+                times, missing = self.checkpoint.read_block(
+                    stripe["stripe"], block_idx
+                )
+                if times is not None:
+                    done.append(times)
+                done.extend(MissingBlock(*block) for block in missing)
+            yield (
+                stripe["stripe"],
+                stripe["o_start_idx"],
+                stripe["o_end_idx"],
+                blocks,
+                done,
+            )
+            o_start_idx = stripe["o_end_idx"]
+
+        # Stripes are generated lazily, so the pairs skipped by each one are
+        # counted as they're generated
+        n_skipped_pairs = self.stats.counts["n_skipped_pairs"]
+        for o_start_idx, o_end_idx, blocks, unroutable in self._iter_stripes(
+            o_start_idx
+        ):
+            stripe_idx = self.checkpoint.add_stripe(
+                o_start_idx,
+                o_end_idx,
+                blocks,
+                [
+                    (b.o_start_idx, b.d_start_idx, b.o_end_idx, b.d_end_idx)
+                    for b in unroutable
+                ],
+                self.stats.counts["n_skipped_pairs"] - n_skipped_pairs,
+            )
+            yield (
+                stripe_idx,
+                o_start_idx,
+                o_end_idx,
+                list(enumerate(blocks)),
+                unroutable,
+            )
+            n_skipped_pairs = self.stats.counts["n_skipped_pairs"]
+
+    def _block_shape(self) -> tuple[int, int]:
+        """Number of origins and destinations in the next top-level blocks."""
+        if self.block_size is not None:
+            return self.block_size.shape
+        return (
+            self.inputs.max_split_size_origins,
+            self.inputs.max_split_size_destinations,
+        )
+
+    def _iter_stripes(
+        self, o_start_idx: int = 0
+    ) -> Iterator[tuple[int, int, list[dict], list[MissingBlock]]]:
+        """
+        Yield the origin range and top-level blocks of each stripe of
+        origins, in origin order, starting from o_start_idx. Each block is a
+        dictionary of _binary_search arguments. The block shape is read again
+        for every stripe, so it can change between stripes.
+
+        Blocks between groups of points that can't reach each other are not
+        routed; they are yielded alongside the stripe as missing blocks
+        instead. Pairs further apart than max_distance_m are skipped where
+        possible.
+        """
+        n_oc = self.inputs.n_origins
+
+        o = o_start_idx
+        while o < n_oc:
+            max_spl_o, m_spl_d = self._block_shape()
+            o_end = min(o + max_spl_o, n_oc)
+            blocks, unroutable = [], []
+            for o_group_start, o_group_end, o_label in self.origin_groups:
+                osi, oei = max(o, o_group_start), min(o_end, o_group_end)
+                if osi >= oei:
+                    continue
+                for d_start, d_end, d_label in self.destination_groups:
+                    if not self._is_routable(o_label, d_label):
+                        unroutable.append(
+                            MissingBlock(osi, d_start, oei, d_end)
+                        )
+                        continue
+                    regions = self._candidate_regions(
+                        osi, d_start, oei, d_end, m_spl_d
+                    )
+                    n_skipped = (oei - osi) * (d_end - d_start) - sum(
+                        self._region_pairs(region) for region in regions
+                    )
+                    if n_skipped:
+                        self.stats.increment(n_skipped_pairs=n_skipped)
+                    blocks.extend(
+                        {
+                            "o_start_idx": region_osi,
+                            "d_start_idx": d,
+                            "o_end_idx": region_oei,
+                            "d_end_idx": min(d + m_spl_d, run_end),
+                            "print_log": True,
+                            "cur_depth": 0,
+                        }
+                        for region_osi, region_oei, runs in regions
+                        for run_start, run_end in runs
+                        for d in range(run_start, run_end, m_spl_d)
+                    )
+            yield o, o_end, blocks, unroutable
+            o = o_end
+
+    def _candidate_regions(
+        self,
+        o_start_idx: int,
+        d_start_idx: int,
+        o_end_idx: int,
+        d_end_idx: int,
+        max_split_size: int,
+    ) -> list[tuple[int, int, list[tuple[int, int]]]]:
+        """
+        Find the pairs of a block of origins and destinations that need
+        routing. Returns (origin start, origin end, destination runs) tuples
+        that cover every pair within max_distance_m of each other.
+
+        Points are ordered spatially, so a smaller range of origins reaches
+        fewer destinations. The origins are halved as long as that cuts the
+        number of pairs to route by at least a quarter.
+        """
+        runs = self._destination_runs(
+            o_start_idx, d_start_idx, o_end_idx, d_end_idx, max_split_size
+        )
+        region = (o_start_idx, o_end_idx, runs)
+        if (
+            self.max_distance_m is None
+            or o_end_idx - o_start_idx < 2 * self.MIN_REGION_ORIGINS
+        ):
+            return [region]
+
+        o_mid_idx = (o_start_idx + o_end_idx) // 2
+        halves = self._candidate_regions(
+            o_start_idx, d_start_idx, o_mid_idx, d_end_idx, max_split_size
+        ) + self._candidate_regions(
+            o_mid_idx, d_start_idx, o_end_idx, d_end_idx, max_split_size
+        )
+        if sum(self._region_pairs(r) for r in halves) <= 0.75 * (
+            self._region_pairs(region)
+        ):
+            return halves
+        return [region]
+
+    @staticmethod
+    def _region_pairs(region: tuple[int, int, list[tuple[int, int]]]) -> int:
+        o_start_idx, o_end_idx, runs = region
+        return (o_end_idx - o_start_idx) * sum(e - s for s, e in runs)
+
+    def _destination_runs(
+        self,
+        o_start_idx: int,
+        d_start_idx: int,
+        o_end_idx: int,
+        d_end_idx: int,
+        max_split_size: int,
+    ) -> list[tuple[int, int]]:
+        """
+        Split a range of destinations into runs that cover every destination
+        within max_distance_m of at least one origin in a range of origins,
+        found with a KD-tree of the origins. Gaps shorter than a tenth of a
+        block are kept inside a run, since routing a few extra pairs is
+        cheaper than sending another request.
+        """
+        if self.max_distance_m is None:
+            return [(d_start_idx, d_end_idx)]
+        tree = cKDTree(self._origin_xyz[o_start_idx:o_end_idx])
+        distance, _ = tree.query(
+            self._destination_xyz[d_start_idx:d_end_idx],
+            k=1,
+            distance_upper_bound=self._max_chord,
+        )
+        idx = np.flatnonzero(np.isfinite(distance)) + d_start_idx
+        if len(idx) == 0:
+            return []
+
+        max_gap = max(max_split_size // 10, 1)
+        breaks = np.flatnonzero(np.diff(idx) > max_gap)
+        starts = np.concatenate([idx[:1], idx[breaks + 1]])
+        ends = np.concatenate([idx[breaks] + 1, idx[-1:] + 1])
+        return list(zip(starts.tolist(), ends.tolist()))
+
+    def _too_far(self, o_idx: np.ndarray, d_idx: np.ndarray) -> np.ndarray:
+        """
+        Flag pairs further apart than max_distance_m. Computed in slices to
+        bound the memory used by the gathered coordinates.
+        """
+        too_far = np.zeros(len(o_idx), dtype=bool)
+        if self.max_distance_m is None:
+            return too_far
+
+        slice_size = 1 << 20
+        for start in range(0, len(o_idx), slice_size):
+            o_sl = o_idx[start : start + slice_size]
+            d_sl = d_idx[start : start + slice_size]
+            cos_angle = np.einsum(
+                "ij,ij->i",
+                self._origin_xyz[o_sl],
+                self._destination_xyz[d_sl],
+            )
+            too_far[start : start + slice_size] = cos_angle < self._min_cos
+        return too_far
+
+    def _result_matrix(
+        self, o_start_idx: int, o_end_idx: int
+    ) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Allocate the result matrix of a range of origins, with a row per
+        origin and a column per destination, both in ID order. Every cell
+        starts as NO_RESULT.
+
+        Returns:
+            The matrix, the ID code of each row, and the row of each origin
+            in the range.
+        """
+        o_codes = self._origin_codes[o_start_idx:o_end_idx]
+        row_codes = np.sort(o_codes)
+        origin_rows = np.searchsorted(row_codes, o_codes)
+        matrix = np.full(
+            (len(row_codes), len(self.destinations)),
+            self.NO_RESULT,
+            dtype=np.float32,
+        )
+        return matrix, row_codes, origin_rows
+
+    def _fill_matrix(
+        self,
+        matrix: np.ndarray,
+        origin_rows: np.ndarray,
+        o_start_idx: int,
+        results: list[BlockResult],
+    ) -> None:
+        """
+        Write block results into a result matrix, emptying the list of
+        results as they're written. Pairs that couldn't be routed or that
+        OSRM returned as null are written as NaN. Pairs further apart than
+        max_distance_m (routed only because they shared a block with closer
+        pairs) are left out and counted as skipped, as are pairs that take
+        longer than max_duration_sec.
+
+        Args:
+            matrix: Result matrix from _result_matrix.
+            origin_rows: Row of each origin in the matrix.
+            o_start_idx: Index of the origin in the first row of the matrix.
+            results: Block results of origins covered by the matrix.
+        """
+        while results:
+            result = results.pop()
+            if isinstance(result, MissingBlock):
+                self._fill_missing_block(
+                    matrix, origin_rows, o_start_idx, result
+                )
+                continue
+
+            o_idx = result["origin_idx"].to_numpy()
+            d_idx = result["destination_idx"].to_numpy()
+            durations = result["duration_sec"].to_numpy()
+            del result
+
+            keep = ~self._too_far(o_idx, d_idx)
+            n_too_far = len(keep) - int(np.count_nonzero(keep))
+            if n_too_far:
+                self.stats.increment(n_skipped_pairs=n_too_far)
+            if self.max_duration_sec is not None:
+                too_long = keep & (durations > self.max_duration_sec)
+                if too_long.any():
+                    self.stats.increment(
+                        n_over_max_duration_pairs=int(too_long.sum())
+                    )
+                    keep &= ~too_long
+            if not keep.all():
+                o_idx, d_idx = o_idx[keep], d_idx[keep]
+                durations = durations[keep]
+
+            matrix[
+                origin_rows[o_idx - o_start_idx],
+                self._destination_codes[d_idx],
+            ] = durations
+
+    def _fill_missing_block(
+        self,
+        matrix: np.ndarray,
+        origin_rows: np.ndarray,
+        o_start_idx: int,
+        block: MissingBlock,
+    ) -> None:
+        """
+        Write a block of pairs that couldn't be routed into a result matrix
+        as NaN. Pairs of the block further apart than max_distance_m are
+        left out and counted as skipped, as they are when routed.
+        """
+        cols = self._destination_codes[block.d_start_idx : block.d_end_idx]
+        if self.max_distance_m is None:
+            rows = origin_rows[
+                block.o_start_idx - o_start_idx : block.o_end_idx - o_start_idx
+            ]
+            matrix[np.ix_(rows, cols)] = np.nan
+            return
+
+        d_xyz = self._destination_xyz[block.d_start_idx : block.d_end_idx]
+        slice_rows = max(1, self.SPLIT_SLICE_CELLS // max(len(cols), 1))
+        for start in range(block.o_start_idx, block.o_end_idx, slice_rows):
+            end = min(start + slice_rows, block.o_end_idx)
+            too_far = self._origin_xyz[start:end] @ d_xyz.T < self._min_cos
+            n_too_far = int(np.count_nonzero(too_far))
+            if n_too_far:
+                self.stats.increment(n_skipped_pairs=n_too_far)
+            rows = origin_rows[start - o_start_idx : end - o_start_idx]
+            matrix[np.ix_(rows, cols)] = np.where(
+                too_far, np.float32(self.NO_RESULT), np.float32(np.nan)
+            )
+
+    def _split_matrix(
+        self, matrix: np.ndarray, row_codes: np.ndarray
+    ) -> tuple[pd.DataFrame, MissingPairs]:
+        """
+        Split a result matrix into a DataFrame of routed times and the
+        missing pairs. Cells are read in row-major order, so both come out
+        sorted by IDs without sorting. The matrix is read in slices of rows:
+        once to count the times and missing pairs, so that the output arrays
+        can be allocated at their final size, and once to fill them.
+
+        Args:
+            matrix: Result matrix from _result_matrix.
+            row_codes: ID code of each row of the matrix.
+        """
+        slice_rows = max(1, self.SPLIT_SLICE_CELLS // max(matrix.shape[1], 1))
+        slices = range(0, len(matrix), slice_rows)
+        n_times, n_missing = 0, 0
+        for start in slices:
+            matrix_sl = matrix[start : start + slice_rows]
+            n_times += int(np.count_nonzero(matrix_sl >= 0))
+            n_missing += int(np.count_nonzero(np.isnan(matrix_sl)))
+
+        o_codes = np.empty(n_times, dtype=np.int32)
+        d_codes = np.empty(n_times, dtype=np.int32)
+        durations = np.empty(n_times, dtype=np.float32)
+        missing_o_codes = np.empty(n_missing, dtype=np.int32)
+        missing_d_codes = np.empty(n_missing, dtype=np.int32)
+        times_pos, missing_pos = 0, 0
+        for start in slices:
+            matrix_sl = matrix[start : start + slice_rows]
+            rows, cols = np.nonzero(matrix_sl >= 0)
+            end = times_pos + len(rows)
+            o_codes[times_pos:end] = row_codes[start + rows]
+            d_codes[times_pos:end] = cols
+            durations[times_pos:end] = matrix_sl[rows, cols]
+            times_pos = end
+
+            rows, cols = np.nonzero(np.isnan(matrix_sl))
+            end = missing_pos + len(rows)
+            missing_o_codes[missing_pos:end] = row_codes[start + rows]
+            missing_d_codes[missing_pos:end] = cols
+            missing_pos = end
+
+        missing_pairs = MissingPairs(
+            self._origin_id_dtype.categories,
+            self._destination_id_dtype.categories,
+        )
+        missing_pairs.add_pairs(missing_o_codes, missing_d_codes)
+        return self._times_df(o_codes, d_codes, durations), missing_pairs
+
+    def _times_df(
+        self, o_codes: np.ndarray, d_codes: np.ndarray, durations: np.ndarray
+    ) -> pd.DataFrame:
+        """
+        Build the output times DataFrame. IDs are categoricals built from the
+        ID codes, and durations are cast to the configured dtype. float64
+        durations are rounded back to OSRM's tenths of a second, so they
+        don't carry float32 rounding error into the output.
+        """
+        if self.duration_dtype == "uint32":
+            durations = np.round(durations).astype(np.uint32)
+        elif self.duration_dtype == "float64":
+            durations = np.round(durations.astype(np.float64), 1)
+        else:
+            durations = durations.astype(self.duration_dtype, copy=False)
+        return pd.DataFrame(
+            {
+                "origin_id": pd.Categorical.from_codes(
+                    o_codes, dtype=self._origin_id_dtype
+                ),
+                "destination_id": pd.Categorical.from_codes(
+                    d_codes, dtype=self._destination_id_dtype
+                ),
+                "duration_sec": durations,
+            }
+        )
+
+
+class AsyncTravelTimeCalculator(TravelTimeCalculator):
+    """
+    Class to calculate travel times between origins and destinations using an
+    asyncio event loop instead of a thread pool.
+
+    A bounded number of OSRM Table API requests are kept in flight at once.
+    Response decoding and DataFrame construction run in worker threads, so
+    they overlap with network waits for other blocks. Blocks that fail are
+    split and searched concurrently.
+    """
+
+    def __init__(
+        self,
+        config: TravelTimeConfig,
+        inputs: TravelTimeInputs,
+        concurrency: int | None = None,
+    ) -> None:
+        super().__init__(config, inputs)
+        self.concurrency = concurrency if concurrency else self.config.ncpu
+        self.max_pending_blocks = 2 * self.concurrency
+        self.client: AsyncOSRMClient
+
+    def _create_client(self) -> AsyncOSRMClient:
+        return AsyncOSRMClient(
+            endpoint=DOCKER_ENDPOINT,
+            concurrency=self.concurrency,
+            connect_timeout=self.config.params["times"]["connect_timeout_sec"],
+            read_timeout=self.config.params["times"]["read_timeout_sec"],
+        )
+
+    async def _calculate_times_async(
+        self,
+        o_start_idx: int,
+        d_start_idx: int,
+        o_end_idx: int,
+        d_end_idx: int,
+    ) -> pd.DataFrame:
+        """
+        Async version of _calculate_times. Sends the request to the OSRM
+        Table API and parses the response in a worker thread.
+        """
+        idx = (o_start_idx, d_start_idx, o_end_idx, d_end_idx)
+        single_pair_df = self._get_single_pair_df(*idx)
+        if single_pair_df is not None:
+            return single_pair_df
+
+        request_path = self.request_builder.build(*idx)
+        halves = self._split_oversized_block(request_path, *idx)
+        if halves:
+            results = await asyncio.gather(
+                *[self._calculate_times_async(*half) for half in halves]
+            )
+            return pd.concat(results, ignore_index=True)
+
+        request_start_time = time.time()
+        try:
+            response_data = await self.client.get(request_path)
+        finally:
+            self.stats.add_latencies(time.time() - request_start_time)
+        self.stats.increment(
+            bytes_received=response_data.get("response_bytes", 0)
+        )
+        return await asyncio.to_thread(
+            parse_table_response, response_data, *idx
+        )
+
+    async def _try_route_async(
+        self,
+        o_start_idx: int,
+        d_start_idx: int,
+        o_end_idx: int,
+        d_end_idx: int,
+    ) -> pd.DataFrame | Exception:
+        """Async version of _try_route."""
+        try:
+            return await self._calculate_times_async(
+                o_start_idx, d_start_idx, o_end_idx, d_end_idx
+            )
+        except Exception as e:
+            return e
+
+    async def _run_search_step_async(
+        self, step: SearchStep
+    ) -> tuple[list[BlockResult], list[SearchTask]]:
+        """
+        Async version of _run_search_step. The blocks a step asks for at
+        once (e.g. both halves of a group test) are routed concurrently.
+        """
+        try:
+            blocks = next(step)
+            while True:
+                outcomes = await asyncio.gather(
+                    *[self._try_route_async(*b) for b in blocks]
+                )
+                blocks = step.send(list(outcomes))
+        except StopIteration as stop:
+            return stop.value
+
+    async def _search_async(self, task: SearchTask) -> list[BlockResult]:
+        """
+        Run a search task and, concurrently, all the tasks that follow from
+        it. Tasks name the sync method whose step is run, e.g. _group_test
+        runs _group_test_step.
+        """
+        fn, kwargs = task
+        self.stats.count_task(kwargs["cur_depth"])
+        step = getattr(self, f"{fn.__name__}_step")(**kwargs)
+        results, tasks = await self._run_search_step_async(step)
+        searches = await asyncio.gather(
+            *[self._search_async(task) for task in tasks]
+        )
+        return results + [df for search in searches for df in search]
+
+    async def _route_stripe_async(
+        self,
+        stripe_idx: int,
+        blocks: list[tuple[int, dict]],
+        done: list[BlockResult],
+    ) -> list[BlockResult]:
+        """
+        Route all blocks of a stripe of origins concurrently, checkpointing
+        each one as it finishes.
+        """
+        tasks = []
+        for block_idx, block in blocks:
+            task = asyncio.ensure_future(
+                self._search_async((self._binary_search, block))
+            )
+            if self.checkpoint is not None:
+                task.add_done_callback(
+                    lambda task, block_idx=block_idx: self._checkpoint_block(
+                        stripe_idx, block_idx, task
+                    )
+                )
+            tasks.append(task)
+        results = await asyncio.gather(*tasks)
+        return [df for block in results for df in block] + done
+
+    def _iter_stripe_results(
+        self,
+    ) -> Iterator[tuple[int, int, list[BlockResult]]]:
+        """
+        Version of _iter_stripe_results using the asyncio engine. The event
+        loop only runs while waiting for the next stripe, but the queued
+        stripes all make progress while it does.
+        """
+        loop = asyncio.new_event_loop()
+        client = self._create_client()
+        pending: deque[tuple[int, int, asyncio.Task, int]] = deque()
+        n_pending = 0
+        try:
+            self.client = loop.run_until_complete(client.__aenter__())
+            for (
+                stripe_idx,
+                o_start_idx,
+                o_end_idx,
+                blocks,
+                done,
+            ) in self._iter_stripes_to_route():
+                task = loop.create_task(
+                    self._route_stripe_async(stripe_idx, blocks, done)
+                )
+                pending.append((o_start_idx, o_end_idx, task, len(blocks)))
+                n_pending += len(blocks)
+                while n_pending >= self.max_pending_blocks:
+                    o_start_idx, o_end_idx, task, n_blocks = pending.popleft()
+                    n_pending -= n_blocks
+                    yield o_start_idx, o_end_idx, loop.run_until_complete(task)
+
+            while pending:
+                o_start_idx, o_end_idx, task, _ = pending.popleft()
+                yield o_start_idx, o_end_idx, loop.run_until_complete(task)
+        finally:
+            for _, _, task, _ in pending:
+                task.cancel()
+            loop.run_until_complete(client.__aexit__(None, None, None))
+            loop.close()
+
+
+class RecordedBlockSizes:
+    """
+    Stand-in for the BlockSizeController in worker processes. Keeps the
+    outcomes of top-level blocks so they can be replayed to the controller
+    of the main process.
+    """
+
+    def __init__(self) -> None:
+        self.records: list[tuple[int, int, float, bool]] = []
+
+    def record(
+        self,
+        n_origins: int,
+        n_destinations: int,
+        elapsed_sec: float,
+        failed: bool = False,
+    ) -> None:
+        self.records.append((n_origins, n_destinations, elapsed_sec, failed))
+
+
+# Output of a block search task run in a worker process: the routed times as
+# an Arrow record batch (None if nothing was routed), the missing blocks, the
+# follow-up tasks by method name, the stats counts and request latencies,
+# and the recorded block sizes
+WorkerTaskResult = tuple[
+    pa.RecordBatch | None,
+    list[MissingBlock],
+    list[tuple[str, dict[str, Any]]],
+    dict[str, int],
+    list[float],
+    list[tuple[int, int, float, bool]],
+]
+
+# Calculator of the current worker process, set up by _init_block_worker
+_worker_calc: "ProcessTravelTimeCalculator | None" = None
+
+
+def _init_block_worker(
+    config: TravelTimeConfig,
+    specs: SharedArraySpecs,
+    lon_col: str,
+    lat_col: str,
+    adaptive: bool,
+) -> None:
+    """Set up the calculator of a worker process. Runs once per worker."""
+    global _worker_calc
+    _worker_calc = ProcessTravelTimeCalculator._for_worker(
+        config, specs, lon_col, lat_col, adaptive
+    )
+
+
+def _run_block_task(method: str, kwargs: dict[str, Any]) -> WorkerTaskResult:
+    """Run one block search task in a worker process."""
+    calc = _worker_calc
+    assert calc is not None, "Block worker was not initialized"
+    calc.stats = RoutingStats()
+    recorded = RecordedBlockSizes()
+    if calc.adaptive:
+        calc.block_size = recorded  # type: ignore[assignment]
+
+    results, tasks = getattr(calc, method)(**kwargs)
+    times = [r for r in results if isinstance(r, pd.DataFrame)]
+    batch = None
+    if times:
+        df = pd.concat(times, ignore_index=True)
+        batch = pa.RecordBatch.from_arrays(
+            [pa.array(df[col].to_numpy()) for col in df.columns],
+            names=list(df.columns),
+        )
+    return (
+        batch,
+        [r for r in results if isinstance(r, MissingBlock)],
+        [(fn.__name__, task_kwargs) for fn, task_kwargs in tasks],
+        dict(calc.stats.counts),
+        calc.stats.request_latencies,
+        recorded.records,
+    )
+
+
+class BlockWorkerPool(Executor):
+    """
+    Executor that runs the search tasks of a ProcessTravelTimeCalculator in a
+    pool of worker processes, so they can be driven by BlockSearch like
+    tasks on a thread pool.
+
+    Tasks are sent to the workers as a method name and block indices. Each
+    returned future resolves in the main process, once the worker's output
+    has been converted back: times to DataFrames, follow-up tasks to bound
+    methods, and stats and block sizes merged into the calculator's own.
+    """
+
+    def __init__(
+        self,
+        calc: "ProcessTravelTimeCalculator",
+        executor: ProcessPoolExecutor,
+    ) -> None:
+        self.calc = calc
+        self.executor = executor
+
+    def submit(self, fn, /, *args, **kwargs) -> Future:
+        future: Future = Future()
+        self.executor.submit(
+            _run_block_task, fn.__name__, kwargs
+        ).add_done_callback(lambda f: self._on_done(future, f))
+        return future
+
+    def _on_done(self, future: Future, worker_future: Future) -> None:
+        try:
+            batch, missing, tasks, counts, latencies, block_sizes = (
+                worker_future.result()
+            )
+        except Exception as e:
+            future.set_exception(e)
+            return
+        self.calc.stats.increment(**counts)
+        self.calc.stats.add_latencies(*latencies)
+        if self.calc.block_size is not None:
+            for record in block_sizes:
+                self.calc.block_size.record(*record)
+
+        results: list[BlockResult] = list(missing)
+        if batch is not None:
+            results.append(batch.to_pandas())
+        future.set_result(
+            (
+                results,
+                [
+                    (getattr(self.calc, name), task_kwargs)
+                    for name, task_kwargs in tasks
+                ],
+            )
+        )
+
+    def shutdown(self, wait: bool = True, *, cancel_futures: bool = False):
+        self.executor.shutdown(wait=wait, cancel_futures=cancel_futures)
+
+
+class ProcessTravelTimeCalculator(TravelTimeCalculator):
+    """
+    Class to calculate travel times between origins and destinations using a
+    pool of worker processes instead of a thread pool.
+
+    Decoding OSRM responses and building DataFrames hold the GIL, so routing
+    threads can only keep about one core busy with them. Here, every block
+    search task runs in a worker process with its own OSRM connection.
+    Origin and destination coordinates are copied once into shared memory
+    that the workers attach to, so tasks only carry block indices, and
+    routed times come back as Arrow record batches. Sub-blocks of failed
+    blocks are sent back through the main process, so any idle worker can
+    pick them up.
+    """
+
+    def __init__(
+        self,
+        config: TravelTimeConfig,
+        inputs: TravelTimeInputs,
+        n_workers: int | None = None,
+    ) -> None:
+        super().__init__(config, inputs)
+        self.n_workers = n_workers if n_workers else self.config.ncpu
+        self.max_pending_blocks = 2 * self.n_workers
+        self.adaptive = self.block_size is not None
+
+        # Index of the origin with the same ID as each destination (-1 if
+        # there is none), so workers can spot single pairs of the same point
+        # without the IDs
+        self._destination_origin_idx = pd.Index(
+            self.origins["id"]
+        ).get_indexer(self.destinations["id"])
+
+    @classmethod
+    def _for_worker(
+        cls,
+        config: TravelTimeConfig,
+        specs: SharedArraySpecs,
+        lon_col: str,
+        lat_col: str,
+        adaptive: bool,
+    ) -> "ProcessTravelTimeCalculator":
+        """
+        Create the calculator of a worker process. It only gets what the
+        block search methods use, built from the shared arrays.
+        """
+        calc = cls.__new__(cls)
+        arrays, calc._shared_blocks = SharedArrays.attach(specs)
+
+        # Workers run one task at a time, so need a single connection
+        if not config.logger.handlers:
+            config.logger = create_logger(config.logger.name)
+        config.ncpu = 1
+        config.client = config._create_client()
+        calc.config = config
+
+        calc.lon_col, calc.lat_col = lon_col, lat_col
+        calc.request_builder = TableRequestBuilder(
+            mode=config.args.mode,
+            origins=pd.DataFrame(
+                {lon_col: arrays["origin_lon"], lat_col: arrays["origin_lat"]}
+            ),
+            destinations=pd.DataFrame(
+                {
+                    lon_col: arrays["destination_lon"],
+                    lat_col: arrays["destination_lat"],
+                }
+            ),
+            lon_col=lon_col,
+            lat_col=lat_col,
+            encoding=config.params["times"]["coordinate_encoding"],
+        )
+        calc._destination_origin_idx = arrays["destination_origin_idx"]
+        calc.max_url_bytes = config.params["times"]["max_url_bytes"]
+        calc.fault_isolation = config.params["times"]["fault_isolation"]
+        calc.adaptive = adaptive
+        calc.block_size = None
+        calc.stats = RoutingStats()
+        return calc
+
+    def _same_id(self, o_idx: int, d_idx: int) -> bool:
+        return bool(self._destination_origin_idx[d_idx] == o_idx)
+
+    @contextmanager
+    def _create_executor(self) -> Iterator[Executor]:
+        """
+        Share the coordinates and start the worker processes. Workers are
+        started with forkserver, so they don't inherit the inputs or the
+        connections of the main process.
+        """
+        arrays = {
+            "origin_lon": self.origins[self.lon_col].to_numpy(),
+            "origin_lat": self.origins[self.lat_col].to_numpy(),
+            "destination_lon": self.destinations[self.lon_col].to_numpy(),
+            "destination_lat": self.destinations[self.lat_col].to_numpy(),
+            "destination_origin_idx": self._destination_origin_idx,
+        }
+        worker_config = copy.copy(self.config)
+        worker_config.client = None  # type: ignore[assignment]
+        with (
+            SharedArrays(arrays) as shared,
+            ProcessPoolExecutor(
+                self.n_workers,
+                mp_context=multiprocessing.get_context("forkserver"),
+                initializer=_init_block_worker,
+                initargs=(
+                    worker_config,
+                    shared.specs,
+                    self.lon_col,
+                    self.lat_col,
+                    self.adaptive,
+                ),
+            ) as executor,
+        ):
+            yield BlockWorkerPool(self, executor)
+
+
+def snap_df_to_osm(
+    df: pd.DataFrame,
+    mode: str,
+    client: RoutingBackend,
+    cache: dict[str, list[float]] | None = None,
+) -> pd.DataFrame:
+    """
+    Snap a DataFrame of lat/lon points to the OpenStreetMap network using
+    the OSRM Nearest API.
+
+    Args:
+        df: DataFrame containing the columns 'id', 'lat', and 'lon'.
+        mode: Travel mode to use for snapping.
+        client: Routing backend used to send the Nearest API requests.
+        cache: Snapped coordinates by "lon,lat" string, shared between
+            calls. Only coordinates missing from it are sent to the client.
+    """
+    coords_list = format_coords(df["lon"], df["lat"]).tolist()
+
+    # Snap each input coordinate to the OSM grid. The OSRM Nearest API only
+    # takes one coordinate pair at a time, so reuse the client's keep-alive
+    # connection for every request
+    if cache is None:
+        cache = {}
+    for coord in coords_list:
+        if coord not in cache:
+            cache[coord] = client.nearest(mode, coord)
+    snapped_list = [cache[coord] for coord in coords_list]
 
     snapped_df = pd.DataFrame(
         [
@@ -3,7 +3,15 @@ import itertools
 import math
 from pathlib import Path
 
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from utils.constants import OD_ROW_GROUP_SIZE
+from utils.logging import create_logger
+
+logger = create_logger(__name__)
 
 
 def create_empty_df(
@@ -52,6 +60,175 @@ def get_md5_hash(file_path):
     return hash_md5.hexdigest()
 
 
+def hilbert_index(
+    lon: np.ndarray,
+    lat: np.ndarray,
+    bounds: tuple[float, float, float, float],
+    order: int = 16,
+) -> np.ndarray:
+    """
+    Get the position of each point along a Hilbert curve covering a bounding
+    box. Points that are close together along the curve are also close
+    together in space, so sorting by this index groups nearby points.
+
+    Args:
+        lon: Longitudes of the points.
+        lat: Latitudes of the points.
+        bounds: Bounding box as (min lon, min lat, max lon, max lat).
+        order: Number of levels of the curve. The box is divided into a grid
+            of 2^order by 2^order cells.
+    """
+    n = 1 << order
+    min_lon, min_lat, max_lon, max_lat = bounds
+
+    def _scale(values: np.ndarray, low: float, high: float) -> np.ndarray:
+        scaled = (np.asarray(values, dtype=np.float64) - low) / max(
+            high - low, 1e-12
+        )
+        return np.clip((scaled * (n - 1)).round(), 0, n - 1).astype(np.int64)
+
+    x, y = _scale(lon, min_lon, max_lon), _scale(lat, min_lat, max_lat)
+    d = np.zeros(len(x), dtype=np.int64)
+    s = n >> 1
+    while s > 0:
+        rx = (x & s) > 0
+        ry = (y & s) > 0
+        d += s * s * ((3 * rx) ^ ry)
+
+        # Rotate each quadrant so the curve stays continuous across it
+        flip = rx & ~ry
+        x = np.where(flip, n - 1 - x, x)
+        y = np.where(flip, n - 1 - y, y)
+        x, y = np.where(ry, x, y), np.where(ry, y, x)
+        s >>= 1
+    return d
+
+
+def sphere_coords(lon: np.ndarray, lat: np.ndarray) -> np.ndarray:
+    """
+    Convert longitudes and latitudes to 3D unit vectors. The straight-line
+    (chord) distance between two vectors is a monotonic function of their
+    great-circle distance, so they can be used with Euclidean KD-trees.
+    """
+    lon_rad = np.radians(np.asarray(lon, dtype=np.float64))
+    lat_rad = np.radians(np.asarray(lat, dtype=np.float64))
+    return np.column_stack(
+        [
+            np.cos(lat_rad) * np.cos(lon_rad),
+            np.cos(lat_rad) * np.sin(lon_rad),
+            np.sin(lat_rad),
+        ]
+    )
+
+
+def is_sorted_parquet(file: pq.ParquetFile, column: str) -> bool:
+    """
+    Check whether the metadata of a Parquet file says that every row group
+    is sorted in ascending order by the given column. Row groups are written
+    in order, so the whole file is then sorted by it.
+    """
+    metadata = file.metadata
+    for i in range(metadata.num_row_groups):
+        sorting_columns = metadata.row_group(i).sorting_columns
+        if not sorting_columns:
+            return False
+        sort_keys, _ = pq.SortingColumn.to_ordering(
+            file.schema_arrow, sorting_columns[:1]
+        )
+        if sort_keys[0] != (column, "ascending"):
+            return False
+    return True
+
+
+def read_parquet_rows(
+    file: str | Path,
+    columns: list[str],
+    sort_by: str,
+    start_idx: int | None = None,
+    end_idx: int | None = None,
+) -> tuple[pd.DataFrame, int]:
+    """
+    Read a range of rows of a Parquet file sorted by a column, and only the
+    given columns. Files written by write_sorted_parquet have their sort
+    order in their metadata, so only the row groups covering the range are
+    read. Other files, such as cenloc and destpoint files created before
+    write_sorted_parquet, are read whole and sorted in memory, with a
+    warning.
+
+    Args:
+        file: The path to the Parquet file.
+        columns: The columns to read.
+        sort_by: The column the rows are sorted by.
+        start_idx: The first row to read, in sorted order. Defaults to 0.
+        end_idx: The row to stop before, in sorted order. Defaults to the
+            number of rows.
+
+    Returns:
+        The rows, and the total number of rows in the file.
+    """
+    parquet_file = pq.ParquetFile(file)
+    n_rows = parquet_file.metadata.num_rows
+    start_idx = 0 if start_idx is None else max(start_idx, 0)
+    end_idx = n_rows if end_idx is None else min(end_idx, n_rows)
+
+    if not is_sorted_parquet(parquet_file, sort_by):
+        logger.warning(
+            "%s isn't sorted by %s in its metadata, so it's read whole and "
+            "sorted. Rerun the DVC stage that creates it to read only the "
+            "rows needed",
+            file,
+            sort_by,
+        )
+        df = (
+            parquet_file.read(columns=columns)
+            .to_pandas()
+            .sort_values(by=sort_by)
+            .iloc[start_idx:end_idx]
+        )
+        return df, n_rows
+
+    # Find the row groups that overlap the range from their row counts
+    row_groups = []
+    first_row = group_start = 0
+    for i in range(parquet_file.metadata.num_row_groups):
+        group_end = group_start + parquet_file.metadata.row_group(i).num_rows
+        if group_start < end_idx and group_end > start_idx:
+            if not row_groups:
+                first_row = group_start
+            row_groups.append(i)
+        group_start = group_end
+
+    table = parquet_file.read_row_groups(row_groups, columns=columns)
+    df = table.to_pandas().iloc[
+        start_idx - first_row : max(end_idx - first_row, 0)
+    ]
+    return df, n_rows
+
+
+def write_sorted_parquet(
+    df: pd.DataFrame,
+    file: str | Path,
+    sort_by: str,
+    row_group_size: int = OD_ROW_GROUP_SIZE,
+) -> None:
+    """
+    Write a DataFrame to Parquet sorted by a column, with small row groups
+    and the sort order recorded in the file metadata. Ranges of rows can
+    then be read with read_parquet_rows without reading the whole file.
+    """
+    table = pa.Table.from_pandas(
+        df.sort_values(by=sort_by), preserve_index=False
+    )
+    pq.write_table(
+        table,
+        file,
+        row_group_size=row_group_size,
+        sorting_columns=pq.SortingColumn.from_ordering(
+            table.schema, [(sort_by, "ascending")]
+        ),
+    )
+
+
 def split_file_to_str(file: str | Path, **kwargs) -> list[str]:
     """
     Splits the contents of a Parquet file into chunks and return the chunk
@@ -65,8 +242,8 @@ def split_file_to_str(file: str | Path, **kwargs) -> list[str]:
         A list of hyphen-separated strings representing the chunked ranges in
         the format "start-end".
     """
-    df = pd.read_parquet(file)
-    chunk_idx = split_range(len(df), **kwargs)
+    n_rows = pq.ParquetFile(file).metadata.num_rows
+    chunk_idx = split_range(n_rows, **kwargs)
     zfill_size = len(str(chunk_idx[-1][1]))
     chunk_str = [
         f"{str(start).zfill(zfill_size)}-{str(end).zfill(zfill_size)}"